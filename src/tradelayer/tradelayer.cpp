@@ -4848,7 +4848,11 @@ int mastercore_handler_block_begin(int nBlockPrev, CBlockIndex const * pBlockInd
     if (nHeight == params.MSC_VESTING_CREATION_BLOCK) creatingVestingTokens(nHeight);
 
     /** Vesting Tokens to Balance **/
-    if (nHeight > params.MSC_VESTING_BLOCK) VestingTokens(nHeight);
+    if (nHeight > params.MSC_VESTING_BLOCK) {
+        const int64_t nTimeStart = GetTimeMicros();
+        VestingTokens(nHeight);
+        LogPrint(BCLog::BENCH, "      - Vesting: %.2fms\n", (GetTimeMicros() - nTimeStart) * 0.001);
+    }
 
     /** Channels **/
     if (nHeight > params.MSC_TRADECHANNEL_TOKENS_BLOCK)
@@ -4923,8 +4927,10 @@ int mastercore_handler_block_end(int nBlockNow, CBlockIndex const * pBlockIndex,
        {
          PrintToLog("%s(): Running LiquidationEngine and Settlement (actual block: %d)\n",
            __func__, nBlockNow);
+           const int64_t nTimeStart = GetTimeMicros();
            LiquidationEngine(nBlockNow);
            bS.makeSettlement();
+           LogPrint(BCLog::BENCH, "      - Settlement: %.2fms\n", (GetTimeMicros() - nTimeStart) * 0.001);
        }
 
        // deleting Expired DEx accepts
@@ -4972,7 +4978,9 @@ int mastercore_handler_block_end(int nBlockNow, CBlockIndex const * pBlockIndex,
      if (checkpointValid){
          // save out the state after this block
          if (writePersistence(nBlockNow) && nBlockNow >= params.GENESIS_BLOCK) {
+              const int64_t nTimeStart = GetTimeMicros();
               mastercore_save_state(pBlockIndex);
+              LogPrint(BCLog::BENCH, "      - Save state: %.2fms\n", (GetTimeMicros() - nTimeStart) * 0.001);
           }
       }
 
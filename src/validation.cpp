@@ -2293,6 +2293,9 @@ static int64_t nTimeConnectTotal = 0;
 static int64_t nTimeFlush = 0;
 static int64_t nTimeChainState = 0;
 static int64_t nTimePostConnect = 0;
+static int64_t nTimeTLBlockBegin = 0;
+static int64_t nTimeTLHandlerTx = 0;
+static int64_t nTimeTLBlockEnd = 0;
 
 struct PerBlockConnectTrace {
     CBlockIndex* pindex = nullptr;
@@ -2421,6 +2424,8 @@ bool CChainState::ConnectTip(CValidationState& state, const CChainParams& chainp
        // LogPrint("handler", "Trade Layer handler: block connect begin [height: %d]\n", GetHeight());
        mastercore_handler_block_begin(GetHeight(), pindexNew);
     }
+    int64_t nTimeTL1 = GetTimeMicros(); nTimeTLBlockBegin += nTimeTL1 - nTime5;
+    LogPrint(BCLog::BENCH, "    - Tradelayer block begin: %.2fms [%.2fs (%.2fms/blk)]\n", (nTimeTL1 - nTime5) * MILLI, nTimeTLBlockBegin * MICRO, nTimeTLBlockBegin * MILLI / nBlocksTotal);
 
     // Remove conflicting transactions from the mempool.;
     mempool.removeForBlock(blockConnecting.vtx, pindexNew->nHeight);
@@ -2430,12 +2435,17 @@ bool CChainState::ConnectTip(CValidationState& state, const CChainParams& chainp
     chainActive.SetTip(pindexNew);
     UpdateTip(pindexNew, chainparams);
 
+    int64_t nTimeTL2 = GetTimeMicros();
     for(const CTransactionRef& tx : blockConnecting.vtx){
         //! Trade Layer: new confirmed transaction notification
         if (mastercore_handler_tx(*tx, pindexNew->nHeight, nTxIdx++, pindexNew, removedCoins)) ++nNumMetaTxs;
     }
+    int64_t nTimeTL3 = GetTimeMicros(); nTimeTLHandlerTx += nTimeTL3 - nTimeTL2;
+    LogPrint(BCLog::BENCH, "    - Tradelayer handler_tx (%u txs, %u meta): %.2fms [%.2fs (%.2fms/blk)]\n", nTxIdx, nNumMetaTxs, (nTimeTL3 - nTimeTL2) * MILLI, nTimeTLHandlerTx * MICRO, nTimeTLHandlerTx * MILLI / nBlocksTotal);
 
     mastercore_handler_block_end(pindexNew->nHeight, pindexNew, nNumMetaTxs);
+    int64_t nTimeTL4 = GetTimeMicros(); nTimeTLBlockEnd += nTimeTL4 - nTimeTL3;
+    LogPrint(BCLog::BENCH, "    - Tradelayer block end: %.2fms [%.2fs (%.2fms/blk)]\n", (nTimeTL4 - nTimeTL3) * MILLI, nTimeTLBlockEnd * MICRO, nTimeTLBlockEnd * MILLI / nBlocksTotal);
 
     int64_t nTime6 = GetTimeMicros(); nTimePostConnect += nTime6 - nTime5; nTimeTotal += nTime6 - nTime1;
     LogPrint(BCLog::BENCH, "  - Connect postprocess: %.2fms [%.2fs (%.2fms/blk)]\n", (nTime6 - nTime5) * MILLI, nTimePostConnect * MICRO, nTimePostConnect * MILLI / nBlocksTotal);
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Extract per-block processing times from litecoind debug.logs.
+
+The argument is either a test temporary directory, in which case the
+debug.log of every node is read, or the path of a single debug.log (for
+example of a production node).
+
+Blocks are delimited by the UpdateTip line that connects them. With
+-debug=bench (on in the functional tests), ConnectTip logs the time of every
+step of connecting a block, including the Tradelayer handlers:
+
+    - Connect block         the whole of ConnectTip
+      - Connect total       ConnectBlock, the script and UTXO checks
+      - Connect postprocess mempool update, UpdateTip and the Tradelayer handlers
+        - Tradelayer block begin, handler_tx and block end
+          - Vesting, Settlement and Save state (the persistence writes)
+
+Without bench logging, only the time between consecutive UpdateTips is
+available. It is a good approximation of the processing time of a block
+during a reindex or initial sync, when blocks are connected back to back.
+
+The output is a summary of the percentiles of every metric and the blocks
+that took longest. The per-block series can be written as CSV, the series
+and the summary as JSON."""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import re
+import sys
+
+from combine_logs import LogReader, MOCKTIME_PATTERN
+
+# Bench lines, e.g. "  - Connect total: 1.23ms [0.45s (0.67ms/blk)]".
+# Only the time of the block is used, not the running totals.
+BENCH_PATTERN = re.compile(r"^\s*- (?P<step>[^:(]+?)(?: \((?P<txs>\d+) txs, (?P<meta>\d+) meta\))?: (?P<ms>[0-9.]+)ms")
+UPDATETIP_PATTERN = re.compile(r"^UpdateTip: new best=(?P<hash>[0-9a-f]{64}) height=(?P<height>\d+)")
+
+# Bench step name -> metric, in the order of the output columns
+BENCH_METRICS = [
+    ("Connect block", "connect_block_ms"),
+    ("Load block from disk", "load_ms"),
+    ("Connect total", "connect_total_ms"),
+    ("Flush", "flush_ms"),
+    ("Writing chainstate", "chainstate_ms"),
+    ("Connect postprocess", "postprocess_ms"),
+    ("Tradelayer block begin", "tl_block_begin_ms"),
+    ("Vesting", "tl_vesting_ms"),
+    ("Tradelayer handler_tx", "tl_handler_tx_ms"),
+    ("Tradelayer block end", "tl_block_end_ms"),
+    ("Settlement", "tl_settlement_ms"),
+    ("Save state", "tl_save_state_ms"),
+]
+STEP_METRICS = dict(BENCH_METRICS)
+
+METRICS = ["interval_ms"] + [metric for _, metric in BENCH_METRICS]
+COLUMNS = ["node", "height", "hash", "time", "txs", "meta_txs"] + METRICS
+
+PERCENTILES = [50, 90, 99]
+
+def main():
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] <test temporary directory or debug.log>', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='test temporary directory or debug.log')
+    parser.add_argument('--node', help='only read the debug.logs of these nodes of a test temporary directory (comma-separated)')
+    parser.add_argument('--top', type=int, default=10, help='number of outlier blocks to list (default: %(default)s)')
+    parser.add_argument('--sortby', default='connect_block_ms', choices=METRICS, help='metric to rank the outlier blocks by (default: %(default)s, interval_ms if there is no bench logging)')
+    parser.add_argument('--csv', metavar='FILE', help='write the per-block series as CSV to FILE ("-" for stdout)')
+    parser.add_argument('--json', metavar='FILE', help='write the per-block series, percentiles and outliers as JSON to FILE ("-" for stdout)')
+    args = parser.parse_args()
+
+    readers = block_log_readers(args.path)
+    if args.node:
+        nodes = set(args.node.split(","))
+        readers = [reader for reader in readers if str(reader.node) in nodes]
+    if not readers:
+        print("No debug.log found in %s" % args.path, file=sys.stderr)
+        sys.exit(1)
+
+    blocks = []
+    for reader in readers:
+        blocks.extend(block_timings(reader))
+    if not blocks:
+        print("No connected blocks found", file=sys.stderr)
+        sys.exit(1)
+
+    summary = summarize(blocks)
+    sortby = args.sortby
+    if summary[sortby]["count"] == 0:
+        sortby = "interval_ms"
+    outliers = top_blocks(blocks, sortby, args.top)
+
+    if args.csv:
+        with open_output(args.csv) as f:
+            write_csv(blocks, f)
+    if args.json:
+        with open_output(args.json) as f:
+            json.dump({"blocks": blocks, "percentiles": summary, "sortby": sortby, "outliers": outliers}, f, indent=1)
+            f.write("\n")
+    if "-" not in (args.csv, args.json):
+        print_summary(blocks, summary, sortby, outliers)
+
+def block_log_readers(path):
+    """Return LogReaders for a debug.log, or for the debug.log of every node of a test temporary directory."""
+    if os.path.isfile(path):
+        return [LogReader("node", 0, path)]
+    readers = []
+    for i in itertools.count():
+        logfile = os.path.join(path, "node%d" % i, "regtest", "debug.log")
+        if not os.path.isfile(logfile):
+            break
+        readers.append(LogReader("node%d" % i, i, logfile))
+    return readers
+
+def block_timings(reader):
+    """Return a dict per block connected in the log of reader, in log order.
+
+    Bench lines come before the UpdateTip line of their block (load, connect,
+    flush, chainstate, Tradelayer block begin) and after it (Tradelayer
+    handler_tx and block end, postprocess, and "Connect block", which is
+    the last line of ConnectTip)."""
+    blocks = []
+    current = {}
+    last_tip_time = None
+
+    def finish():
+        nonlocal current
+        if "height" in current:
+            blocks.append(current)
+        current = {}
+
+    for event in reader.events():
+        message = MOCKTIME_PATTERN.sub("", event.event[len(event.timestamp):].lstrip(), count=1)
+        match = UPDATETIP_PATTERN.match(message)
+        if match:
+            if current.get("disconnect"):
+                # The UpdateTip of a disconnect is not a block being connected
+                current = {}
+                last_tip_time = None
+                continue
+            if "height" in current:
+                # No bench logging, the previous block has no "Connect block" line
+                finish()
+            current.update(node=reader.node, height=int(match.group("height")), hash=match.group("hash"), time=event.timestamp)
+            if last_tip_time is not None:
+                current["interval_ms"] = round((event.time - last_tip_time) * 1000, 3)
+            last_tip_time = event.time
+            continue
+        match = BENCH_PATTERN.match(message)
+        if not match:
+            continue
+        step = match.group("step")
+        if step == "Load block from disk":
+            # First line of ConnectTip
+            finish()
+        elif step == "Disconnect block":
+            # Logged before the UpdateTip of the disconnect
+            finish()
+            current["disconnect"] = True
+            continue
+        metric = STEP_METRICS.get(step)
+        if metric is None:
+            continue
+        current[metric] = float(match.group("ms"))
+        if match.group("txs") is not None:
+            current["txs"] = int(match.group("txs"))
+            current["meta_txs"] = int(match.group("meta"))
+        if step == "Connect block":
+            finish()
+    finish()
+    return blocks
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a sorted list of values."""
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+def summarize(blocks):
+    """Return {metric: {count, mean, p50, p90, p99, max, total}} over all blocks."""
+    summary = {}
+    for metric in METRICS:
+        values = sorted(block[metric] for block in blocks if metric in block)
+        stats = {"count": len(values)}
+        if values:
+            stats["mean"] = round(sum(values) / len(values), 3)
+            for pct in PERCENTILES:
+                stats["p%d" % pct] = percentile(values, pct)
+            stats["max"] = values[-1]
+            stats["total"] = round(sum(values), 3)
+        summary[metric] = stats
+    return summary
+
+def top_blocks(blocks, metric, count):
+    return sorted((block for block in blocks if metric in block), key=lambda block: -block[metric])[:count]
+
+def open_output(path):
+    if path == "-":
+        # Don't close stdout
+        return open(sys.stdout.fileno(), 'w', encoding='utf8', closefd=False)
+    return open(path, 'w', encoding='utf8', newline='')
+
+def write_csv(blocks, f):
+    writer = csv.DictWriter(f, fieldnames=COLUMNS, restval="")
+    writer.writeheader()
+    writer.writerows(blocks)
+
+def print_summary(blocks, summary, sortby, outliers):
+    print("%d blocks" % len(blocks))
+    print("")
+    print("%-20s %7s %10s %10s %10s %10s %10s %12s" % ("metric (ms)", "blocks", "mean", *("p%d" % pct for pct in PERCENTILES), "max", "total"))
+    for metric in METRICS:
+        stats = summary[metric]
+        if not stats["count"]:
+            continue
+        print("%-20s %7d %10.2f %10.2f %10.2f %10.2f %10.2f %12.2f" % (metric[:-3], stats["count"], stats["mean"], *(stats["p%d" % pct] for pct in PERCENTILES), stats["max"], stats["total"]))
+    print("")
+    print("Slowest blocks by %s:" % sortby[:-3])
+    print("%-6s %8s %10s %10s %10s %6s %6s  %s" % ("node", "height", sortby[:-3], "tl_tx", "tl_end", "txs", "meta", "time"))
+    for block in outliers:
+        print("%-6s %8d %10.2f %10s %10s %6s %6s  %s" % (block["node"], block["height"], block[sortby],
+                                                          format_ms(block.get("tl_handler_tx_ms")), format_ms(block.get("tl_block_end_ms")),
+                                                          block.get("txs", ""), block.get("meta_txs", ""), block["time"]))
+
+def format_ms(value):
+    return "" if value is None else "%.2f" % value
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,62 @@
 """Combine logs from multiple bitcoin nodes as well as the test_framework log.
 
 This streams the combined log output to stdout. Use combine_logs.py > outputfile
-to write to an outputfile."""
+to write to an outputfile.
+
+The logs are read through mmap. The first time a log file is read, a sparse
+index of the timestamps of its events is written next to it (<log>.idx), so
+that a time window (--start/--end) can be extracted from very large logs
+without scanning them. Events can also be filtered by node, category and
+regular expression.
+
+tradelayer.log timestamps only have whole seconds and follow mocktime, so
+Tradelayer events are merged by a time that may be up to a second early
+relative to debug.log events, and in tests that set mocktime, by a time
+that has nothing to do with the other logs: they then all sort together,
+and fall outside --start/--end windows given relative to the test. The
+times in tradelayer.log are not guaranteed to increase, so it is scanned
+whole rather than through the index."""
 
 import argparse
+from bisect import bisect_left
+import calendar
 from collections import defaultdict, namedtuple
+import hashlib
 import heapq
 import itertools
+import mmap
 import os
 import re
+import struct
 import sys
+import time
+
+from test_framework.logtail import classify_debug
+
+# Matches on the date format at the start of the log event: "2018-05-01 12:34:56.123456"
+# in test_framework.log, "2018-05-01T12:34:56.123456Z" in debug.log and tradelayer.log
+# Only used with match(), which anchors it at the given position
+TIMESTAMP_PATTERN = re.compile(rb"(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(\.\d+)?Z?")
 
-# Matches on the date format at the start of the log event
-TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}")
+MOCKTIME_PATTERN = re.compile(r"^\(mocktime: [^)]*\) ")
 
-LogEvent = namedtuple('LogEvent', ['timestamp', 'source', 'event'])
+# time: seconds since the epoch, used to merge the logs
+LogEvent = namedtuple('LogEvent', ['time', 'timestamp', 'source', 'event'])
+
+# One index entry per INDEX_INTERVAL bytes of log
+INDEX_INTERVAL = 64 * 1024
+INDEX_MAGIC = b"CLOGIDX2"
+# magic, indexed size, inode and mtime (ns) of the log file, digest of the
+# first and last INDEX_CHECK_SIZE bytes of the indexed part
+INDEX_HEADER = struct.Struct("<8sQQQ16s")
+INDEX_CHECK_SIZE = 4096
+# time, offset of the first event at or after an interval boundary
+INDEX_ENTRY = struct.Struct("<dQ")
+
+DEFAULT_PAGE_SIZE = 10000
+
+# Events of debug.log are categorized by test_framework.logtail.classify_debug()
+CATEGORIES = ["test", "tradelayer", "init", "validation", "bench", "mempool", "rpc", "net", "wallet", "other"]
 
 def main():
     """Main function. Parses args, reads the log files and renders them as text or html."""
@@ -23,6 +65,13 @@ def main():
     parser = argparse.ArgumentParser(usage='%(prog)s [options] <test temporary directory>', description=__doc__)
     parser.add_argument('-c', '--color', dest='color', action='store_true', help='outputs the combined log with events colored by source (requires posix terminal colors. Use less -r for viewing)')
     parser.add_argument('--html', dest='html', action='store_true', help='outputs the combined log as html. Requires jinja2. pip install jinja2')
+    parser.add_argument('--page', type=int, default=1, help='with --html, the page of events to output (default: 1)')
+    parser.add_argument('--pagesize', type=int, default=DEFAULT_PAGE_SIZE, help='with --html, the number of events per page (default: %(default)s)')
+    parser.add_argument('--start', help='only output events from this time on: YYYY-MM-DD HH:MM:SS[.ffffff] (UTC), or +SECONDS after the first event of the test')
+    parser.add_argument('--end', help='only output events up to this time, in the same formats as --start')
+    parser.add_argument('--node', help='only output the events of these nodes: a comma-separated list of node numbers, and "test" for the test_framework log')
+    parser.add_argument('--category', help='only output events of these categories: a comma-separated list of %s' % ", ".join(CATEGORIES))
+    parser.add_argument('--grep', help='only output events matching this regular expression')
     args, unknown_args = parser.parse_known_args()
 
     if args.color and os.name != 'posix':
@@ -38,77 +87,234 @@ def main():
         print("Unexpected arguments" + str(unknown_args))
         sys.exit(1)
 
-    log_events = read_logs(unknown_args[0])
+    readers = log_readers(unknown_args[0])
+    origin = readers[0].first_time() if args.start or args.end else None
+    if args.node:
+        nodes = set(args.node.split(","))
+        readers = [reader for reader in readers if str(reader.node) in nodes]
+    start = parse_time(args.start, origin) if args.start else None
+    end = parse_time(args.end, origin) if args.end else None
 
-    print_logs(log_events, color=args.color, html=args.html)
+    log_events = heapq.merge(*[reader.events(start, end) for reader in readers])
+    if args.category:
+        categories = set(args.category.split(","))
+        log_events = (event for event in log_events if event_category(event) in categories)
+    if args.grep:
+        regex = re.compile(args.grep)
+        log_events = (event for event in log_events if regex.search(event.event))
 
-def read_logs(tmp_dir):
-    """Reads log files.
+    if args.html:
+        print_html(log_events, args.page, args.pagesize)
+    else:
+        print_logs(log_events, color=args.color)
 
-    Delegates to generator function get_log_events() to provide individual log events
-    for each of the input log files."""
+def log_readers(tmp_dir):
+    """Return LogReaders for the test_framework log and the debug.log and tradelayer.log of every node."""
 
-    files = [("test", "%s/test_framework.log" % tmp_dir)]
+    readers = [LogReader("test", "test", "%s/test_framework.log" % tmp_dir)]
     for i in itertools.count():
         logfile = "{}/node{}/regtest/debug.log".format(tmp_dir, i)
         if not os.path.isfile(logfile):
             break
-        files.append(("node%d" % i, logfile))
+        readers.append(LogReader("node%d" % i, i, logfile))
+        tradelayer_log = "{}/node{}/regtest/tradelayer.log".format(tmp_dir, i)
+        if os.path.isfile(tradelayer_log):
+            readers.append(LogReader("node%d-tl" % i, i, tradelayer_log, ordered=False))
+    return readers
 
-    return heapq.merge(*[get_log_events(source, f) for source, f in files])
+_epoch_cache = {}
 
-def get_log_events(source, logfile):
-    """Generator function that returns individual log events.
+def timestamp_to_time(match):
+    """Return the seconds since the epoch of a TIMESTAMP_PATTERN match."""
+    date, clock, fraction = match.groups()
+    key = date + clock
+    seconds = _epoch_cache.get(key)
+    if seconds is None:
+        seconds = _epoch_cache[key] = calendar.timegm(time.strptime(key.decode('ascii'), "%Y-%m-%d%H:%M:%S"))
+    return seconds + float(fraction) if fraction else seconds
+
+def parse_time(value, origin):
+    if value.startswith("+"):
+        if origin is None:
+            print("Relative times need the test_framework log", file=sys.stderr)
+            sys.exit(1)
+        return origin + float(value[1:])
+    match = TIMESTAMP_PATTERN.match(value.encode('ascii'))
+    if not match:
+        print("Invalid time %s" % value, file=sys.stderr)
+        sys.exit(1)
+    return timestamp_to_time(match)
+
+def event_category(event):
+    if event.source == "test":
+        return "test"
+    if event.source.endswith("-tl"):
+        return "tradelayer"
+    message = MOCKTIME_PATTERN.sub("", event.event[len(event.timestamp):].lstrip(), count=1)
+    return classify_debug(message)
+
+class LogReader():
+    """Read the events of a log file through mmap.
 
     Log events may be split over multiple lines. We use the timestamp
-    regex match as the marker for a new log event."""
-    try:
-        with open(logfile, 'r') as infile:
-            event = ''
-            timestamp = ''
-            for line in infile:
-                # skip blank lines
-                if line == '\n':
-                    continue
-                # if this line has a timestamp, it's the start of a new log event.
-                time_match = TIMESTAMP_PATTERN.match(line)
-                if time_match:
-                    if event:
-                        yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
-                    event = line
-                    timestamp = time_match.group()
-                # if it doesn't have a timestamp, it's a continuation line of the previous log.
-                else:
-                    event += "\n" + line
-            # Flush the final event
-            yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
-    except FileNotFoundError:
-        print("File %s could not be opened. Continuing without it." % logfile, file=sys.stderr)
-
-def print_logs(log_events, color=False, html=False):
-    """Renders the iterator of log events into text or html."""
-    if not html:
-        colors = defaultdict(lambda: '')
-        if color:
-            colors["test"] = "\033[0;36m"   # CYAN
-            colors["node0"] = "\033[0;34m"  # BLUE
-            colors["node1"] = "\033[0;32m"  # GREEN
-            colors["node2"] = "\033[0;31m"  # RED
-            colors["node3"] = "\033[0;33m"  # YELLOW
-            colors["reset"] = "\033[0m"     # Reset font color
-
-        for event in log_events:
-            print("{0} {1: <5} {2} {3}".format(colors[event.source.rstrip()], event.source, event.event, colors["reset"]))
+    regex match as the marker for a new log event.
 
-    else:
+    Log files are written in time order, so the time of the first event after
+    every INDEX_INTERVAL bytes is enough to find where a time window starts.
+    The index is kept in <log>.idx and extended when the log has grown since
+    it was written. Logs whose times may decrease (ordered=False) are not
+    indexed, but scanned whole. It is rebuilt when the log was rewritten (e.g. by
+    ShrinkDebugFile), which is detected by the mtime for a log of the same
+    size, and by the head and tail of the indexed part for a longer one."""
+
+    def __init__(self, source, node, path, ordered=True):
+        self.source = source
+        self.node = node
+        self.path = path
+        self.ordered = ordered
+        self.times = []
+        self.offsets = []
+
+    def first_time(self):
+        for event in self.events():
+            return event.time
+        return None
+
+    def _open(self):
+        """Return an mmap of the log file, or None if it is missing or empty."""
         try:
-            import jinja2
-        except ImportError:
-            print("jinja2 not found. Try `pip install jinja2`")
-            sys.exit(1)
-        print(jinja2.Environment(loader=jinja2.FileSystemLoader('./'))
-                    .get_template('combined_log_template.html')
-                    .render(title="Combined Logs from testcase", log_events=[event._asdict() for event in log_events]))
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            print("File %s could not be opened. Continuing without it." % self.path, file=sys.stderr)
+            return None
+
+    def _next_event_start(self, data, pos):
+        """Return the offset and timestamp match of the first event starting at or after pos, or (None, None)."""
+        while pos < len(data):
+            match = TIMESTAMP_PATTERN.match(data, pos)
+            if match:
+                return pos, match
+            newline = data.find(b"\n", pos)
+            if newline < 0:
+                break
+            pos = newline + 1
+        return None, None
+
+    @staticmethod
+    def _digest(data, size):
+        """Return a digest of the first and last INDEX_CHECK_SIZE bytes of data[:size]."""
+        return hashlib.blake2b(data[:INDEX_CHECK_SIZE] + data[max(0, size - INDEX_CHECK_SIZE):size], digest_size=16).digest()
+
+    def _load_index(self, data):
+        """Read the sidecar index and extend it to the current end of the log."""
+        index_path = self.path + ".idx"
+        st = os.stat(self.path)
+        indexed_size = 0
+        self.times, self.offsets = [], []
+        try:
+            with open(index_path, 'rb') as f:
+                magic, size, inode, mtime, digest = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                valid = magic == INDEX_MAGIC and inode == st.st_ino and size <= len(data)
+                if valid and size == len(data):
+                    valid = mtime == st.st_mtime_ns
+                if valid and size < len(data):
+                    valid = digest == self._digest(data, size)
+                if valid:
+                    for entry_time, offset in INDEX_ENTRY.iter_unpack(f.read()):
+                        self.times.append(entry_time)
+                        self.offsets.append(offset)
+                    indexed_size = size
+        except (OSError, struct.error):
+            pass
+
+        if indexed_size == len(data):
+            return
+        # Index the part of the log that was appended since
+        pos = self.offsets[-1] + INDEX_INTERVAL if self.offsets else 0
+        while pos < len(data):
+            if pos:
+                # Continue at the start of the next line
+                newline = data.find(b"\n", pos)
+                if newline < 0:
+                    break
+                pos = newline + 1
+            offset, match = self._next_event_start(data, pos)
+            if offset is None:
+                break
+            self.times.append(timestamp_to_time(match))
+            self.offsets.append(offset)
+            pos = offset + INDEX_INTERVAL
+        try:
+            with open(index_path, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(data), st.st_ino, st.st_mtime_ns, self._digest(data, len(data))))
+                for entry in zip(self.times, self.offsets):
+                    f.write(INDEX_ENTRY.pack(*entry))
+        except OSError:
+            # Read-only log directory, keep the index in memory only
+            pass
+
+    def events(self, start=None, end=None):
+        """Generator function that returns the log events between start and end (in seconds since the epoch)."""
+        data = self._open()
+        if data is None:
+            return
+        try:
+            pos = 0
+            if start is not None and self.ordered:
+                self._load_index(data)
+                # The last indexed event before start
+                i = bisect_left(self.times, start) - 1
+                pos = self.offsets[i] if i >= 0 else 0
+            pos, match = self._next_event_start(data, pos)
+            while pos is not None:
+                event_time = timestamp_to_time(match)
+                if end is not None and event_time > end and self.ordered:
+                    break
+                # The event ends where the next line with a timestamp starts
+                next_pos, next_match = self._next_event_start(data, data.find(b"\n", pos) + 1 or len(data))
+                if (start is None or event_time >= start) and (end is None or event_time <= end):
+                    text = data[pos:next_pos if next_pos is not None else len(data)].decode('utf8', 'replace').rstrip()
+                    if "\n\n" in text:
+                        # skip blank lines
+                        text = "\n".join(line for line in text.split("\n") if line)
+                    yield LogEvent(time=event_time, timestamp=match.group(0).decode('ascii'), source=self.source, event=text)
+                pos, match = next_pos, next_match
+        finally:
+            data.close()
+
+def print_logs(log_events, color=False):
+    """Renders the iterator of log events into text."""
+    colors = defaultdict(lambda: '')
+    if color:
+        colors["test"] = "\033[0;36m"   # CYAN
+        colors["node0"] = "\033[0;34m"  # BLUE
+        colors["node1"] = "\033[0;32m"  # GREEN
+        colors["node2"] = "\033[0;31m"  # RED
+        colors["node3"] = "\033[0;33m"  # YELLOW
+        colors["reset"] = "\033[0m"     # Reset font color
+
+    for event in log_events:
+        print("{0} {1: <5} {2} {3}".format(colors[event.source.split("-")[0]], event.source, event.event, colors["reset"]))
+
+def print_html(log_events, page, page_size):
+    """Renders one page of the iterator of log events into html."""
+    try:
+        import jinja2
+    except ImportError:
+        print("jinja2 not found. Try `pip install jinja2`")
+        sys.exit(1)
+    first = (page - 1) * page_size
+    events = [event._asdict() for event in itertools.islice(log_events, first, first + page_size)]
+    # Only look one event further, to tell whether there is a next page
+    more = next(log_events, None) is not None
+    template_dir = os.path.dirname(os.path.abspath(__file__))
+    print(jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
+                .get_template('combined_log_template.html')
+                .render(title="Combined Logs from testcase", log_events=events,
+                        page=page, more=more, first=first + 1))
 
 if __name__ == '__main__':
     main()
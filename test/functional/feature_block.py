@@ -68,6 +68,8 @@ class FullBlockTest(ComparisonTestFramework):
     def add_options(self, parser):
         super().add_options(parser)
         parser.add_option("--runbarelyexpensive", dest="runbarelyexpensive", default=True)
+        parser.add_option("--pipelinewindow", dest="pipeline_window", default=0, type='int',
+                          help="Deliver runs of up to this many accepted blocks without syncing each one (default: %default, sync every block)")
 
     def run_test(self):
         self.test = TestManager(self, self.options.tmpdir)
@@ -1158,6 +1160,7 @@ class FullBlockTest(ComparisonTestFramework):
         yield accepted()
 
         # mempool should be empty
+        self.test.sync_pipeline()
         assert_equal(len(self.nodes[0].getrawmempool()), 0)
 
         tip(77)
@@ -1174,6 +1177,7 @@ class FullBlockTest(ComparisonTestFramework):
         save_spendable_output()
 
         # now check that tx78 and tx79 have been put back into the peer's mempool
+        self.test.sync_pipeline()
         mempool = self.nodes[0].getrawmempool()
         assert_equal(len(mempool), 2)
         assert(tx78.hash in mempool)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Feed a node a locally built chain and measure how fast it ingests it.
+
+Builds --blocks blocks on top of the genesis block with ChainBuilder and
+submits half of them with batched submitblock calls and half over P2P (or all
+of them one way with --via). With --reindex, the node is then restarted with
+-reindex and the time to rebuild the chain and the Tradelayer state is
+measured as well. Use --blocks=100000 to build histories for rescan and
+reindex benchmarks.
+"""
+
+import json
+import time
+
+from test_framework.chainbuilder import ChainBuilder
+from test_framework.mininode import P2PInterface, network_thread_join, network_thread_start
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, wait_until
+
+class FabricatedChainTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+
+    def add_options(self, parser):
+        parser.add_option("--blocks", dest="blocks", default=2000, type='int',
+                          help="Number of blocks to build (default: %default)")
+        parser.add_option("--via", dest="via", default="both", type='choice', choices=["both", "rpc", "p2p"],
+                          help="Submit the blocks with submitblock, over P2P, or half each (default: %default)")
+        parser.add_option("--batchsize", dest="batchsize", default=100, type='int',
+                          help="Blocks per submitblock batch or per P2P ping (default: %default)")
+        parser.add_option("--reindex", dest="reindex", default=False, action="store_true",
+                          help="Measure a -reindex of the built chain")
+        parser.add_option("--resultfile", dest="resultfile", default=None,
+                          help="Write the results as JSON to this file")
+
+    def run_test(self):
+        node = self.nodes[0]
+        builder = ChainBuilder.from_node(node)
+        results = {}
+
+        rpc_blocks = {"both": self.options.blocks // 2, "rpc": self.options.blocks, "p2p": 0}[self.options.via]
+        p2p_blocks = self.options.blocks - rpc_blocks
+
+        if rpc_blocks:
+            self.log.info("Submit %d blocks with submitblock" % rpc_blocks)
+            results["rpc"] = builder.submit_rpc(node, rpc_blocks, batch_size=self.options.batchsize)
+            self.log_stats(results["rpc"])
+            assert_equal(node.getblockcount(), builder.height)
+
+        if p2p_blocks:
+            self.log.info("Send %d blocks over P2P" % p2p_blocks)
+            node.add_p2p_connection(P2PInterface())
+            network_thread_start()
+            node.p2p.wait_for_verack()
+            results["p2p"] = builder.submit_p2p(node.p2p, p2p_blocks, batch_size=self.options.batchsize)
+            self.log_stats(results["p2p"])
+            node.disconnect_p2ps()
+            network_thread_join()
+
+        assert_equal(node.getblockcount(), self.options.blocks)
+        assert_equal(node.getbestblockhash(), "%064x" % builder.tip)
+
+        if self.options.reindex:
+            self.log.info("Reindex the chain")
+            self.stop_node(0)
+            start = time.time()
+            self.start_node(0, extra_args=["-reindex"])
+            wait_until(lambda: node.getblockcount() == self.options.blocks, timeout=3600)
+            elapsed = time.time() - start
+            results["reindex"] = {"blocks": self.options.blocks, "elapsed": elapsed,
+                                  "blocks_per_second": self.options.blocks / elapsed}
+            self.log.info("Reindexed %d blocks in %.1f s (%.0f blocks/s)" % (self.options.blocks, elapsed, self.options.blocks / elapsed))
+            assert_equal(node.getbestblockhash(), "%064x" % builder.tip)
+
+        if self.options.resultfile:
+            with open(self.options.resultfile, 'w', encoding='utf8') as f:
+                json.dump(results, f, indent=4)
+
+    def log_stats(self, stats):
+        self.log.info("%d blocks in %.1f s: %.0f blocks/s (building %.1f s, submitting %.1f s)" %
+                      (stats["blocks"], stats["elapsed"], stats["blocks_per_second"], stats["build_seconds"], stats["submit_seconds"]))
+
+if __name__ == '__main__':
+    FabricatedChainTest().main()
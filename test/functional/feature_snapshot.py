@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test starting nodes from a ChainSnapshot.
+
+The snapshot holds 200 mined blocks and three funded, self-attested
+addresses. The first run builds it; later runs restore it from the cache.
+Check that the chain, the wallet and the Tradelayer state all come back,
+and that a second node beyond the snapshot starts on a clean chain.
+"""
+
+import os
+
+from test_framework.snapshot import CACHE_ENTRIES, ChainSnapshot
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal
+
+def build_attested_addresses(test):
+    node = test.nodes[0]
+    node.generate(200)
+    addresses = [node.getnewaddress(account) for account in ["john", "doe", "another"]]
+    for address in addresses:
+        node.sendtoaddress(address, 0.1)
+    node.generate(1)
+    for address in addresses:
+        node.tl_attestation(address, address, "")
+    node.generate(1)
+    return {"addresses": addresses}
+
+class SnapshotTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 2
+        self.extra_args = [["-txindex=1"], ["-txindex=1"]]
+        self.snapshot = ChainSnapshot("attested-addresses", 1, build_attested_addresses,
+                                      extra_args=[["-txindex=1"]])
+
+    def setup_network(self):
+        self.setup_nodes()
+
+    def run_test(self):
+        node = self.nodes[0]
+        addresses = self.snapshot_data["addresses"]
+
+        self.log.info("Check the restored datadir")
+        regtest = os.path.join(node.datadir, "regtest")
+        for entry in CACHE_ENTRIES:
+            assert os.path.isdir(os.path.join(regtest, entry)), entry
+
+        self.log.info("Check the restored chain and wallet")
+        assert_equal(node.getblockcount(), 202)
+        for address in addresses:
+            assert_equal(float(node.getreceivedbyaddress(address)), 0.1)
+
+        self.log.info("Check the restored Tradelayer state")
+        attestations = node.tl_list_attestation()
+        assert_equal(sorted(a['att sender'] for a in attestations), sorted(addresses))
+        for a in attestations:
+            assert_equal(a['att sender'], a['att receiver'])
+
+        self.log.info("Check that a node outside the snapshot starts clean")
+        assert_equal(self.nodes[1].getblockcount(), 0)
+
+        self.log.info("Check that the restored node keeps working")
+        node.generate(1)
+        assert_equal(node.getblockcount(), 203)
+
+if __name__ == '__main__':
+    SnapshotTest().main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Measure how many transactions per second a node accepts into its mempool.
+
+Opens --peers P2P connections to a single node and streams pre-built
+transactions through them, either as fast as possible or at --rate tx/s.
+The transactions come from the node's own wallet, or from --txfile (one
+hex-encoded transaction per line, spendable on the node's chain).
+
+Acceptance latency is the time from sending a transaction to it appearing
+in getrawmempool, or in a ZMQ hashtx notification if --zmq is given.
+"""
+
+import configparser
+from decimal import Decimal
+import json
+import os
+
+from test_framework.mininode import network_thread_join, network_thread_start
+from test_framework.test_framework import BitcoinTestFramework, SkipTest
+from test_framework.txflood import (
+    TxFlood,
+    create_wallet_transactions,
+    load_transactions,
+)
+from test_framework.util import assert_equal, p2p_port
+
+class MempoolTxFloodTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.extra_args = [["-txindex=1"]]
+
+    def add_options(self, parser):
+        parser.add_option("--txcount", dest="txcount", default=500, type='int',
+                          help="Number of wallet transactions to flood (default: %default)")
+        parser.add_option("--peers", dest="peers", default=4, type='int',
+                          help="Number of P2P connections to send through (default: %default)")
+        parser.add_option("--rate", dest="rate", default=None, type='float',
+                          help="Target transactions per second (default: as fast as possible)")
+        parser.add_option("--announce", dest="announce", default=False, action="store_true",
+                          help="Announce transactions with inv and wait for getdata")
+        parser.add_option("--txfile", dest="txfile", default=None,
+                          help="Flood transactions from this file instead of the wallet")
+        parser.add_option("--zmq", dest="zmq", default=False, action="store_true",
+                          help="Measure latency with ZMQ hashtx notifications instead of polling getrawmempool")
+        parser.add_option("--resultfile", dest="resultfile", default=None,
+                          help="Write the results as JSON to this file")
+
+    def setup_nodes(self):
+        self.zmq_address = None
+        if self.options.zmq:
+            try:
+                import zmq
+            except ImportError:
+                raise SkipTest("python3-zmq module not available.")
+            config = configparser.ConfigParser()
+            if not self.options.configfile:
+                self.options.configfile = os.path.abspath(os.path.join(os.path.dirname(__file__), "../config.ini"))
+            config.read_file(open(self.options.configfile))
+            if not config["components"].getboolean("ENABLE_ZMQ"):
+                raise SkipTest("litecoind has not been built with zmq enabled.")
+            # Use a port in this test's own range so parallel runs don't collide
+            self.zmq_address = "tcp://127.0.0.1:%d" % (p2p_port(self.num_nodes))
+            self.extra_args[0].append("-zmqpubhashtx=%s" % self.zmq_address)
+        super().setup_nodes()
+
+    def run_test(self):
+        node = self.nodes[0]
+        if self.options.txfile:
+            txs = load_transactions(self.options.txfile)
+            self.log.info("Loaded %d transactions from %s" % (len(txs), self.options.txfile))
+        else:
+            self.log.info("Create %d wallet transactions" % self.options.txcount)
+            txs = create_wallet_transactions(node, self.options.txcount, Decimal("0.0001"))
+        assert_equal(node.getmempoolinfo()['size'], 0)
+
+        flood = TxFlood(node, txs, num_peers=self.options.peers, rate=self.options.rate,
+                        announce=self.options.announce, zmq_address=self.zmq_address)
+        flood.add_peers()
+        network_thread_start()
+
+        self.log.info("Flood %d transactions through %d peers" % (len(txs), self.options.peers))
+        result = flood.run()
+        if result["accepted"]:
+            self.log.info("Acceptance latency p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s" %
+                          (result["latency_p50"], result["latency_p90"], result["latency_p99"], result["latency_max"]))
+        for i, peer in enumerate(result["peers"]):
+            self.log.debug("peer%d: %s" % (i, peer))
+        if result["reject_reasons"]:
+            self.log.info("Reject reasons: %s" % result["reject_reasons"])
+        if self.options.resultfile:
+            with open(self.options.resultfile, 'w', encoding='utf8') as f:
+                json.dump(result, f, indent=4)
+
+        if not self.options.txfile:
+            # Wallet transactions are all valid and independent
+            assert_equal(result["accepted"], len(txs))
+            assert_equal(result["rejected"], 0)
+            assert_equal(node.getmempoolinfo()['size'], len(txs))
+
+        node.disconnect_p2ps()
+        network_thread_join()
+
+if __name__ == '__main__':
+    MempoolTxFloodTest().main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test P2P traffic capture and replay.
+
+- Connect a P2PInterface to node0 and record its traffic to a capture file
+  while node0 mines blocks and relays them to it.
+- Check the capture contains the expected messages.
+- Replay the received messages into node1, which is not connected to node0,
+  at full speed and check that node1 syncs to node0's tip.
+"""
+
+import os
+
+from test_framework.mininode import (
+    CAPTURE_RECV,
+    CAPTURE_SEND,
+    P2PInterface,
+    P2PReplayer,
+    message_command,
+    mininode_lock,
+    network_thread_join,
+    network_thread_start,
+    read_capture,
+)
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, assert_greater_than, wait_until
+
+class P2PCaptureReplayTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 2
+
+    def setup_network(self):
+        # Leave the nodes unconnected: node1 only learns about blocks through the replay
+        self.setup_nodes()
+
+    def run_test(self):
+        capture_path = os.path.join(self.options.tmpdir, "node0.p2pcap")
+
+        self.log.info("Record blocks relayed by node0")
+        recorder = P2PInterface()
+        recorder.start_capture(capture_path)
+        self.nodes[0].add_p2p_connection(recorder)
+        network_thread_start()
+        recorder.wait_for_verack()
+        blockhashes = self.nodes[0].generate(20)
+        wait_until(lambda: recorder.message_count["block"] == 20, timeout=60, lock=mininode_lock)
+        recorder.sync_with_ping()
+        capture = recorder.stop_capture()
+        self.nodes[0].disconnect_p2ps()
+        network_thread_join()
+
+        records = list(read_capture(capture_path))
+        assert_equal(len(records), capture.num_messages)
+        received = [message_command(data) for direction, _, data in records if direction == CAPTURE_RECV]
+        sent = [message_command(data) for direction, _, data in records if direction == CAPTURE_SEND]
+        assert_equal(received.count(b"block"), 20)
+        assert_equal(sent[0], b"version")
+        assert b"getdata" in sent
+        assert_equal([t for _, t, _ in records], sorted(t for _, t, _ in records))
+
+        self.log.info("Replay the received blocks into node1")
+        assert_equal(self.nodes[1].getblockcount(), 0)
+        replayer = self.nodes[1].add_p2p_connection(P2PReplayer())
+        network_thread_start()
+        replayer.wait_for_verack()
+        stats = replayer.replay(capture_path, commands=["block"])
+        assert_equal(stats["messages"], 20)
+        assert_greater_than(stats["msgs_per_s"], 0)
+        wait_until(lambda: self.nodes[1].getbestblockhash() == blockhashes[-1], timeout=60)
+        assert_equal(self.nodes[1].getblockcount(), 20)
+
+if __name__ == '__main__':
+    P2PCaptureReplayTest().main()
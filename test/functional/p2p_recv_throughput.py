@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Benchmark the mininode receive path.
+
+A loopback peer streams --megabytes worth of large `block` messages to a
+P2PInterface as fast as the socket allows. The test checks that every block
+was framed, verified and delivered, and logs the receive throughput.
+
+By default the blocks are only counted and the last one is decoded on
+access. Pass --decode to deserialize every block as it arrives.
+
+No litecoind is started: this measures the test framework itself."""
+
+import socket
+import threading
+import time
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.mininode import (
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    COutPoint,
+    FramedMessage,
+    P2PInterface,
+    mininode_lock,
+    msg_block,
+    network_thread_join,
+    network_thread_start,
+)
+from test_framework.script import CScript, OP_RETURN
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, wait_until
+
+class LoopbackPeer(threading.Thread):
+    """Listens on a loopback port and floods the first connection with a message."""
+
+    def __init__(self, data, count):
+        super().__init__(name="LoopbackPeer")
+        self.data = data
+        self.count = count
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        conn, _ = self.listener.accept()
+        self.listener.close()
+        with conn:
+            for _ in range(self.count):
+                conn.sendall(self.data)
+            # Wait for the other side to hang up
+            while conn.recv(4096):
+                pass
+
+class BlockCounter(P2PInterface):
+    """Counts blocks without deserializing them."""
+    subscribed_commands = set()
+
+class P2PRecvThroughputTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.num_nodes = 0
+        self.setup_clean_chain = True
+
+    def add_options(self, parser):
+        parser.add_option("--megabytes", dest="megabytes", default=100, type='int',
+                          help="Amount of block data to stream through the loopback peer (default: %default)")
+        parser.add_option("--decode", dest="decode", default=False, action="store_true",
+                          help="Deserialize every received block")
+
+    def setup_network(self):
+        pass
+
+    def make_large_block(self, size):
+        """Build a block of roughly `size` bytes out of OP_RETURN transactions."""
+        block = create_block(0, create_coinbase(1), 0)
+        script = CScript([OP_RETURN, b"\x01" * 10000])
+        while len(block.serialize()) < size:
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(len(block.vtx), 0), b"", 0xffffffff))
+            tx.vout.append(CTxOut(0, script))
+            block.vtx.append(tx)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        return block
+
+    def run_test(self):
+        block = self.make_large_block(1000000)
+        data = FramedMessage(msg_block(block)).serialize()
+        count = max(1, self.options.megabytes * 1000000 // len(data))
+        self.log.info("Streaming %d blocks of %d bytes" % (count, len(data)))
+
+        peer = LoopbackPeer(data, count)
+        peer.start()
+
+        conn = P2PInterface() if self.options.decode else BlockCounter()
+        conn.peer_connect("127.0.0.1", peer.port)
+        start = time.time()
+        network_thread_start()
+        wait_until(lambda: conn.message_count["block"] == count, timeout=600, lock=mininode_lock)
+        elapsed = time.time() - start
+
+        with mininode_lock:
+            assert_equal(conn.last_message["block"].block.rehash(), block.sha256)
+        self.log.info("Received %.1f MB in %.2f s (%.1f MB/s, %.1f blocks/s)" %
+                      (count * len(data) / 1e6, elapsed, count * len(data) / 1e6 / elapsed, count / elapsed))
+
+        conn.peer_disconnect()
+        network_thread_join()
+        peer.join()
+
+if __name__ == '__main__':
+    P2PRecvThroughputTest().main()
@@ -47,6 +47,10 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 log = logging.getLogger("BitcoinRPC")
 
+# Number of HTTP requests made by all proxies of this process, and the time
+# spent waiting for their responses
+RPC_STATS = {"requests": 0, "seconds": 0.0}
+
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
         try:
@@ -94,14 +98,23 @@ class AuthServiceProxy():
         return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
 
     def _request(self, method, path, postdata):
-        '''
-        Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
-        This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
-        '''
+        """Do a HTTP request and count it in RPC_STATS."""
         headers = {'Host': self.__url.hostname,
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
+        start = time.time()
+        RPC_STATS["requests"] += 1
+        try:
+            return self._send(method, path, postdata, headers)
+        finally:
+            RPC_STATS["seconds"] += time.time() - start
+
+    def _send(self, method, path, postdata, headers):
+        '''
+        Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
+        This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
+        '''
         try:
             self.__conn.request(method, path, postdata, headers)
             return self._get_response()
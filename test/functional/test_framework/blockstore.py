@@ -2,14 +2,102 @@
 # Copyright (c) 2015-2017 The Bitcoin Core developers
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""BlockStore and TxStore helper classes."""
+"""BlockStore and TxStore helper classes.
+
+Serialized blocks and transactions are appended to a data file and located
+through an in-memory index, so lookups cost one pread() and nothing is ever
+rewritten. BlockStore also keeps a header chain index with skip pointers,
+so walking back along the chain does not touch the data file."""
 
 from .mininode import *
 from io import BytesIO
-import dbm.dumb as dbmd
+import os
 
 logger = logging.getLogger("TestFramework.blockstore")
 
+class AppendOnlyFile():
+    """A data file that records are only ever appended to."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.size = 0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def append(self, data):
+        """Append a record and return its (offset, length)."""
+        offset = self.size
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fd, data[written:], offset + written)
+        self.size += len(data)
+        return offset, len(data)
+
+    def read(self, location):
+        offset, length = location
+        return os.pread(self.fd, length, offset)
+
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+def get_skip_height(height):
+    """Return the height a block's skip pointer points to, as in CBlockIndex."""
+    if height < 2:
+        return 0
+    # Any number strictly lower than height is acceptable, but this gives
+    # O(log n) ancestor lookups while keeping the pointers mostly short.
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+class HeaderEntry():
+    """An entry in the header chain index.
+
+    Heights are relative to the root of the known chain, which is the first
+    stored block whose parent is unknown."""
+    __slots__ = ("header", "prev", "skip", "height", "location", "children")
+
+    def __init__(self, header):
+        self.header = header
+        self.prev = None
+        self.skip = None
+        self.height = 0
+        self.location = None
+        self.children = []
+
+    def link(self, prev):
+        """Attach this entry to its parent and compute its height and skip pointer."""
+        self.prev = prev
+        if prev is None:
+            self.height = 0
+            self.skip = None
+        else:
+            self.height = prev.height + 1
+            self.skip = prev.get_ancestor(get_skip_height(self.height))
+
+    def get_ancestor(self, height):
+        """Return the ancestor of this entry at a given height, or None."""
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        height_walk = self.height
+        while height_walk > height:
+            height_skip = get_skip_height(height_walk)
+            height_skip_prev = get_skip_height(height_walk - 1)
+            if walk.skip is not None and (height_skip == height or
+                                          (height_skip > height and not (height_skip_prev < height_skip - 2 and
+                                                                         height_skip_prev >= height))):
+                # Only follow the skip pointer if prev.skip isn't better than skip.prev.
+                walk = walk.skip
+                height_walk = height_skip
+            else:
+                walk = walk.prev
+                height_walk -= 1
+        return walk
+
 class BlockStore():
     """BlockStore helper class.
 
@@ -19,24 +107,29 @@ class BlockStore():
     """
 
     def __init__(self, datadir):
-        self.blockDB = dbmd.open(datadir + "/blocks", 'c')
+        self.blockData = AppendOnlyFile(datadir + "/blocks.dat")
         self.currentBlock = 0
-        self.headers_map = dict()
+        # hash -> HeaderEntry, for every block or header we know about
+        self.index = dict()
+        # parent hash -> entries whose parent we don't know yet
+        self.orphans = dict()
 
     def close(self):
-        self.blockDB.close()
+        self.blockData.close()
 
     def erase(self, blockhash):
-        del self.blockDB[repr(blockhash)]
+        # Forget the block data, but keep its header in the chain index
+        entry = self.index.get(blockhash)
+        if entry is None or entry.location is None:
+            raise KeyError(repr(blockhash))
+        entry.location = None
 
     # lookup an entry and return the item as raw bytes
     def get(self, blockhash):
-        value = None
-        try:
-            value = self.blockDB[repr(blockhash)]
-        except KeyError:
+        entry = self.index.get(blockhash)
+        if entry is None or entry.location is None:
             return None
-        return value
+        return self.blockData.read(entry.location)
 
     # lookup an entry and return it as a CBlock
     def get_block(self, blockhash):
@@ -50,50 +143,76 @@ class BlockStore():
         return ret
 
     def get_header(self, blockhash):
-        try:
-            return self.headers_map[blockhash]
-        except KeyError:
+        entry = self.index.get(blockhash)
+        if entry is None:
             return None
+        return entry.header
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        entry = self.index.get(current_tip)
+        if entry is None:
             return None
 
         response = msg_headers()
-        headersList = [ current_block_header ]
         maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
-                break
+        # Walk back from the tip to the first block in the locator, then
+        # return the headers from there (inclusive) in chain order.
+        have = set(locator.vHave)
+        headersList = [entry.header]
+        while entry.prev is not None and entry.header.sha256 not in have:
+            entry = entry.prev
+            headersList.append(entry.header)
+        headersList.reverse()
         headersList = headersList[:maxheaders] # truncate if we have too many
-        hashList = [x.sha256 for x in headersList]
         index = len(headersList)
-        if (hash_stop in hashList):
-            index = hashList.index(hash_stop)+1
+        for i, header in enumerate(headersList):
+            if header.sha256 == hash_stop:
+                index = i + 1
+                break
         response.headers = headersList[:index]
         return response
 
+    def _add_entry(self, header):
+        """Return the index entry for a header, creating and linking it if needed."""
+        entry = self.index.get(header.sha256)
+        if entry is not None:
+            entry.header = header
+            return entry
+        entry = HeaderEntry(header)
+        self.index[header.sha256] = entry
+        prev = self.index.get(header.hashPrevBlock)
+        if prev is not None:
+            entry.link(prev)
+            prev.children.append(entry)
+        else:
+            entry.link(None)
+            self.orphans.setdefault(header.hashPrevBlock, []).append(entry)
+        # This may be the missing parent of earlier blocks: re-root them and
+        # everything built on them onto this entry.
+        todo = self.orphans.pop(header.sha256, [])
+        entry.children.extend(todo)
+        todo = [(child, entry) for child in todo]
+        while todo:
+            child, parent = todo.pop()
+            child.link(parent)
+            todo.extend((grandchild, child) for grandchild in child.children)
+        return entry
+
     def add_block(self, block):
         block.calc_sha256()
         try:
-            self.blockDB[repr(block.sha256)] = bytes(block.serialize())
+            location = self.blockData.append(bytes(block.serialize()))
         except TypeError as e:
             logger.exception("Unexpected error")
+            return
+        entry = self._add_entry(CBlockHeader(block))
+        entry.location = location
         self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        self._add_entry(header)
 
     # lookup the hashes in "inv", and return p2p messages for delivering
     # blocks found.
@@ -113,13 +232,10 @@ class BlockStore():
         r = []
         counter = 0
         step = 1
-        lastBlock = self.get_block(current_tip)
-        while lastBlock is not None:
-            r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get_block(lastBlock.hashPrevBlock)
-                if lastBlock is None:
-                    break
+        entry = self.index.get(current_tip)
+        while entry is not None:
+            r.append(entry.header.hashPrevBlock)
+            entry = entry.get_ancestor(entry.height - step)
             counter += 1
             if counter > 10:
                 step *= 2
@@ -129,24 +245,23 @@ class BlockStore():
 
 class TxStore():
     def __init__(self, datadir):
-        self.txDB = dbmd.open(datadir + "/transactions", 'c')
+        self.txData = AppendOnlyFile(datadir + "/transactions.dat")
+        self.index = dict()
 
     def close(self):
-        self.txDB.close()
+        self.txData.close()
 
     # lookup an entry and return the item as raw bytes
     def get(self, txhash):
-        value = None
-        try:
-            value = self.txDB[repr(txhash)]
-        except KeyError:
+        location = self.index.get(txhash)
+        if location is None:
             return None
-        return value
+        return self.txData.read(location)
 
     def add_transaction(self, tx):
         tx.calc_sha256()
         try:
-            self.txDB[repr(tx.sha256)] = bytes(tx.serialize())
+            self.index[tx.sha256] = self.txData.append(bytes(tx.serialize()))
         except TypeError as e:
             logger.exception("Unexpected error")
 
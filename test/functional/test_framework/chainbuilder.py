@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Fabricate long regtest chains without mining on the node.
+
+generate(n) makes the node assemble, mine and add every block to its wallet.
+ChainBuilder builds the blocks locally instead, on top of a node's tip, with
+coinbases paying to a fixed key, and feeds them to the node either as
+batched submitblock calls or as block messages over a P2P connection:
+
+    builder = ChainBuilder.from_node(node)
+    stats = builder.submit_rpc(node, 10000)
+    self.log.info("%.0f blocks/s" % stats["blocks_per_second"])
+
+Block building overlaps with the node's validation: RPC batches are sent
+from a separate thread while the next batch is built, and P2P blocks are
+only synced with a ping every batch.
+
+At regtest difficulty a block needs two scrypt hashes on average, so solving
+is not worth parallelizing; building and serializing the blocks is what costs.
+
+Block times start one second after the tip and increase by one second per
+block. Nodes reject blocks more than two hours ahead of their (mock)time, so
+long chains should be built on a tip that is old enough, like the regtest
+genesis block."""
+
+import hashlib
+import queue
+import threading
+import time
+
+from .blocktools import (
+    add_witness_commitment,
+    create_block,
+    create_coinbase,
+)
+from .key import CECKey
+from .messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    bytes_to_hex_str,
+    msg_block,
+    msg_witness_block,
+)
+from .script import CScript, OP_TRUE, SIGHASH_ALL, SignatureHash
+from .util import get_rpc_proxy
+
+# Signal BIP9 (top bits 001) without setting any deployment bit
+BLOCK_VERSION = 0x20000000
+
+COINBASE_MATURITY = 100
+
+# Coinbases of fabricated chains pay to this key, so that the same chain is
+# built on every run.
+CHAIN_BUILDER_SECRET = hashlib.sha256(b"chainbuilder").digest()
+
+def chain_builder_key():
+    key = CECKey()
+    key.set_secretbytes(CHAIN_BUILDER_SECRET)
+    key.set_compressed(True)
+    return key
+
+class ChainBuilder():
+    """Build and submit blocks on top of a given tip.
+
+    payload: optional function called with the builder and the height of the
+        next block, returning the transactions to include in it besides the
+        coinbase. spend_coinbase() creates transactions spending the builder's
+        matured coinbases."""
+
+    def __init__(self, tip_hash, tip_height, tip_time, key=None, payload=None):
+        self.tip = tip_hash
+        self.height = tip_height
+        self.next_time = tip_time + 1
+        self.key = key if key is not None else chain_builder_key()
+        self.pubkey = self.key.get_pubkey()
+        self.payload = payload
+        # (height, coinbase transaction) of unspent coinbases, oldest first
+        self.coinbases = []
+
+    @classmethod
+    def from_node(cls, node, **kwargs):
+        tip = node.getbestblockhash()
+        header = node.getblockheader(tip)
+        return cls(int(tip, 16), header['height'], header['time'], **kwargs)
+
+    def spend_coinbase(self, outputs=None, fee=1000):
+        """Return a transaction spending the oldest matured coinbase of this chain, or None.
+
+        outputs is a list of CTxOuts, by default a single anyone-can-spend output."""
+        if not self.coinbases or self.coinbases[0][0] > self.height + 1 - COINBASE_MATURITY:
+            return None
+        _, coinbase = self.coinbases.pop(0)
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(coinbase.sha256, 0), b"", 0xffffffff))
+        if outputs is None:
+            outputs = [CTxOut(coinbase.vout[0].nValue - fee, CScript([OP_TRUE]))]
+        tx.vout = outputs
+        sighash, _ = SignatureHash(coinbase.vout[0].scriptPubKey, tx, 0, SIGHASH_ALL)
+        tx.vin[0].scriptSig = CScript([self.key.sign(sighash) + bytes([SIGHASH_ALL])])
+        tx.rehash()
+        return tx
+
+    def next_block(self, txs=None):
+        """Build and solve the block on top of the current tip, and make it the tip."""
+        height = self.height + 1
+        if txs is None:
+            txs = self.payload(self, height) if self.payload is not None else []
+        coinbase = create_coinbase(height, self.pubkey)
+        block = create_block(self.tip, coinbase, self.next_time)
+        block.nVersion = BLOCK_VERSION
+        if txs:
+            block.vtx.extend(txs)
+            if any(not tx.wit.is_null() for tx in txs):
+                add_witness_commitment(block)
+            else:
+                block.hashMerkleRoot = block.calc_merkle_root()
+        block.solve()
+        if coinbase.vout[0].nValue > 0:
+            self.coinbases.append((height, coinbase))
+        self.tip = block.sha256
+        self.height = height
+        self.next_time += 1
+        return block
+
+    def build(self, n):
+        """Yield n new blocks."""
+        for _ in range(n):
+            yield self.next_block()
+
+    def submit_rpc(self, node, n, batch_size=100, queue_depth=4):
+        """Build n blocks and submit them with batched submitblock calls. Returns timing stats."""
+        # A connection of its own, used from the submitter thread
+        rpc = get_rpc_proxy(node.url, node.index, timeout=600, coveragedir=node.coverage_dir)
+        batches = queue.Queue(maxsize=queue_depth)
+        errors = []
+        submit_time = [0.0]
+
+        def submitter():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if errors:
+                    # Keep draining the queue so the builder doesn't block
+                    continue
+                start = time.time()
+                try:
+                    responses = rpc.batch([rpc.submitblock.get_request(block_hex) for block_hex in batch])
+                except Exception as e:
+                    errors.append(repr(e))
+                    continue
+                submit_time[0] += time.time() - start
+                for response in responses:
+                    # submitblock returns null on success and a reason otherwise
+                    if response['error'] is not None or response['result'] is not None:
+                        errors.append(response['error'] or response['result'])
+
+        thread = threading.Thread(target=submitter, name="ChainBuilder-submitblock")
+        start = time.time()
+        build_time = 0.0
+        thread.start()
+        try:
+            batch = []
+            for _ in range(n):
+                build_start = time.time()
+                block = self.next_block()
+                batch.append(bytes_to_hex_str(block.serialize(with_witness=True)))
+                build_time += time.time() - build_start
+                if len(batch) == batch_size:
+                    batches.put(batch)
+                    batch = []
+                if errors:
+                    break
+            if batch:
+                batches.put(batch)
+        finally:
+            batches.put(None)
+            thread.join()
+        assert not errors, "submitblock failed: %s" % errors[:10]
+        return self._stats(n, time.time() - start, build_time, submit_time[0])
+
+    def submit_p2p(self, p2p, n, batch_size=100):
+        """Build n blocks and send them over a P2P connection, syncing with a ping every batch_size blocks. Returns timing stats."""
+        start = time.time()
+        build_time = 0.0
+        for i in range(n):
+            build_start = time.time()
+            block = self.next_block()
+            witness = any(not tx.wit.is_null() for tx in block.vtx)
+            build_time += time.time() - build_start
+            p2p.send_message(msg_witness_block(block) if witness else msg_block(block))
+            if (i + 1) % batch_size == 0:
+                p2p.sync_with_ping(timeout=600)
+        p2p.sync_with_ping(timeout=600)
+        elapsed = time.time() - start
+        return self._stats(n, elapsed, build_time, elapsed - build_time)
+
+    def _stats(self, n, elapsed, build_time, submit_time):
+        return {
+            "blocks": n,
+            "height": self.height,
+            "elapsed": elapsed,
+            "build_seconds": build_time,
+            "submit_seconds": submit_time,
+            "blocks_per_second": n / elapsed if elapsed else 0,
+        }
@@ -22,11 +22,15 @@ from .blockstore import BlockStore, TxStore
 from .util import p2p_port, wait_until
 
 import logging
+import time
 
 logger=logging.getLogger("TestFramework.comptool")
 
 global mininode_lock
 
+# Max number of headers a node accepts in one headers message
+MAX_HEADERS_RESULTS = 2000
+
 class RejectResult():
     """Outcome that expects rejection of a transaction or block."""
     def __init__(self, code, reason=b''):
@@ -151,6 +155,24 @@ class TestNode(P2PInterface):
 #    on the final tx is None, then contents of entire mempool are compared
 #    across all connections.  (If outcome of final tx is specified as true
 #    or false, then only the last tx is tested against outcome.)
+#
+# Pipelining:
+#
+# With a pipeline window W > 0, blocks that are expected to be accepted and
+# that each extend the previous one, starting from the tip the nodes are
+# known to have, are not synced one at a time. Up to W of them (across
+# consecutive TestInstances) are announced with headers, the nodes fetch them
+# from the block store, and the connections are only synced once at the end
+# of the window. Each of those blocks must become the tip in turn, so the
+# verdicts are the same as in the synchronous mode, and a failure is still
+# reported against the test that yielded the failing block. Anything else
+# (other outcomes, headers, transactions) flushes the window first and is run
+# synchronously. Test generators that query node state between yields must
+# call TestManager.sync_pipeline() before doing so.
+#
+# Pipelining is opt-in: the window is taken from the test's pipeline_window
+# option, which only tests that sync the pipeline where needed define (see
+# feature_block.py --pipelinewindow).
 
 class TestInstance():
     def __init__(self, objects=None, sync_every_block=True, sync_every_tx=False):
@@ -160,12 +182,21 @@ class TestInstance():
 
 class TestManager():
 
-    def __init__(self, testgen, datadir):
+    def __init__(self, testgen, datadir, pipeline_window=None):
         self.test_generator = testgen
         self.p2p_connections= []
         self.block_store    = BlockStore(datadir)
         self.tx_store       = TxStore(datadir)
         self.ping_counter   = 1
+        if pipeline_window is None:
+            pipeline_window = getattr(getattr(testgen, "options", None), "pipeline_window", 0)
+        # Max number of blocks in a pipeline window, or 0 to sync every block
+        self.pipeline_window = min(pipeline_window, MAX_HEADERS_RESULTS)
+        # [(block, test_number)] announced but not yet synced
+        self.pipeline = []
+        # Tip that all nodes agreed on at the last sync, if any
+        self.pipeline_tip = None
+        self.blocks_delivered = 0
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
@@ -211,6 +242,62 @@ class TestManager():
         self.wait_for_pings(self.ping_counter)
         self.ping_counter += 1
 
+    # Pipeline mode: see the description above TestInstance
+    def can_pipeline(self, test_instance, block, outcome, tip):
+        if not self.pipeline_window or not test_instance.sync_every_block:
+            return False
+        if outcome is not True or tip != block.sha256:
+            return False
+        if self.block_store.get(block.sha256) is not None:
+            return False
+        with mininode_lock:
+            # A node is already waiting for this block: deliver it synchronously
+            if any(c.block_request_map.get(block.sha256) for c in self.p2p_connections):
+                return False
+        parent = self.pipeline[-1][0].sha256 if self.pipeline else self.pipeline_tip
+        return parent is not None and block.hashPrevBlock == parent
+
+    def pipeline_block(self, block, test_number):
+        with mininode_lock:
+            self.block_store.add_block(block)
+            for c in self.p2p_connections:
+                c.block_request_map[block.sha256] = False
+        self.pipeline.append((block, test_number))
+        if len(self.pipeline) >= self.pipeline_window:
+            self.sync_pipeline()
+
+    def sync_pipeline(self):
+        """Deliver all pipelined blocks and check that the last one is every node's tip."""
+        if not self.pipeline:
+            return
+        window, self.pipeline = self.pipeline, []
+        headers = msg_headers()
+        headers.headers = [CBlockHeader(block) for block, _ in window]
+        [ c.send_message(headers) for c in self.p2p_connections ]
+        def blocks_requested():
+            return all(node.block_request_map.get(block.sha256)
+                       for node in self.p2p_connections for block, _ in window)
+        wait_until(blocks_requested, attempts=160*len(window), lock=mininode_lock)
+        last_block = window[-1][0]
+        self.sync_blocks(last_block.sha256, 1)
+        if not self.check_results(last_block.sha256, True):
+            # Find the first block that didn't become the tip on some node
+            hashes = [block.sha256 for block, _ in window]
+            with mininode_lock:
+                tips = [c.bestblockhash for c in self.p2p_connections]
+            tips += [int(node.getbestblockhash(), 16) for node in getattr(self.test_generator, "nodes", [])]
+            first_failed = min(hashes.index(tip) + 1 if tip in hashes else 0 for tip in tips)
+            # Every node reached the last block, but the results still didn't match
+            first_failed = min(first_failed, len(window) - 1)
+            self.pipeline_tip = None
+            raise AssertionError("Test failed at test %d" % window[first_failed][1])
+        self.pipeline_tip = last_block.sha256
+
+    def update_pipeline_tip(self):
+        with mininode_lock:
+            tips = set(c.bestblockhash for c in self.p2p_connections)
+        self.pipeline_tip = tips.pop() if len(tips) == 1 else None
+
     # Analogous to sync_block (see above)
     def sync_transaction(self, txhash, num_events):
         # Wait for nodes to request transaction (50ms sleep * 20 tries * num_events)
@@ -286,6 +373,7 @@ class TestManager():
         # Wait until verack is received
         self.wait_for_verack()
 
+        start_time = time.time()
         test_number = 0
         tests = self.test_generator.get_tests()
         for test_instance in tests:
@@ -311,6 +399,11 @@ class TestManager():
                     # (default is to use the block being tested)
                     if len(test_obj) >= 3:
                         tip = test_obj[2]
+                    self.blocks_delivered += 1
+                    if self.can_pipeline(test_instance, block, outcome, tip):
+                        self.pipeline_block(block, test_number)
+                        continue
+                    self.sync_pipeline()
 
                     # Add to shared block_store, set as current block
                     # If there was an open getdata request for the block
@@ -346,10 +439,12 @@ class TestManager():
                             self.ping_counter += 1
                         if (not self.check_results(tip, outcome)):
                             raise AssertionError("Test failed at test %d" % test_number)
+                        self.update_pipeline_tip()
                     else:
                         invqueue.append(CInv(2, block.sha256))
                 elif isinstance(b_or_t, CBlockHeader):
                     block_header = b_or_t
+                    self.sync_pipeline()
                     self.block_store.add_header(block_header)
                     [ c.send_header(block_header) for c in self.p2p_connections ]
 
@@ -357,6 +452,7 @@ class TestManager():
                     assert(isinstance(b_or_t, CTransaction))
                     tx = b_or_t
                     tx_outcome = outcome
+                    self.sync_pipeline()
                     # Add to shared tx store and clear map entry
                     with mininode_lock:
                         self.tx_store.add_transaction(tx)
@@ -383,6 +479,7 @@ class TestManager():
                 self.sync_blocks(block.sha256, len(test_instance.blocks_and_transactions))
                 if (not self.check_results(tip, block_outcome)):
                     raise AssertionError("Block test failed at test %d" % test_number)
+                self.update_pipeline_tip()
             if (not test_instance.sync_every_tx and tx is not None):
                 if len(invqueue) > 0:
                     [ c.send_message(msg_inv(invqueue)) for c in self.p2p_connections ]
@@ -391,6 +488,11 @@ class TestManager():
                 if (not self.check_mempool(tx.sha256, tx_outcome)):
                     raise AssertionError("Mempool test failed at test %d" % test_number)
 
+        self.sync_pipeline()
+        elapsed = time.time() - start_time
+        logger.info("Delivered %d blocks in %.1f s (%.1f blocks/s)" %
+                    (self.blocks_delivered, elapsed, self.blocks_delivered / max(elapsed, 1e-6)))
+
         [ c.disconnect_node() for c in self.p2p_connections ]
         self.wait_for_disconnections()
         self.block_store.close()
@@ -6,13 +6,24 @@
 
 Provides a way to track which RPC commands are exercised during
 testing.
+
+Calls are counted in memory and written by flush(), at the end of the test
+or when the process exits, as one "command count" line per command to a
+file per test process and node.
 """
 
+import atexit
+from collections import Counter
 import os
 
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
 
+# Counts of RPC calls by coverage file
+_call_counts = {}
+# Coverage files whose counts changed since the last flush()
+_dirty = set()
+
 
 class AuthServiceProxyWrapper():
     """
@@ -24,8 +35,8 @@ class AuthServiceProxyWrapper():
         Kwargs:
             auth_service_proxy_instance (AuthServiceProxy): the instance
                 being wrapped.
-            coverage_logfile (str): if specified, write each service_name
-                out to a file when called.
+            coverage_logfile (str): if specified, count the calls of each
+                service_name and write the counts to this file on flush().
 
         """
         self.auth_service_proxy_instance = auth_service_proxy_instance
@@ -40,8 +51,8 @@ class AuthServiceProxyWrapper():
 
     def __call__(self, *args, **kwargs):
         """
-        Delegates to AuthServiceProxy, then writes the particular RPC method
-        called to a file.
+        Delegates to AuthServiceProxy, then counts the particular RPC method
+        called.
 
         """
         return_val = self.auth_service_proxy_instance.__call__(*args, **kwargs)
@@ -52,8 +63,8 @@ class AuthServiceProxyWrapper():
         rpc_method = self.auth_service_proxy_instance._service_name
 
         if self.coverage_logfile:
-            with open(self.coverage_logfile, 'a+', encoding='utf8') as f:
-                f.write("%s\n" % rpc_method)
+            _call_counts.setdefault(self.coverage_logfile, Counter())[rpc_method] += 1
+            _dirty.add(self.coverage_logfile)
 
     def __truediv__(self, relative_uri):
         return AuthServiceProxyWrapper(self.auth_service_proxy_instance / relative_uri,
@@ -63,11 +74,31 @@ class AuthServiceProxyWrapper():
         self._log_call()
         return self.auth_service_proxy_instance.get_request(*args, **kwargs)
 
+def flush():
+    """Write the call counts of the coverage files that changed since the last flush."""
+    for filename in sorted(_dirty):
+        with open(filename, 'w', encoding='utf8') as f:
+            f.writelines("%s %d\n" % item for item in sorted(_call_counts[filename].items()))
+    _dirty.clear()
+
+# Don't lose the counts of tests that crash or exit early
+atexit.register(flush)
+
+def read_counts(filename):
+    """Return a Counter of the RPC calls in a coverage file."""
+    counts = Counter()
+    with open(filename, 'r', encoding='utf8') as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                counts[fields[0]] += int(fields[1]) if len(fields) > 1 else 1
+    return counts
+
 def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
 
-    This file will contain a list of RPC commands covered.
+    This file will contain the counts of the RPC commands covered.
     """
     pid = str(os.getpid())
     return os.path.join(
@@ -12,77 +12,85 @@ import ctypes.util
 import hashlib
 import sys
 
-ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
+# this specifies the curve used with ECDSA.
+NID_secp256k1 = 714 # from openssl/obj_mac.h
 
-ssl.BN_new.restype = ctypes.c_void_p
-ssl.BN_new.argtypes = []
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
-ssl.BN_bin2bn.restype = ctypes.c_void_p
-ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+# Thx to Sam Devlin for the ctypes magic 64-bit fix.
+def _check_result(val, func, args):
+    if val == 0:
+        raise ValueError
+    else:
+        return ctypes.c_void_p (val)
 
-ssl.BN_CTX_free.restype = None
-ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
+# OpenSSL, loaded by the first CECKey. Scripts that import this module
+# (e.g. through blocktools.py) but never use keys don't load it.
+ssl = None
 
-ssl.BN_CTX_new.restype = ctypes.c_void_p
-ssl.BN_CTX_new.argtypes = []
+def _load_ssl():
+    global ssl
+    if ssl is not None:
+        return
+    lib = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
 
-ssl.ECDH_compute_key.restype = ctypes.c_int
-ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+    lib.BN_new.restype = ctypes.c_void_p
+    lib.BN_new.argtypes = []
 
-ssl.ECDSA_sign.restype = ctypes.c_int
-ssl.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    lib.BN_bin2bn.restype = ctypes.c_void_p
+    lib.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.ECDSA_verify.restype = ctypes.c_int
-ssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+    lib.BN_CTX_free.restype = None
+    lib.BN_CTX_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_free.restype = None
-ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
+    lib.BN_CTX_new.restype = ctypes.c_void_p
+    lib.BN_CTX_new.argtypes = []
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
+    lib.ECDH_compute_key.restype = ctypes.c_int
+    lib.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
+    lib.ECDSA_sign.restype = ctypes.c_int
+    lib.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
+    lib.ECDSA_verify.restype = ctypes.c_int
+    lib.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.EC_KEY_set_private_key.restype = ctypes.c_int
-ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_free.restype = None
+    lib.EC_KEY_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_set_conv_form.restype = None
-ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
+    lib.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
 
-ssl.EC_KEY_set_public_key.restype = ctypes.c_int
-ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_get0_group.restype = ctypes.c_void_p
+    lib.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
 
-ssl.i2o_ECPublicKey.restype = ctypes.c_void_p
-ssl.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_get0_public_key.restype = ctypes.c_void_p
+    lib.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
 
-ssl.EC_POINT_new.restype = ctypes.c_void_p
-ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+    lib.EC_KEY_set_private_key.restype = ctypes.c_int
+    lib.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_POINT_free.restype = None
-ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+    lib.EC_KEY_set_conv_form.restype = None
+    lib.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
 
-ssl.EC_POINT_mul.restype = ctypes.c_int
-ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    lib.EC_KEY_set_public_key.restype = ctypes.c_int
+    lib.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-# this specifies the curve used with ECDSA.
-NID_secp256k1 = 714 # from openssl/obj_mac.h
+    lib.i2o_ECPublicKey.restype = ctypes.c_void_p
+    lib.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
-SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+    lib.EC_POINT_new.restype = ctypes.c_void_p
+    lib.EC_POINT_new.argtypes = [ctypes.c_void_p]
 
-# Thx to Sam Devlin for the ctypes magic 64-bit fix.
-def _check_result(val, func, args):
-    if val == 0:
-        raise ValueError
-    else:
-        return ctypes.c_void_p (val)
+    lib.EC_POINT_free.restype = None
+    lib.EC_POINT_free.argtypes = [ctypes.c_void_p]
+
+    lib.EC_POINT_mul.restype = ctypes.c_int
+    lib.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
+    lib.EC_KEY_new_by_curve_name.errcheck = _check_result
+    ssl = lib
 
 class CECKey():
     """Wrapper around OpenSSL's EC_KEY"""
@@ -91,6 +99,7 @@ class CECKey():
     POINT_CONVERSION_UNCOMPRESSED = 4
 
     def __init__(self):
+        _load_ssl()
         self.k = ssl.EC_KEY_new_by_curve_name(NID_secp256k1)
 
     def __del__(self):
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Incrementally parse a node's debug.log and tradelayer.log.
+
+A LogTailer thread reads the lines the node appended to its log files since
+the last read, parses their timestamps and turns them into LogEvents, which
+are kept in memory and indexed by source, category and (for Tradelayer
+events) kind. Waiting for a log line then only looks at events that arrived
+since the wait started, instead of re-reading the log files:
+
+    mark = node.log_mark()
+    node.tl_sendissuancefixed(...)
+    node.generate(1)
+    node.wait_for_log(r"rejected: .*insufficient balance", since=mark, kind="rejected")
+
+litecoind doesn't log the category of debug.log lines, so it is derived from
+the message (see DEBUG_CATEGORIES). Events are numbered in the order they were
+read; log_mark() returns the number of the next one.
+
+tradelayer.log timestamps only have whole seconds, and follow mocktime. The
+time of a Tradelayer event is therefore not comparable with debug.log times,
+and a since= given as a time only locates the position among debug.log
+events: Tradelayer events are taken from that position on. Use marks to
+select Tradelayer events reliably."""
+
+from collections import namedtuple
+import calendar
+import os
+import re
+import threading
+import time
+
+# How often the tailer thread checks the log files for new lines
+TAIL_POLL_INTERVAL = 0.05
+
+# "2018-05-01T12:34:56.123456Z (mocktime: 2018-05-01T12:00:00Z) message",
+# or "2018-05-01 12:34:56 message" from older Tradelayer builds
+TIMESTAMP_RE = re.compile(r"(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(\.\d+)?Z? (?:\(mocktime: [^)]*\) )?")
+
+# First match wins. Lines that don't match any pattern are in the "other" category.
+DEBUG_CATEGORIES = [
+    ("init", re.compile(r"^init message: |^Bound to |^Loaded \d+ blocks|^Shutdown: ")),
+    ("validation", re.compile(r"^(UpdateTip|InvalidChainFound|ConnectBlock|ActivateBestChain|CheckBlock|ERROR: ConnectTip|Leaving InvalidChainFound)")),
+    ("bench", re.compile(r"^\s+- ")),
+    ("mempool", re.compile(r"AcceptToMemoryPool|mempool|replacing tx ")),
+    ("rpc", re.compile(r"^ThreadRPCServer|^Received a POST request")),
+    ("net", re.compile(r"peer=\d+")),
+    ("wallet", re.compile(r"^(AddToWallet|CommitTransaction|keypool|Relaying wtx)")),
+]
+
+# Kinds of Tradelayer events, first match wins
+TRADELAYER_EVENTS = [
+    ("rejected", re.compile(r"^(\w+)\(\): rejected: ")),
+    ("error", re.compile(r"^(\w+)\(.*\).*\bERROR\b|^(\w+) error\b|^TRADEDB error")),
+    ("settlement", re.compile(r"Calling the Settlement Algorithm|Matrix for Settlement")),
+    ("shutdown", re.compile(r"Trade Layer shutdown completed")),
+    ("message", re.compile(r"^(\w+)\(\): ")),
+]
+
+# time: seconds since the epoch, from the log timestamp
+# source: "debug" or "tradelayer"
+# kind, function: for Tradelayer events, the event kind and the function that logged it
+LogEvent = namedtuple("LogEvent", ["seq", "time", "source", "category", "kind", "function", "message"])
+
+def classify_debug(message):
+    for category, regex in DEBUG_CATEGORIES:
+        if regex.search(message):
+            return category
+    return "other"
+
+def classify_tradelayer(message):
+    for kind, regex in TRADELAYER_EVENTS:
+        match = regex.search(message)
+        if match:
+            function = next((g for g in match.groups() if g), None)
+            return kind, function
+    return "message", None
+
+class LogFile():
+    """Incremental reader of a log file that may be truncated or replaced."""
+
+    def __init__(self, source, path, position=None):
+        self.source = source
+        self.path = path
+        # Start reading at a file_position(), or at the start of the file
+        self.inode, self.offset = position or (None, 0)
+        self.partial = b""
+        self.last_time = None
+
+    def read_lines(self):
+        """Return the complete lines appended since the last call."""
+        try:
+            with open(self.path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_ino != self.inode or st.st_size < self.offset:
+                    # New or rotated (ShrinkDebugFile, logrotate) file
+                    self.inode = st.st_ino
+                    self.offset = 0
+                    self.partial = b""
+                if st.st_size == self.offset:
+                    return []
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return []
+        self.offset += len(data)
+        data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        return data[:end].decode('utf8', 'replace').splitlines()
+
+def file_position(path):
+    """Return the (inode, size) of a file, to start a LogFile at its current end."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size
+
+class LogTailer():
+    """Tail a node's log files into an in-memory, indexed list of LogEvents.
+
+    A thread polls the files between start() and stop(). The events are kept
+    when it is stopped, and it is started again when the node restarts."""
+
+    def __init__(self, files, name="LogTailer", positions=None):
+        self.name = name
+        self.thread = None
+        positions = positions or {}
+        self.files = [LogFile(source, path, positions.get(source)) for source, path in files.items()]
+        self.events = []
+        # ("source" | "category" | "kind", value) -> events, in order
+        self.index = {}
+        self.cond = threading.Condition()
+        self.read_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self._epoch_cache = {}
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(TAIL_POLL_INTERVAL):
+            self.sync()
+
+    def stop(self):
+        """Stop polling, after reading what was logged so far."""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.sync()
+
+    def _epoch(self, date, clock):
+        key = date + clock
+        if key not in self._epoch_cache:
+            if len(self._epoch_cache) > 10000:
+                self._epoch_cache.clear()
+            self._epoch_cache[key] = calendar.timegm(time.strptime(key, "%Y-%m-%d%H:%M:%S"))
+        return self._epoch_cache[key]
+
+    def _parse(self, log, line):
+        match = TIMESTAMP_RE.match(line)
+        if match:
+            timestamp = self._epoch(match.group(1), match.group(2)) + float(match.group(3) or 0)
+            log.last_time = timestamp
+            message = line[match.end():]
+        else:
+            # Continuation of a multi-line message, or -nologtimestamps
+            timestamp = log.last_time if log.last_time is not None else time.time()
+            message = line
+        if log.source == "tradelayer":
+            kind, function = classify_tradelayer(message)
+            category = "tradelayer"
+        else:
+            kind = function = None
+            category = classify_debug(message)
+        return timestamp, category, kind, function, message
+
+    def sync(self):
+        """Read and index what was appended to the log files since the last read."""
+        with self.read_lock:
+            new_events = []
+            for log in self.files:
+                for line in log.read_lines():
+                    new_events.append((log.source,) + self._parse(log, line))
+            if not new_events:
+                return
+            with self.cond:
+                for source, timestamp, category, kind, function, message in new_events:
+                    event = LogEvent(len(self.events), timestamp, source, category, kind, function, message)
+                    self.events.append(event)
+                    for key in [("source", source), ("category", category), ("kind", kind)]:
+                        if key[1] is not None:
+                            self.index.setdefault(key, []).append(event)
+                self.cond.notify_all()
+
+    def _candidates(self, source, category, kind):
+        """Return the most specific (live) event list for these filters."""
+        for key in [("kind", kind), ("category", category), ("source", source)]:
+            if key[1] is not None:
+                return self.index.setdefault(key, [])
+        return self.events
+
+    @staticmethod
+    def _start(events, since):
+        """Return the position in events of the first one at or after since (a mark or a time).
+
+        A time is only compared with the times of debug.log events (see the
+        module docstring)."""
+        if since is None:
+            return 0
+        pos = len(events)
+        if isinstance(since, float):
+            while pos > 0 and (events[pos - 1].source == "tradelayer" or events[pos - 1].time >= since):
+                pos -= 1
+        else:
+            while pos > 0 and events[pos - 1].seq >= since:
+                pos -= 1
+        return pos
+
+    def mark(self):
+        self.sync()
+        with self.cond:
+            return len(self.events)
+
+    def select(self, since=None, source=None, category=None, kind=None, pattern=None):
+        """Return the events matching all the given filters."""
+        self.sync()
+        regex = re.compile(pattern) if pattern is not None else None
+        with self.cond:
+            events = self._candidates(source, category, kind)
+            return [e for e in events[self._start(events, since):]
+                    if (source is None or e.source == source) and
+                       (category is None or e.category == category) and
+                       (kind is None or e.kind == kind) and
+                       (regex is None or regex.search(e.message))]
+
+    def wait_for(self, pattern, timeout, since=None, source=None, category=None, kind=None):
+        """Wait for an event whose message matches pattern and return it."""
+        regex = re.compile(pattern)
+        deadline = time.time() + timeout
+        self.sync()
+        with self.cond:
+            events = self._candidates(source, category, kind)
+            pos = self._start(events, since)
+            while True:
+                while pos < len(events):
+                    e = events[pos]
+                    pos += 1
+                    if (source is None or e.source == source) and (category is None or e.category == category) and \
+                       (kind is None or e.kind == kind) and regex.search(e.message):
+                        return e
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AssertionError("No log line matching '%s' within %s seconds" % (pattern, timeout))
+                self.cond.wait(remaining)
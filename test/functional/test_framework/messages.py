@@ -23,7 +23,6 @@ import socket
 import struct
 import time
 
-import litecoin_scrypt
 from test_framework.siphash import siphash256
 from test_framework.util import hex_str_to_bytes, bytes_to_hex_str
 
@@ -55,6 +54,12 @@ def ripemd160(s):
 def hash256(s):
     return sha256(sha256(s))
 
+def scrypt_pow_hash(s):
+    # litecoin_scrypt is a compiled extension that only scripts working with
+    # blocks need, so it is imported on first use
+    import litecoin_scrypt
+    return litecoin_scrypt.getPoWHash(s)
+
 def ser_compact_size(l):
     r = b""
     if l < 253:
@@ -546,7 +551,7 @@ class CBlockHeader():
             r += struct.pack("<I", self.nNonce)
             self.sha256 = uint256_from_str(hash256(r))
             self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
-            self.scrypt256 = uint256_from_str(litecoin_scrypt.getPoWHash(r))
+            self.scrypt256 = uint256_from_str(scrypt_pow_hash(r))
 
     def rehash(self):
         self.sha256 = None
@@ -10,15 +10,22 @@ This python code was modified from ArtForz' public domain  half-a-node, as
 found in the mini-node branch of http://github.com/jgarzik/pynode.
 
 P2PConnection: A low-level connection object to a node's P2P interface
-P2PInterface: A high-level interface object for communicating to a node over P2P"""
+P2PInterface: A high-level interface object for communicating to a node over P2P
+FramedMessage: A P2P message serialized and framed once, to be sent many times
+LazyMessageDict: A dict of messages that are only deserialized when accessed
+P2PCapture: A recorder of the raw messages sent and received by a connection
+P2PReplayer: A P2PInterface that pushes a recorded capture into a node"""
 import asyncore
-from collections import defaultdict
+from collections import defaultdict, deque
 from io import BytesIO
+from itertools import islice
 import logging
+import os
 import socket
 import struct
 import sys
 import threading
+import time
 
 from test_framework.messages import *
 from test_framework.util import wait_until
@@ -49,6 +56,18 @@ MESSAGEMAP = {
     b"version": msg_version,
 }
 
+# Size of the P2P message header: magic, command, length and checksum
+MSG_HEADER_SIZE = 4 + 12 + 4 + 4
+
+# Number of bytes to read from the socket at a time
+RECV_BUFFER_SIZE = 256 * 1024
+
+# Maximum number of buffers to pass to a single sendmsg() call
+try:
+    SEND_MAX_BUFFERS = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    SEND_MAX_BUFFERS = 1024
+
 MAGIC_BYTES = {
     "mainnet": b"\xfb\xc0\xb6\xdb",   # mainnet
     "testnet4": b"\xfd\xd2\xc8\xf1",  # testnet3
@@ -75,13 +94,19 @@ class P2PConnection(asyncore.dispatcher):
 
         super().__init__(map=mininode_socket_map)
 
+        # P2PCapture recording the raw messages on this connection, if any
+        self.capture = None
+
     def peer_connect(self, dstaddr, dstport, net="regtest"):
         self.dstaddr = dstaddr
         self.dstport = dstport
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        self.sendbuf = deque()
+        self.sendbuf_size = 0
+        self.recvbuf = bytearray()
+        self.readbuf = bytearray(RECV_BUFFER_SIZE)
+        self.readview = memoryview(self.readbuf)
         self.state = "connecting"
         self.network = net
         self.disconnect = False
@@ -111,8 +136,9 @@ class P2PConnection(asyncore.dispatcher):
         """asyncore callback when a connection is closed."""
         logger.debug("Closing connection to: %s:%d" % (self.dstaddr, self.dstport))
         self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
+        self.recvbuf = bytearray()
+        self.sendbuf = deque()
+        self.sendbuf_size = 0
         try:
             self.close()
         except:
@@ -129,59 +155,105 @@ class P2PConnection(asyncore.dispatcher):
     # Socket read methods
 
     def handle_read(self):
-        """asyncore callback when data is read from the socket."""
-        t = self.recv(8192)
-        if len(t) > 0:
-            self.recvbuf += t
-            self._on_data()
+        """asyncore callback when data is read from the socket.
+
+        Reads directly into a preallocated buffer and appends to the bytearray
+        receive buffer, so that receiving a large message in many chunks is
+        linear in the message size."""
+        try:
+            n = self.socket.recv_into(self.readbuf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if n == 0:
+            # A closed connection is indicated by signaling a read condition
+            # and having recv_into() return 0.
+            self.handle_close()
+            return
+        self.recvbuf += self.readview[:n]
+        self._on_data()
 
     def _on_data(self):
         """Try to read P2P messages from the recv buffer.
 
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
-        the on_message callback for processing."""
+        the on_message callback for processing.
+
+        Messages are framed in place: headers are parsed from a memoryview
+        of the receive buffer, each payload is copied out exactly once, and the
+        consumed bytes are only dropped from the front of the buffer once all
+        complete messages have been handled."""
+        pos = 0
+        recvbuf = self.recvbuf
         try:
-            while True:
-                if len(self.recvbuf) < 4:
-                    return
-                if self.recvbuf[:4] != MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command not in MESSAGEMAP:
-                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[command]()
-                t.deserialize(f)
-                self._log_message("receive", t)
-                self.on_message(t)
+            with memoryview(recvbuf) as buf:
+                while True:
+                    avail = len(buf) - pos
+                    if avail < 4:
+                        break
+                    if buf[pos:pos+4] != MAGIC_BYTES[self.network]:
+                        raise ValueError("got garbage %s" % repr(bytes(buf[pos:])))
+                    if avail < MSG_HEADER_SIZE:
+                        break
+                    command = bytes(buf[pos+4:pos+4+12]).split(b"\x00", 1)[0]
+                    msglen, = struct.unpack_from("<i", buf, pos+4+12)
+                    checksum = bytes(buf[pos+4+12+4:pos+MSG_HEADER_SIZE])
+                    if avail < MSG_HEADER_SIZE + msglen:
+                        break
+                    msg = bytes(buf[pos+MSG_HEADER_SIZE:pos+MSG_HEADER_SIZE+msglen])
+                    th = sha256(msg)
+                    h = sha256(th)
+                    if checksum != h[:4]:
+                        raise ValueError("got bad checksum " + repr(bytes(buf[pos:])))
+                    if self.capture is not None:
+                        self.capture.record(CAPTURE_RECV, buf[pos:pos+MSG_HEADER_SIZE+msglen])
+                    pos += MSG_HEADER_SIZE + msglen
+                    if command not in MESSAGEMAP:
+                        raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
+                    if self.wants_decoded(command):
+                        t = deserialize_message(command, msg)
+                        self._log_message("receive", t)
+                        self.on_message(t)
+                    else:
+                        self._log_raw_message("receive", command, msg)
+                        self.on_raw_message(command, msg)
         except Exception as e:
             logger.exception('Error reading message:', repr(e))
             raise
+        finally:
+            # Drop everything that has been consumed in one go. The buffer may
+            # have been replaced if the connection was closed in a callback.
+            if pos and self.recvbuf is recvbuf:
+                del recvbuf[:pos]
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
         raise NotImplementedError
 
+    def wants_decoded(self, command):
+        """Return whether messages with this command should be deserialized.
+
+        Messages that are not deserialized are passed to on_raw_message()
+        instead of on_message()."""
+        return True
+
+    def on_raw_message(self, command, payload):
+        """Callback for a P2P payload that was not deserialized. Must be overridden
+        by derived classes that return False from wants_decoded()."""
+        raise NotImplementedError
+
     # Socket write methods
 
     def writable(self):
         """asyncore method to determine whether the handle_write() callback should be called on the next loop."""
         with mininode_lock:
             pre_connection = self.state == "connecting"
-            length = len(self.sendbuf)
+            length = self.sendbuf_size
         return (length > 0 or pre_connection)
 
     def handle_write(self):
@@ -194,46 +266,88 @@ class P2PConnection(asyncore.dispatcher):
                 self.handle_connect()
             if not self.writable():
                 return
+            self._flush_sendbuf()
 
-            try:
-                sent = self.send(self.sendbuf)
-            except:
+    def _flush_sendbuf(self, in_network_thread=True):
+        """Write as much of the send buffer as the socket accepts.
+
+        All queued buffers are handed to the kernel in one sendmsg() call,
+        without joining them first. Must be called with mininode_lock held.
+
+        On a socket error, the connection is only closed from the network
+        thread. Other threads leave the data queued, and handle_write()
+        runs into the error again and closes the connection."""
+        try:
+            sent = self.socket.sendmsg(list(islice(self.sendbuf, SEND_MAX_BUFFERS)))
+        except BlockingIOError:
+            return
+        except OSError:
+            if in_network_thread:
                 self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
+            return
+        self.sendbuf_size -= sent
+        while sent:
+            buf = self.sendbuf[0]
+            if sent < len(buf):
+                self.sendbuf[0] = memoryview(buf)[sent:]
+                break
+            sent -= len(buf)
+            self.sendbuf.popleft()
 
     def send_message(self, message, pushbuf=False):
         """Send a P2P message over the socket.
 
         This method takes a P2P payload, builds the P2P header and adds
-        the message to the send buffer to be sent over the socket."""
+        the message to the send buffer to be sent over the socket. The
+        message may also be a FramedMessage, which is sent without being
+        serialized again."""
+        if self.state != "connected" and not pushbuf:
+            raise IOError('Not connected, no pushbuf')
+        if not isinstance(message, FramedMessage):
+            message = FramedMessage(message)
+        self._log_message("send", message.message)
+        self._send_buffers((message.header(self.network), message.payload), pushbuf)
+
+    def send_raw(self, tmsg, pushbuf=False):
+        """Send an already framed P2P message (or several) over the socket."""
         if self.state != "connected" and not pushbuf:
             raise IOError('Not connected, no pushbuf')
-        self._log_message("send", message)
-        command = message.command
-        data = message.serialize()
-        tmsg = MAGIC_BYTES[self.network]
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
-        th = sha256(data)
-        h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
+        self._send_buffers((tmsg,), pushbuf)
+
+    def _send_buffers(self, buffers, pushbuf):
+        """Queue buffers on the send buffer and try to write them out immediately."""
+        if self.capture is not None:
+            self.capture.record(CAPTURE_SEND, b"".join(buffers))
         with mininode_lock:
-            if (len(self.sendbuf) == 0 and not pushbuf):
-                try:
-                    sent = self.send(tmsg)
-                    self.sendbuf = tmsg[sent:]
-                except BlockingIOError:
-                    self.sendbuf = tmsg
-            else:
-                self.sendbuf += tmsg
+            was_empty = self.sendbuf_size == 0
+            for buf in buffers:
+                if buf:
+                    self.sendbuf.append(buf)
+                    self.sendbuf_size += len(buf)
+            if was_empty and not pushbuf:
+                self._flush_sendbuf(in_network_thread=False)
+
+    # Capture methods
+
+    def start_capture(self, path):
+        """Record all raw messages sent and received on this connection to a file."""
+        assert self.capture is None, "Connection is already being captured"
+        self.capture = P2PCapture(path)
+        return self.capture
+
+    def stop_capture(self):
+        """Stop recording and close the capture file."""
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+        return capture
 
     # Class utility methods
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
@@ -243,6 +357,165 @@ class P2PConnection(asyncore.dispatcher):
             log_message += "... (msg truncated)"
         logger.debug(log_message)
 
+    def _log_raw_message(self, direction, command, payload):
+        """Logs a message that is not deserialized, without formatting its payload."""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s:%d: %s (%d bytes)" % ("Send message to" if direction == "send" else "Received message from",
+                                                      self.dstaddr, self.dstport, command.decode('ascii'), len(payload)))
+
+
+def deserialize_message(command, payload):
+    """Deserialize a P2P payload into the message object for its command."""
+    t = MESSAGEMAP[command]()
+    t.deserialize(BytesIO(payload))
+    return t
+
+class RawMessage():
+    """A received P2P payload that has not been deserialized yet."""
+    __slots__ = ("command", "payload")
+
+    def __init__(self, command, payload):
+        self.command = command
+        self.payload = payload
+
+    def decode(self):
+        return deserialize_message(self.command, self.payload)
+
+class FramedMessage():
+    """A P2P message that is serialized and checksummed once.
+
+    The payload is kept as a single bytes object and the header is built
+    lazily for each network magic, so the same FramedMessage can be sent to
+    many connections, or many times, without being serialized again."""
+    __slots__ = ("message", "command", "payload", "_checksum", "_headers")
+
+    def __init__(self, message):
+        self.message = message
+        self.command = message.command
+        self.payload = message.serialize()
+        self._checksum = sha256(sha256(self.payload))[:4]
+        self._headers = {}
+
+    def header(self, net="regtest"):
+        """Return the message header for a network."""
+        header = self._headers.get(net)
+        if header is None:
+            header = (MAGIC_BYTES[net] + self.command + b"\x00" * (12 - len(self.command)) +
+                      struct.pack("<I", len(self.payload)) + self._checksum)
+            self._headers[net] = header
+        return header
+
+    def serialize(self, net="regtest"):
+        """Return the full wire encoding of the message."""
+        return self.header(net) + self.payload
+
+    def __len__(self):
+        return MSG_HEADER_SIZE + len(self.payload)
+
+    def __repr__(self):
+        return "FramedMessage(%s)" % repr(self.message)
+
+def broadcast_message(message, connections, pushbuf=False):
+    """Send one message to several connections, serializing it only once."""
+    if not isinstance(message, FramedMessage):
+        message = FramedMessage(message)
+    for conn in connections:
+        conn.send_message(message, pushbuf)
+    return message
+
+class LazyMessageDict(dict):
+    """A dict of the most recent message of each type.
+
+    Values may be stored as RawMessage objects. They are deserialized on first
+    access through the usual dict accessors and the decoded message replaces
+    the raw payload.
+
+    The network thread inserts messages while holding mininode_lock, so
+    decoding and iterating take it too."""
+
+    def __getitem__(self, key):
+        with mininode_lock:
+            value = super().__getitem__(key)
+            if isinstance(value, RawMessage):
+                value = value.decode()
+                super().__setitem__(key, value)
+            return value
+
+    def get(self, key, default=None):
+        with mininode_lock:
+            return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        with mininode_lock:
+            value = super().pop(key, *args)
+        return value.decode() if isinstance(value, RawMessage) else value
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        with mininode_lock:
+            return [(key, self[key]) for key, _ in list(super().items())]
+
+
+# P2P capture files start with CAPTURE_MAGIC, followed by one record per
+# message: the direction (CAPTURE_RECV or CAPTURE_SEND), the time at which
+# the message was sent or received, the length of the message and the
+# framed message itself (header and payload) as it was on the wire.
+CAPTURE_MAGIC = b"P2PCAP\x00\x01"
+CAPTURE_RECORD = struct.Struct("<BdI")
+CAPTURE_RECV = 0
+CAPTURE_SEND = 1
+
+class P2PCapture():
+    """Records raw framed P2P messages to a compact binary file.
+
+    Records may be written from both the network thread and the test
+    logic thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.num_messages = 0
+        self.num_bytes = 0
+
+    def record(self, direction, data, timestamp=None):
+        with self.lock:
+            # Taken under the lock, so that the records are in time order
+            if timestamp is None:
+                timestamp = time.time()
+            self.file.write(CAPTURE_RECORD.pack(direction, timestamp, len(data)))
+            self.file.write(data)
+            self.num_messages += 1
+            self.num_bytes += len(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_capture(path):
+    """Generator that yields (direction, timestamp, data) for each message in a capture file."""
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a P2P capture file" % path)
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if not header:
+                return
+            if len(header) < CAPTURE_RECORD.size:
+                raise ValueError("Truncated record in capture file %s" % path)
+            direction, timestamp, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError("Truncated record in capture file %s" % path)
+            yield direction, timestamp, data
+
+def message_command(data):
+    """Return the command of a framed P2P message."""
+    return data[4:4+12].split(b"\x00", 1)[0]
+
 
 class P2PInterface(P2PConnection):
     """A high-level P2P interface class for communicating with a Litecoin node.
@@ -252,14 +525,34 @@ class P2PInterface(P2PConnection):
     node over P2P.
 
     Individual testcases should subclass this and override the on_* methods
-    if they want to alter message handling behaviour."""
+    if they want to alter message handling behaviour.
+
+    By default every received message is deserialized. Tests that only count
+    some message types (eg when flooding a node) can set
+    subscribed_commands to the set of commands they need decoded. Messages
+    of any other type are then only counted and kept as raw bytes in
+    last_message, their on_* callbacks are not called, and they are
+    deserialized on first access of last_message[command]."""
+
+    # Set of command strings to deserialize, or None to deserialize everything
+    subscribed_commands = None
+
+    # Commands that are always deserialized, since the version handshake and
+    # sync_with_ping() depend on their callbacks.
+    ALWAYS_DECODED = frozenset([b"version", b"verack", b"ping", b"pong"])
+
     def __init__(self):
         super().__init__()
 
         # Track number of messages of each type received and the most recent
         # message of each type
         self.message_count = defaultdict(int)
-        self.last_message = {}
+        self.last_message = LazyMessageDict()
+
+        if self.subscribed_commands is None:
+            self.decoded_commands = None
+        else:
+            self.decoded_commands = self.ALWAYS_DECODED.union(c.encode('ascii') for c in self.subscribed_commands)
 
         # A count of the number of ping messages we've sent to the node
         self.ping_counter = 1
@@ -297,6 +590,16 @@ class P2PInterface(P2PConnection):
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
 
+    def wants_decoded(self, command):
+        return self.decoded_commands is None or command in self.decoded_commands
+
+    def on_raw_message(self, command, payload):
+        """Count a message that is not subscribed to and keep its raw payload."""
+        with mininode_lock:
+            command_str = command.decode('ascii')
+            self.message_count[command_str] += 1
+            self.last_message[command_str] = RawMessage(command, payload)
+
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
 
@@ -390,6 +693,71 @@ class P2PInterface(P2PConnection):
         self.ping_counter += 1
 
 
+class P2PReplayer(P2PInterface):
+    """A P2PInterface that pushes the messages of a capture file into a node.
+
+    The connection performs its own version handshake, so handshake and
+    ping/pong messages from the capture are skipped. By default the messages
+    that were received by the recording connection are replayed, ie the
+    replayer plays the role of the peer that was recorded."""
+
+    # Commands that are never replayed
+    SKIPPED_COMMANDS = frozenset([b"version", b"verack", b"ping", b"pong"])
+
+    # Maximum number of bytes to queue in the send buffer before waiting for
+    # the network thread to drain it
+    MAX_QUEUED_BYTES = 16 * 1024 * 1024
+
+    def replay(self, path, direction=CAPTURE_RECV, commands=None, paced=False, timeout=600):
+        """Replay a capture file over this connection and sync with a ping.
+
+        commands: if given, an iterable of command strings to replay.
+        paced: if True, keep the original spacing between messages. Otherwise
+            push messages as fast as the socket allows.
+
+        Returns a dict with the number of messages and bytes replayed, the
+        elapsed time and the resulting rates."""
+        if commands is not None:
+            commands = set(c.encode('ascii') for c in commands)
+        magic = MAGIC_BYTES[self.network]
+        num_messages = 0
+        num_bytes = 0
+        first_timestamp = None
+        start = time.time()
+        for record_direction, timestamp, data in read_capture(path):
+            command = message_command(data)
+            if record_direction != direction or command in self.SKIPPED_COMMANDS:
+                continue
+            if commands is not None and command not in commands:
+                continue
+            if paced:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = (timestamp - first_timestamp) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                wait_until(lambda: self.sendbuf_size < self.MAX_QUEUED_BYTES, timeout=timeout, lock=mininode_lock)
+            if data[:4] != magic:
+                # Replay captures from other networks into this node's network
+                data = magic + data[4:]
+            self.send_raw(data)
+            num_messages += 1
+            num_bytes += len(data)
+        self.sync_with_ping(timeout=timeout)
+        elapsed = max(time.time() - start, 1e-6)
+        stats = {
+            "messages": num_messages,
+            "bytes": num_bytes,
+            "seconds": elapsed,
+            "msgs_per_s": num_messages / elapsed,
+            "bytes_per_s": num_bytes / elapsed,
+        }
+        logger.info("Replayed %d messages (%d bytes) in %.3f s: %.1f msgs/s, %.1f bytes/s" %
+                    (num_messages, num_bytes, elapsed, stats["msgs_per_s"], stats["bytes_per_s"]))
+        return stats
+
+
 # Keep our own socket map for asyncore, so that we can track disconnects
 # ourselves (to workaround an issue with closing an asyncore socket when
 # using select)
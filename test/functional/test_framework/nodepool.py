@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Pool of warm litecoind processes shared by the test scripts of a test run.
+
+Starting litecoind (mastercore_init, loading the Tradelayer state, opening
+the LevelDB databases) dominates the runtime of short tests. With
+`test_runner.py --nodepool=N`, the runner keeps up to N started nodes per
+node profile and hands them to test scripts over a Unix socket, whose path is
+passed to the scripts in the TEST_NODEPOOL environment variable.
+
+A node profile is everything that determines a node's initial state: its
+arguments (except -datadir), its litecoin.conf (except the ports), the
+datadir it was provisioned from (a clean chain, the cache or a snapshot) and
+the list of files in its datadir. The first time a profile is requested the
+test starts its node cold, and the pool starts a node with that profile in
+the background for the next test. When a test is done with a pooled node it
+releases it; the pool stops it, provisions its datadir again and restarts it.
+
+Pooled nodes use their own ports. The test script overrides p2p_port() and
+rpc_port() for the node's index, and the test datadir becomes a symlink to the
+pooled node's datadir, so the rest of the framework doesn't see a difference.
+
+Protocol: one JSON object per line in each direction, one request per
+connection.
+    {"op": "acquire", "profile": {...}} -> {"ok": true, "id": ..., "datadir": ..., "pid": ..., "p2p_port": ..., "rpc_port": ...}
+                                         or {"ok": false}
+    {"op": "release", "id": ...}        -> {"ok": true}"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import threading
+
+from .util import (
+    PORT_MIN,
+    PORT_RANGE,
+    clone_datadir,
+    reserve_port,
+    wait_until,
+)
+
+logger = logging.getLogger("TestFramework.nodepool")
+
+ENV_VAR = "TEST_NODEPOOL"
+
+# Pooled nodes get ports above the ranges used by test scripts and feature_proxy.py:
+# p2p ports in [POOL_PORT_MIN, POOL_PORT_MIN + PORT_RANGE), rpc ports in the next range.
+# They are reserved in the port registry like the ports of the test scripts.
+POOL_PORT_MIN = PORT_MIN + 3 * PORT_RANGE
+
+# Files that are copied back into the test datadir when a pooled node is released
+RELEASED_LOG_FILES = ["debug.log", "tradelayer.log"]
+
+def strip_port_lines(conf):
+    return "".join(line for line in conf.splitlines(True) if not line.startswith(("port=", "rpcport=")))
+
+def datadir_fingerprint(datadir):
+    """Return the litecoin.conf (without ports) and the (path, size) list of a datadir's other files."""
+    with open(os.path.join(datadir, "litecoin.conf"), encoding='utf8') as f:
+        conf = strip_port_lines(f.read())
+    files = []
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, datadir)
+            if rel != "litecoin.conf":
+                files.append([rel, os.path.getsize(path)])
+    return conf, sorted(files)
+
+def node_profile(index, args, datadir, source):
+    """Return the profile of a node that is about to be started with args."""
+    binary = shutil.which(args[0]) or args[0]
+    conf, files = datadir_fingerprint(datadir)
+    return {
+        "index": index,
+        "binary": os.path.realpath(binary),
+        "args": [arg for arg in args[1:] if not arg.startswith("-datadir=")],
+        "conf": conf,
+        "source": source,
+        "files": files,
+    }
+
+def profile_key(profile):
+    return hashlib.sha256(json.dumps(profile, sort_keys=True).encode('utf8')).hexdigest()
+
+class PooledProcess():
+    """A subprocess.Popen-like handle on a litecoind started by the pool.
+
+    The process is not a child of the test script, so its exit status is
+    unknown and reported as 0."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                with open("/proc/%d/stat" % self.pid, encoding='utf8') as f:
+                    state = f.read().rsplit(")", 1)[1].split()[0]
+            except (OSError, IndexError):
+                state = "X"
+            if state in ("Z", "X"):
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        wait_until(lambda: self.poll() is not None, timeout=timeout if timeout is not None else float('inf'))
+        return self.returncode
+
+    def send_signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class NodePoolClient():
+    """Client side of the pool protocol, used by the test framework."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_environment(cls):
+        path = os.getenv(ENV_VAR)
+        return cls(path) if path else None
+
+    def request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.path)
+            s.sendall(json.dumps(request).encode('utf8') + b"\n")
+            with s.makefile('rb') as f:
+                return json.loads(f.readline().decode('utf8'))
+
+    def acquire(self, profile):
+        """Return a lease on a started node with this profile, or None."""
+        try:
+            reply = self.request({"op": "acquire", "profile": profile})
+        except (OSError, ValueError):
+            logger.exception("Node pool unavailable")
+            return None
+        return reply if reply.get("ok") else None
+
+    def release(self, lease_id):
+        try:
+            self.request({"op": "release", "id": lease_id})
+        except (OSError, ValueError):
+            logger.exception("Node pool unavailable")
+
+class PoolEntry():
+    def __init__(self, entry_id, profile, pooldir, p2p_port, rpc_port):
+        # test_node imports this module
+        from .test_node import TestNode
+        self.id = entry_id
+        self.profile = profile
+        self.key = profile_key(profile)
+        self.p2p_port = p2p_port
+        self.rpc_port = rpc_port
+        self.stderr = None
+        self.node = TestNode(profile["index"], os.path.join(pooldir, str(entry_id)), extra_args=[],
+                             rpchost="127.0.0.1:%d" % rpc_port, timewait=None, binary=None,
+                             stderr=None, mocktime=0, coverage_dir=None)
+        self.node.args = [profile["binary"], "-datadir=" + self.node.datadir] + profile["args"]
+        self.node.cleanup_on_exit = True
+
+class NodePool():
+    """Server side of the pool, run by test_runner.py."""
+
+    def __init__(self, pooldir, max_per_profile):
+        self.pooldir = pooldir
+        self.max_per_profile = max_per_profile
+        self.socket_path = os.path.join(pooldir, "pool.sock")
+        self.lock = threading.Lock()
+        self.entries = {}
+        # profile key -> ids of started nodes that aren't leased
+        self.ready = {}
+        # profile keys that can't be reproduced by the pool
+        self.unpoolable = set()
+        self.next_id = 0
+        self.stopping = False
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        # Only test_runner.py runs the server
+        import socketserver
+        os.makedirs(self.pooldir, exist_ok=True)
+        pool = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline().decode('utf8'))
+                if request["op"] == "acquire":
+                    reply = pool.acquire(request["profile"])
+                elif request["op"] == "release":
+                    reply = pool.release(request["id"])
+                else:
+                    reply = {"ok": False, "error": "unknown op"}
+                self.wfile.write(json.dumps(reply).encode('utf8') + b"\n")
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="NodePool")
+        self.thread.daemon = True
+        self.thread.start()
+        os.environ[ENV_VAR] = self.socket_path
+
+    def stop(self):
+        os.environ.pop(ENV_VAR, None)
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            self.stopping = True
+            entries = list(self.entries.values())
+        for entry in entries:
+            self._stop_node(entry)
+        logger.info("Node pool: %d starts served from the pool, %d cold starts" % (self.hits, self.misses))
+        shutil.rmtree(self.pooldir, ignore_errors=True)
+
+    def acquire(self, profile):
+        key = profile_key(profile)
+        with self.lock:
+            if key in self.unpoolable:
+                self.misses += 1
+                return {"ok": False}
+            ready = self.ready.get(key)
+            if ready:
+                entry = self.entries[ready.pop()]
+                self.hits += 1
+                return {"ok": True, "id": entry.id, "datadir": entry.node.datadir, "pid": entry.node.process.pid,
+                        "p2p_port": entry.p2p_port, "rpc_port": entry.rpc_port}
+            self.misses += 1
+            if sum(1 for e in self.entries.values() if e.key == key) >= self.max_per_profile:
+                return {"ok": False}
+            try:
+                p2p_port = reserve_port(POOL_PORT_MIN, POOL_PORT_MIN + self.next_id)
+                rpc_port = reserve_port(POOL_PORT_MIN + PORT_RANGE, POOL_PORT_MIN + PORT_RANGE + self.next_id)
+            except AssertionError as e:
+                logger.debug("Node pool: %s" % e)
+                return {"ok": False}
+            entry = PoolEntry(self.next_id, profile, self.pooldir, p2p_port, rpc_port)
+            self.next_id += 1
+            self.entries[entry.id] = entry
+        # Warm up a node with this profile for the next test that asks for it
+        threading.Thread(target=self._reset, args=(entry,), daemon=True).start()
+        return {"ok": False}
+
+    def release(self, entry_id):
+        with self.lock:
+            entry = self.entries.get(entry_id)
+        if entry is not None:
+            threading.Thread(target=self._reset, args=(entry,), daemon=True).start()
+        return {"ok": True}
+
+    def _stop_node(self, entry):
+        node = entry.node
+        if node.process is None:
+            return
+        node.process.terminate()
+        try:
+            node.process.wait(timeout=60)
+        except Exception:
+            node.process.kill()
+            node.process.wait()
+        node.process = None
+        node.running = False
+        node.rpc_connected = False
+        node.rpc = None
+        if entry.stderr is not None:
+            entry.stderr.close()
+            entry.stderr = None
+
+    def _provision(self, entry):
+        """Recreate the entry's datadir from its profile.
+
+        Returns False if the result doesn't match the datadir the profile was
+        taken from, e.g. because the test added files of its own."""
+        datadir = entry.node.datadir
+        shutil.rmtree(datadir, ignore_errors=True)
+        if entry.profile["source"]:
+            clone_datadir(entry.profile["source"], datadir)
+        else:
+            os.makedirs(datadir)
+        with open(os.path.join(datadir, "litecoin.conf"), 'w', encoding='utf8') as f:
+            f.write(entry.profile["conf"])
+            f.write("port=%d\n" % entry.p2p_port)
+            f.write("rpcport=%d\n" % entry.rpc_port)
+        return datadir_fingerprint(datadir) == (entry.profile["conf"], entry.profile["files"])
+
+    def _reset(self, entry):
+        """Stop the entry's node, provision its datadir again and restart it."""
+        try:
+            self._stop_node(entry)
+            if not self._provision(entry):
+                logger.debug("Node pool: can't reproduce the datadir of profile %s" % entry.key[:16])
+                with self.lock:
+                    self.unpoolable.add(entry.key)
+                    del self.entries[entry.id]
+                return
+            with self.lock:
+                if self.stopping:
+                    return
+            entry.stderr = open(os.path.join(self.pooldir, "%d.stderr" % entry.id), 'w', encoding='utf8')
+            entry.node.start(stderr=entry.stderr)
+            entry.node.wait_for_rpc_connection()
+            with self.lock:
+                if self.stopping:
+                    stop = True
+                else:
+                    stop = False
+                    self.ready.setdefault(entry.key, []).append(entry.id)
+            if stop:
+                self._stop_node(entry)
+        except Exception:
+            logger.exception("Node pool: failed to start node %d" % entry.id)
+            self._stop_node(entry)
+            with self.lock:
+                self.unpoolable.add(entry.key)
+                self.entries.pop(entry.id, None)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Sample the resource usage of litecoind processes from /proc.
+
+With --nodestats=MS, each TestNode runs a ProcSampler thread that reads
+/proc/<pid>/stat, status, io and fd every MS milliseconds while its litecoind
+runs. Samples go to a ring buffer, so long tests keep the most recent ones,
+while the summary (CPU time, peak RSS, I/O totals, peak open files) covers the
+whole run. At the end of the test the samples of each node are written to
+<tmpdir>/reports/node<n>_resources.json, which test_runner.py summarizes.
+
+Linux only: on other platforms no samples are taken."""
+
+from collections import deque, namedtuple
+import json
+import os
+import threading
+import time
+
+REPORTS_DIR = "reports"
+
+# Keep one hour of samples at the default interval
+DEFAULT_MAX_SAMPLES = 36000
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# time is in seconds since the sampler started, cpu times in seconds, memory and I/O in bytes
+ProcSample = namedtuple("ProcSample", ["time", "cpu_user", "cpu_sys", "rss", "threads", "read_bytes", "write_bytes", "fds"])
+
+def read_proc_sample(pid, start):
+    """Return a ProcSample of a process, or None if it doesn't exist anymore."""
+    try:
+        with open("/proc/%d/stat" % pid, encoding='utf8') as f:
+            # The command name may contain spaces, the fields after it don't
+            stat = f.read().rsplit(")", 1)[1].split()
+        if stat[0] == "Z":
+            return None
+        rss = threads = 0
+        with open("/proc/%d/status" % pid, encoding='utf8') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+        read_bytes = write_bytes = 0
+        try:
+            with open("/proc/%d/io" % pid, encoding='utf8') as f:
+                for line in f:
+                    key, value = line.split(":")
+                    if key == "read_bytes":
+                        read_bytes = int(value)
+                    elif key == "write_bytes":
+                        write_bytes = int(value)
+        except PermissionError:
+            pass
+        fds = len(os.listdir("/proc/%d/fd" % pid))
+    except (OSError, IndexError, ValueError):
+        return None
+    return ProcSample(round(time.time() - start, 3), int(stat[11]) / CLK_TCK, int(stat[12]) / CLK_TCK,
+                      rss, threads, read_bytes, write_bytes, fds)
+
+class ProcSampler(threading.Thread):
+    """Sample a process every interval seconds until it exits or stop() is called."""
+
+    def __init__(self, pid, interval, max_samples=DEFAULT_MAX_SAMPLES):
+        super().__init__(name="ProcSampler-%d" % pid)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.start_time = time.time()
+        self.samples = deque(maxlen=max_samples)
+        self.last = None
+        self.peak_rss = 0
+        self.peak_fds = 0
+        self.peak_threads = 0
+        self.num_samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            sample = read_proc_sample(self.pid, self.start_time)
+            if sample is None:
+                return
+            self.samples.append(sample)
+            self.last = sample
+            self.num_samples += 1
+            self.peak_rss = max(self.peak_rss, sample.rss)
+            self.peak_fds = max(self.peak_fds, sample.fds)
+            self.peak_threads = max(self.peak_threads, sample.threads)
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def summary(self):
+        last = self.last
+        return {
+            "duration": last.time if last else 0,
+            "cpu_user": last.cpu_user if last else 0,
+            "cpu_sys": last.cpu_sys if last else 0,
+            "peak_rss": self.peak_rss,
+            "peak_threads": self.peak_threads,
+            "read_bytes": last.read_bytes if last else 0,
+            "write_bytes": last.write_bytes if last else 0,
+            "peak_fds": self.peak_fds,
+            "num_samples": self.num_samples,
+        }
+
+    def to_dict(self):
+        return {
+            "pid": self.pid,
+            "start": self.start_time,
+            "interval": self.interval,
+            "fields": list(ProcSample._fields),
+            "samples": [list(sample) for sample in self.samples],
+            "summary": self.summary(),
+        }
+
+def combine_summaries(summaries):
+    """Combine the summaries of several runs (restarts) of a node."""
+    combined = {}
+    for key in ["duration", "cpu_user", "cpu_sys", "read_bytes", "write_bytes", "num_samples"]:
+        combined[key] = sum(s[key] for s in summaries)
+    for key in ["peak_rss", "peak_threads", "peak_fds"]:
+        combined[key] = max([s[key] for s in summaries], default=0)
+    return combined
+
+def write_report(path, node_index, runs):
+    """Write the samples of a node's runs, as returned by ProcSampler.to_dict(), to path."""
+    report = {
+        "node": node_index,
+        "runs": runs,
+        "summary": combine_summaries([run["summary"] for run in runs]),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(report, f)
+
+def load_summaries(testdir):
+    """Return {node index: summary} for the resource reports in a test directory."""
+    summaries = {}
+    reports = os.path.join(testdir, REPORTS_DIR)
+    if not os.path.isdir(reports):
+        return summaries
+    for name in sorted(os.listdir(reports)):
+        if name.endswith("_resources.json"):
+            try:
+                with open(os.path.join(reports, name), encoding='utf8') as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                continue
+            summaries[report["node"]] = report["summary"]
+    return summaries
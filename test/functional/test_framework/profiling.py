@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Profile the Python side of a test.
+
+With --profile, run_test() runs under cProfile. The profile is written to
+<tmpdir>/reports/run_test.prof (for pstats, snakeviz, etc.) and summarized
+in run_test_profile.txt: the functions with the highest cumulative time,
+and how the time of the test script splits between waiting for the nodes,
+sleeping (wait_until() and other polling) and the framework's own code, like
+messages.py serialization and the JSON encoding in authproxy.py.
+
+With --tracemalloc, Python allocations are traced and a snapshot is taken
+at the end of every phase of the test. <tmpdir>/reports/tracemalloc.txt lists
+the top allocation sites of each snapshot and what changed since the
+previous one."""
+
+import os
+import tracemalloc
+
+from .procstats import REPORTS_DIR
+
+PROFILE_FILE = "run_test.prof"
+PROFILE_SUMMARY_FILE = "run_test_profile.txt"
+TRACEMALLOC_FILE = "tracemalloc.txt"
+
+# Number of entries in the summaries
+PROFILE_TOP = 40
+TRACEMALLOC_TOP = 25
+
+# (group, predicate on the (path, line, function name) key of a pstats entry).
+# The time of a function goes to the first group it matches.
+TIME_GROUPS = [
+    ("waiting for the nodes", lambda path, line, name: path == "~" and ("recv" in name or "select" in name or "poll" in name or "connect" in name)),
+    ("sleeping", lambda path, line, name: path == "~" and "sleep" in name),
+    ("messages.py serialization", lambda path, line, name: path.endswith(os.path.join("test_framework", "messages.py"))),
+    ("authproxy.py", lambda path, line, name: path.endswith(os.path.join("test_framework", "authproxy.py"))),
+    ("JSON encoding and decoding", lambda path, line, name: os.sep + "json" + os.sep in path or "_json" in name),
+    ("mininode.py", lambda path, line, name: path.endswith(os.path.join("test_framework", "mininode.py"))),
+    ("util.py", lambda path, line, name: path.endswith(os.path.join("test_framework", "util.py"))),
+]
+
+def time_breakdown(stats):
+    """Return [(group, own time in seconds)] of the functions in a pstats.Stats, largest first."""
+    totals = {}
+    for (path, line, name), (_, _, tottime, _, _) in stats.stats.items():
+        group = next((group for group, match in TIME_GROUPS if match(path, line, name)), "other")
+        totals[group] = totals.get(group, 0.0) + tottime
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+def write_profile_summary(stats, path):
+    with open(path, 'w', encoding='utf8') as f:
+        total = stats.total_tt or 1
+        f.write("Time by group (own time of the functions):\n\n")
+        for group, seconds in time_breakdown(stats):
+            f.write("  %-28s %9.3f s  %5.1f%%\n" % (group, seconds, 100 * seconds / total))
+        f.write("\n")
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        stats.stream = None
+
+def profile_call(func, testdir):
+    """Call func under cProfile and write the profile and its summary to the test's reports."""
+    # Only imported when profiling, like pdb
+    import cProfile
+    import pstats
+    reports = os.path.join(testdir, REPORTS_DIR)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        os.makedirs(reports, exist_ok=True)
+        profiler.dump_stats(os.path.join(reports, PROFILE_FILE))
+        write_profile_summary(pstats.Stats(profiler), os.path.join(reports, PROFILE_SUMMARY_FILE))
+
+class MemoryTracer():
+    """Trace Python allocations and take snapshots at phase boundaries."""
+
+    def __init__(self):
+        # (phase, snapshot)
+        self.snapshots = []
+
+    def start(self):
+        tracemalloc.start()
+
+    def snapshot(self, phase):
+        if tracemalloc.is_tracing():
+            self.snapshots.append((phase, tracemalloc.take_snapshot()))
+
+    def write_report(self, testdir):
+        tracemalloc.stop()
+        path = os.path.join(testdir, REPORTS_DIR, TRACEMALLOC_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as f:
+            previous = None
+            for phase, snapshot in self.snapshots:
+                stats = snapshot.statistics("lineno")
+                f.write("After %s: %.1f MB in %d blocks\n\n" % (phase, sum(s.size for s in stats) / 1e6, sum(s.count for s in stats)))
+                for stat in stats[:TRACEMALLOC_TOP]:
+                    f.write("  %s\n" % stat)
+                if previous is not None:
+                    f.write("\n  Changes since the previous snapshot:\n\n")
+                    for stat in snapshot.compare_to(previous, "lineno")[:TRACEMALLOC_TOP]:
+                        f.write("  %s\n" % stat)
+                f.write("\n")
+                previous = snapshot
+        self.snapshots = []
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Named, versioned snapshots of node datadirs.
+
+A test declares the chain state it starts from as a ChainSnapshot:
+
+    def build_funded(test):
+        test.nodes[0].generate(200)
+        ...
+        return {"addresses": addresses}
+
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.snapshot = ChainSnapshot("funded", 1, build_funded)
+
+The first test that needs a snapshot starts nodes on a clean chain, runs the
+builder against them and stores the resulting regtest directories (including
+the Tradelayer OCL_* databases) under <cachedir>/snapshots. Every later test
+restores that copy instead of rebuilding it. The value returned by the builder
+is saved with the snapshot and restored as test.snapshot_data.
+
+Snapshots are keyed by name, version, the node arguments and a hash of the
+litecoind binary, so they are rebuilt whenever the binary changes. Bump the
+version when the builder changes."""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger("TestFramework.snapshot")
+
+# Entries of a node's regtest directory that are kept in caches and snapshots
+CACHE_ENTRIES = ['wallets', 'chainstate', 'blocks', 'OCL_persist', 'OCL_tradelist', 'OCL_txlist', 'OCL_spinfo', 'OCL_TXDB']
+
+MANIFEST = "manifest.json"
+
+_binary_hashes = {}
+
+def binary_hash(binary):
+    """Return the sha256 of a binary, looked up on the PATH if needed."""
+    path = shutil.which(binary) or binary
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key not in _binary_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _binary_hashes[key] = h.hexdigest()
+    return _binary_hashes[key]
+
+class ChainSnapshot():
+    """A named, versioned chain state built once and restored by tests.
+
+    name: a short identifier, used in the snapshot directory name
+    version: bump to invalidate existing snapshots when the builder changes
+    builder: a function called with the test framework once its nodes are
+        started on a clean chain. It may return JSON-serializable data that is
+        stored with the snapshot.
+    num_nodes: number of nodes to build the snapshot with. Tests may use more
+        nodes; the extra ones start on a clean chain.
+    extra_args: per-node extra arguments used while building."""
+
+    def __init__(self, name, version, builder, num_nodes=1, extra_args=None):
+        self.name = name
+        self.version = version
+        self.builder = builder
+        self.num_nodes = num_nodes
+        self.extra_args = extra_args if extra_args is not None else [[]] * num_nodes
+        assert len(self.extra_args) == num_nodes
+
+    def build_hash(self, binary):
+        h = hashlib.sha256()
+        h.update(json.dumps([self.name, self.version, self.num_nodes, self.extra_args]).encode('utf8'))
+        h.update(binary_hash(binary).encode('ascii'))
+        return h.hexdigest()
+
+    def path(self, cachedir, build_hash):
+        return os.path.join(cachedir, "snapshots", "%s-v%s-%s" % (self.name, self.version, build_hash[:16]))
+
+    def load_manifest(self, cachedir, build_hash):
+        """Return the manifest of a complete snapshot, or None."""
+        try:
+            with open(os.path.join(self.path(cachedir, build_hash), MANIFEST), encoding='utf8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("build_hash") != build_hash:
+            return None
+        return manifest
+
+    def ensure(self, cachedir, binary, build):
+        """Return (path, manifest) of the snapshot, building it first if needed.
+
+        build is called with a scratch directory to build the node datadirs
+        in and returns (mocktime, data). Concurrent test processes wait for
+        each other through a lock file, and a snapshot only becomes visible
+        once it is complete."""
+        build_hash = self.build_hash(binary)
+        path = self.path(cachedir, build_hash)
+        manifest = self.load_manifest(cachedir, build_hash)
+        if manifest is not None:
+            return path, manifest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.load_manifest(cachedir, build_hash)
+            if manifest is not None:
+                return path, manifest
+
+            logger.info("Building snapshot %s v%s" % (self.name, self.version))
+            start = time.time()
+            scratch = "%s.tmp%d" % (path, os.getpid())
+            shutil.rmtree(scratch, ignore_errors=True)
+            os.makedirs(scratch)
+            try:
+                mocktime, data = build(scratch)
+                for i in range(self.num_nodes):
+                    regtest = os.path.join(scratch, "node" + str(i), "regtest")
+                    for entry in os.listdir(regtest):
+                        if entry not in CACHE_ENTRIES:
+                            entry_path = os.path.join(regtest, entry)
+                            if os.path.isdir(entry_path):
+                                shutil.rmtree(entry_path)
+                            else:
+                                os.remove(entry_path)
+                manifest = {
+                    "name": self.name,
+                    "version": self.version,
+                    "build_hash": build_hash,
+                    "num_nodes": self.num_nodes,
+                    "mocktime": mocktime,
+                    "data": data,
+                    "created": int(time.time()),
+                }
+                with open(os.path.join(scratch, MANIFEST), 'w', encoding='utf8') as f:
+                    json.dump(manifest, f, indent=4)
+                shutil.rmtree(path, ignore_errors=True)
+                os.rename(scratch, path)
+            except:
+                shutil.rmtree(scratch, ignore_errors=True)
+                raise
+            logger.info("Built snapshot %s v%s in %.1f s" % (self.name, self.version, time.time() - start))
+            return path, manifest
@@ -8,20 +8,25 @@ from enum import Enum
 import logging
 import optparse
 import os
-import pdb
 import shutil
 import sys
 import tempfile
 import time
 
-from .authproxy import JSONRPCException
+from .authproxy import JSONRPCException, RPC_STATS
 from . import coverage
-from .test_node import TestNode
+from .nodepool import NodePoolClient
+from .procstats import REPORTS_DIR
+from .profiling import MemoryTracer, profile_call
+from .snapshot import CACHE_ENTRIES
+from .teststats import PhaseTimer, write_test_stats
+from .test_node import TestNode, wait_for_rpc_connections, wait_until_stopped
 from .util import (
-    MAX_NODES,
+    CACHE_NODES,
     PortSeed,
     assert_equal,
     check_json_precision,
+    clone_datadir,
     connect_nodes_bi,
     disconnect_nodes,
     get_datadir_path,
@@ -63,6 +68,13 @@ class BitcoinTestFramework():
         self.nodes = []
         self.mocktime = 0
         self.supports_cli = False
+        # ChainSnapshot to start the nodes from, if any, and the data its builder returned
+        self.snapshot = None
+        self.snapshot_data = None
+        # Datadir each node was provisioned from by setup_chain(), by node index
+        self.datadir_sources = {}
+        self.nodepool = NodePoolClient.from_environment()
+        self.phase_timer = PhaseTimer()
         self.set_test_params()
 
         assert hasattr(self, "num_nodes"), "Test must set self.num_nodes in set_test_params()"
@@ -94,9 +106,20 @@ class BitcoinTestFramework():
                           help="Attach a python debugger if test fails")
         parser.add_option("--usecli", dest="usecli", default=False, action="store_true",
                           help="use litecoin-cli instead of RPC for all commands")
+        parser.add_option("--nodestats", dest="nodestats", default=0, type='int', metavar="MS",
+                          help="Sample CPU, memory, disk I/O and open files of each litecoind every MS milliseconds and write them to <tmpdir>/reports")
+        parser.add_option("--teststats", dest="teststats", default=False, action="store_true",
+                          help="Write the setup time and RPC statistics of the test to <tmpdir>/reports (used by test_runner.py)")
+        parser.add_option("--profile", dest="profile", default=False, action="store_true",
+                          help="Run run_test() under cProfile and write the profile and a summary to <tmpdir>/reports")
+        parser.add_option("--tracemalloc", dest="tracemalloc", default=False, action="store_true",
+                          help="Trace Python memory allocations and write the top allocation sites after each phase of the test to <tmpdir>/reports")
         self.add_options(parser)
         (self.options, self.args) = parser.parse_args()
 
+        start_time = time.time()
+        setup_time = None
+
         PortSeed.n = self.options.port_seed
 
         os.environ['PATH'] = self.options.srcdir + ":" + self.options.srcdir + "/qt:" + os.environ['PATH']
@@ -115,12 +138,29 @@ class BitcoinTestFramework():
 
         success = TestStatus.FAILED
 
+        memory_tracer = MemoryTracer() if self.options.tracemalloc else None
+        if memory_tracer:
+            memory_tracer.start()
+
         try:
             if self.options.usecli and not self.supports_cli:
                 raise SkipTest("--usecli specified but test does not support using CLI")
-            self.setup_chain()
-            self.setup_network()
-            self.run_test()
+            with self.phase_timer.phase("setup_chain"):
+                self.setup_chain()
+            if memory_tracer:
+                memory_tracer.snapshot("setup_chain")
+            with self.phase_timer.phase("setup_network"):
+                self.setup_network()
+            if memory_tracer:
+                memory_tracer.snapshot("setup_network")
+            setup_time = time.time() - start_time
+            with self.phase_timer.phase("run_test"):
+                if self.options.profile:
+                    profile_call(self.run_test, self.options.tmpdir)
+                else:
+                    self.run_test()
+            if memory_tracer:
+                memory_tracer.snapshot("run_test")
             success = TestStatus.PASSED
         except JSONRPCException as e:
             self.log.exception("JSONRPC error")
@@ -138,23 +178,58 @@ class BitcoinTestFramework():
 
         if success == TestStatus.FAILED and self.options.pdbonfailure:
             print("Testcase failed. Attaching python debugger. Enter ? for help")
+            import pdb
             pdb.set_trace()
 
         if not self.options.noshutdown:
             self.log.info("Stopping nodes")
-            if self.nodes:
-                self.stop_nodes()
+            with self.phase_timer.phase("shutdown"):
+                if self.nodes:
+                    self.stop_nodes()
+                for node in self.nodes:
+                    node.release_to_pool()
+                    node.write_resource_report(self.options.tmpdir)
+            if memory_tracer:
+                memory_tracer.snapshot("shutdown")
         else:
             for node in self.nodes:
                 node.cleanup_on_exit = False
             self.log.info("Note: litecoinds were not stopped and may still be running")
 
+        if self.options.coveragedir is not None:
+            coverage.flush()
+
+        if memory_tracer:
+            memory_tracer.write_report(self.options.tmpdir)
+
         if not self.options.nocleanup and not self.options.noshutdown and success != TestStatus.FAILED:
             self.log.info("Cleaning up")
-            shutil.rmtree(self.options.tmpdir)
+            with self.phase_timer.phase("cleanup"):
+                reports = os.path.join(self.options.tmpdir, REPORTS_DIR)
+                if os.path.isdir(reports):
+                    # Keep the reports for test_runner.py
+                    for entry in os.listdir(self.options.tmpdir):
+                        path = os.path.join(self.options.tmpdir, entry)
+                        if path == reports:
+                            continue
+                        if os.path.isdir(path) and not os.path.islink(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
+                else:
+                    shutil.rmtree(self.options.tmpdir)
         else:
             self.log.warning("Not cleaning up dir %s" % self.options.tmpdir)
 
+        self.log.debug("Phase timings: %s" % self.phase_timer)
+        if self.options.teststats:
+            write_test_stats(self.options.tmpdir, {
+                "setup_time": setup_time,
+                "rpc_requests": RPC_STATS["requests"],
+                "rpc_seconds": RPC_STATS["seconds"],
+                "phases": self.phase_timer.times,
+            })
+
         if success == TestStatus.PASSED:
             self.log.info("Tests successful")
             exit_code = TEST_EXIT_PASSED
@@ -180,7 +255,9 @@ class BitcoinTestFramework():
     def setup_chain(self):
         """Override this method to customize blockchain setup"""
         self.log.info("Initializing test directory " + self.options.tmpdir)
-        if self.setup_clean_chain:
+        if self.snapshot is not None:
+            self._initialize_chain_from_snapshot()
+        elif self.setup_clean_chain:
             self._initialize_chain_clean()
         else:
             self._initialize_chain()
@@ -220,15 +297,22 @@ class BitcoinTestFramework():
         assert_equal(len(extra_args), num_nodes)
         assert_equal(len(binary), num_nodes)
         for i in range(num_nodes):
-            self.nodes.append(TestNode(i, self.options.tmpdir, extra_args[i], rpchost, timewait=timewait, binary=binary[i], stderr=None, mocktime=self.mocktime, coverage_dir=self.options.coveragedir, use_cli=self.options.usecli))
+            node = TestNode(i, self.options.tmpdir, extra_args[i], rpchost, timewait=timewait, binary=binary[i], stderr=None, mocktime=self.mocktime, coverage_dir=self.options.coveragedir, use_cli=self.options.usecli)
+            if self.options.nodestats:
+                node.sample_interval = self.options.nodestats / 1000
+            if rpchost is None:
+                node.pool = self.nodepool
+                node.datadir_source = self.datadir_sources.get(i)
+            self.nodes.append(node)
 
     def start_node(self, i, *args, **kwargs):
         """Start a litecoind"""
 
         node = self.nodes[i]
 
-        node.start(*args, **kwargs)
-        node.wait_for_rpc_connection()
+        with self.phase_timer.phase("node_startup"):
+            node.start(*args, **kwargs)
+            node.wait_for_rpc_connection()
 
         if self.options.coveragedir is not None:
             coverage.write_all_rpc_commands(self.options.coveragedir, node.rpc)
@@ -240,10 +324,10 @@ class BitcoinTestFramework():
             extra_args = [None] * self.num_nodes
         assert_equal(len(extra_args), self.num_nodes)
         try:
-            for i, node in enumerate(self.nodes):
-                node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            with self.phase_timer.phase("node_startup"):
+                for i, node in enumerate(self.nodes):
+                    node.start(extra_args[i], *args, **kwargs)
+                wait_for_rpc_connections(self.nodes)
         except:
             # If one node failed to start, stop the others
             self.stop_nodes()
@@ -264,9 +348,8 @@ class BitcoinTestFramework():
             # Issue RPC to stop nodes
             node.stop_node()
 
-        for node in self.nodes:
-            # Wait for nodes to stop
-            node.wait_until_stopped()
+        # Wait for nodes to stop
+        wait_until_stopped(self.nodes)
 
     def restart_node(self, i, extra_args=None):
         """Stop and start a test node"""
@@ -280,6 +363,7 @@ class BitcoinTestFramework():
                 self.stop_node(i)
             except Exception as e:
                 assert 'litecoind exited' in str(e)  # node must have shutdown
+                self.nodes[i]._stop_log_tailer()
                 self.nodes[i].running = False
                 self.nodes[i].process = None
                 if expected_msg is not None:
@@ -368,12 +452,12 @@ class BitcoinTestFramework():
     def _initialize_chain(self):
         """Initialize a pre-mined blockchain for use by the test.
 
-        Create a cache of a 200-block-long chain (with wallet) for MAX_NODES
+        Create a cache of a 200-block-long chain (with wallet) for CACHE_NODES
         Afterward, create num_nodes copies from the cache."""
 
-        assert self.num_nodes <= MAX_NODES
+        assert self.num_nodes <= CACHE_NODES
         create_cache = False
-        for i in range(MAX_NODES):
+        for i in range(CACHE_NODES):
             if not os.path.isdir(get_datadir_path(self.options.cachedir, i)):
                 create_cache = True
                 break
@@ -382,23 +466,22 @@ class BitcoinTestFramework():
             self.log.debug("Creating data directories from cached datadir")
 
             # find and delete old cache directories if any exist
-            for i in range(MAX_NODES):
+            for i in range(CACHE_NODES):
                 if os.path.isdir(get_datadir_path(self.options.cachedir, i)):
                     shutil.rmtree(get_datadir_path(self.options.cachedir, i))
 
             # Create cache directories, run bitcoinds:
-            for i in range(MAX_NODES):
+            for i in range(CACHE_NODES):
                 datadir = initialize_datadir(self.options.cachedir, i)
                 args = [os.getenv("LITECOIND", "litecoind"), "-server", "-keypool=1", "-datadir=" + datadir, "-discover=0"]
                 if i > 0:
                     args.append("-connect=127.0.0.1:" + str(p2p_port(0)))
                 self.nodes.append(TestNode(i, self.options.cachedir, extra_args=[], rpchost=None, timewait=None, binary=None, stderr=None, mocktime=self.mocktime, coverage_dir=None))
                 self.nodes[i].args = args
-                self.start_node(i)
+                self.nodes[i].start()
 
             # Wait for RPC connections to be ready
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            wait_for_rpc_connections(self.nodes)
 
             # Create a 200-block-long chain; each of the 4 first nodes
             # gets 25 mature blocks and 25 immature.
@@ -426,17 +509,55 @@ class BitcoinTestFramework():
             def cache_path(n, *paths):
                 return os.path.join(get_datadir_path(self.options.cachedir, n), "regtest", *paths)
 
-            for i in range(MAX_NODES):
+            for i in range(CACHE_NODES):
                 for entry in os.listdir(cache_path(i)):
-                    if entry not in ['wallets', 'chainstate', 'blocks', 'OCL_persist', 'OCL_tradelist', 'OCL_txlist', 'OCL_spinfo', 'OCL_TXDB']:
+                    if entry not in CACHE_ENTRIES:
                         os.remove(cache_path(i, entry))
 
         for i in range(self.num_nodes):
             from_dir = get_datadir_path(self.options.cachedir, i)
             to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(from_dir, to_dir)
+            self.log.debug("Cloned node%d datadir: %s" % (i, clone_datadir(from_dir, to_dir)))
+            self.datadir_sources[i] = from_dir
             initialize_datadir(self.options.tmpdir, i)  # Overwrite port/rpcport in bitcoin.conf
 
+    def _build_snapshot(self, scratch):
+        """Start nodes on a clean chain in scratch, run the snapshot builder and stop them.
+
+        Returns the mocktime the builder left set and the data it returned."""
+        snapshot = self.snapshot
+        assert not self.nodes
+        for i in range(snapshot.num_nodes):
+            initialize_datadir(scratch, i)
+            self.nodes.append(TestNode(i, scratch, extra_args=snapshot.extra_args[i], rpchost=None, timewait=None, binary=None, stderr=None, mocktime=self.mocktime, coverage_dir=None))
+        try:
+            for node in self.nodes:
+                node.start()
+            wait_for_rpc_connections(self.nodes)
+            for i in range(snapshot.num_nodes - 1):
+                connect_nodes_bi(self.nodes, i, i + 1)
+            data = snapshot.builder(self)
+            if snapshot.num_nodes > 1:
+                sync_blocks(self.nodes)
+        finally:
+            self.stop_nodes()
+            self.nodes = []
+        mocktime = self.mocktime
+        self.disable_mocktime()
+        return mocktime, data
+
+    def _initialize_chain_from_snapshot(self):
+        """Initialize the test datadirs from the test's ChainSnapshot, building it first if needed."""
+        path, manifest = self.snapshot.ensure(self.options.cachedir, os.getenv("LITECOIND", "litecoind"), self._build_snapshot)
+        for i in range(self.num_nodes):
+            if i < manifest["num_nodes"]:
+                self.log.debug("Cloned node%d datadir: %s" % (i, clone_datadir(get_datadir_path(path, i), get_datadir_path(self.options.tmpdir, i))))
+                self.datadir_sources[i] = get_datadir_path(path, i)
+            initialize_datadir(self.options.tmpdir, i)
+        self.mocktime = manifest["mocktime"]
+        self.snapshot_data = manifest["data"]
+        self.log.debug("Restored snapshot %s v%s" % (manifest["name"], manifest["version"]))
+
     def _initialize_chain_clean(self):
         """Initialize empty blockchain for use by the test.
 
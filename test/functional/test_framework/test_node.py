@@ -11,11 +11,24 @@ import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import time
 
 from .authproxy import JSONRPCException
+from .logtail import LogTailer, file_position
+from .nodepool import (
+    RELEASED_LOG_FILES,
+    PooledProcess,
+    node_profile,
+)
+from .procstats import (
+    REPORTS_DIR,
+    ProcSampler,
+    write_report,
+)
 from .util import (
+    PORT_OVERRIDES,
     assert_equal,
     delete_cookie_file,
     get_rpc_proxy,
@@ -29,6 +42,16 @@ JSONDecodeError = getattr(json, "JSONDecodeError", ValueError)
 
 BITCOIND_PROC_WAIT_TIMEOUT = 90
 
+# Logged by litecoind right after the RPC server leaves warmup
+INIT_DONE_MESSAGE = b"init message: Done loading"
+
+# How often to poll the datadir while waiting for nodes to start or stop
+READY_POLL_INTERVAL = 0.02
+
+# How often to probe RPC while the init done message hasn't been seen, in
+# case it was missed (eg -nodebuglogfile)
+RPC_PROBE_INTERVAL = 1.0
+
 class TestNode():
     """A class for representing a bitcoind node under test.
 
@@ -70,8 +93,27 @@ class TestNode():
         self.rpc_connected = False
         self.rpc = None
         self.url = None
+        self.debug_log_path = os.path.join(self.datadir, "regtest", "debug.log")
+        self.debug_log_offset = 0
+        self.next_rpc_probe = 0
         self.log = logging.getLogger('TestFramework.node%d' % i)
         self.cleanup_on_exit = True # Whether to kill the node when this object goes away
+        # Node pool to take the first started process from, if any (see nodepool.py)
+        self.pool = None
+        self.datadir_source = None
+        self.pool_lease = None
+        self.pool_tried = False
+        # Interval in seconds at which to sample the process's resource usage, if any (see procstats.py)
+        self.sample_interval = None
+        self.sampler = None
+        self.resource_runs = []
+        # Created on first use of wait_for_log() or log_events(), and runs while the node runs
+        self.log_tailer = None
+        # Mark of the log tailer where the log lines of the last start begin, and if the
+        # tailer wasn't created yet, the file_position()s of the logs where it should start reading
+        self.log_start_mark = None
+        self.log_start_positions = None
+        self.start_time = None
 
         self.p2ps = []
 
@@ -99,39 +141,185 @@ class TestNode():
             extra_args = self.extra_args
         if stderr is None:
             stderr = self.stderr
+        if self.pool is not None and not self.pool_tried and stderr is None and not args and not kwargs:
+            self.pool_tried = True
+            lease = self.pool.acquire(node_profile(self.index, self.args + extra_args, self.datadir, self.datadir_source))
+            if lease is not None:
+                self._attach_pooled_node(lease)
+                return
         # Delete any existing cookie file -- if such a file exists (eg due to
         # unclean shutdown), it will get overwritten anyway by bitcoind, and
         # potentially interfere with our attempt to authenticate
         delete_cookie_file(self.datadir)
+        # Only look for the init done message in what this process logs
+        try:
+            self.debug_log_offset = os.path.getsize(self.debug_log_path)
+        except OSError:
+            self.debug_log_offset = 0
+        self.rpc = None
+        self._mark_log_start()
+        self.start_time = time.time()
+        self.next_rpc_probe = self.start_time + RPC_PROBE_INTERVAL
         self.process = subprocess.Popen(self.args + extra_args, stderr=stderr, *args, **kwargs)
         self.running = True
+        self._start_sampler()
+        if self.log_tailer is not None:
+            self.log_tailer.start()
         self.log.debug("litecoind started, waiting for RPC to come up")
 
+    def _attach_pooled_node(self, lease):
+        """Use a process from the node pool instead of starting one.
+
+        The datadir becomes a symlink to the pooled node's datadir, and the
+        node's ports are overridden with the pooled node's ones. Restarts
+        after the first one start a new process in the pooled datadir."""
+        shutil.rmtree(self.datadir)
+        os.symlink(lease["datadir"], self.datadir)
+        PORT_OVERRIDES[self.index] = (lease["p2p_port"], lease["rpc_port"])
+        self.pool_lease = lease["id"]
+        # The pooled node is already up: probe RPC right away
+        self.debug_log_offset = 0
+        self.rpc = None
+        self.next_rpc_probe = 0
+        # The pooled node has logged its startup already
+        self._mark_log_start(rewind=True)
+        self.process = PooledProcess(lease["pid"])
+        self.start_time = time.time()
+        self.running = True
+        self._start_sampler()
+        if self.log_tailer is not None:
+            self.log_tailer.start()
+        self.log.debug("Using litecoind %d from the node pool" % lease["pid"])
+
+    def release_to_pool(self):
+        """Give a pooled node back to the pool, keeping a copy of its logs and litecoin.conf in the datadir."""
+        if self.pool_lease is None:
+            return
+        pooled_datadir = os.path.realpath(self.datadir)
+        os.remove(self.datadir)
+        os.makedirs(os.path.join(self.datadir, "regtest"))
+        shutil.copy(os.path.join(pooled_datadir, "litecoin.conf"), self.datadir)
+        for name in RELEASED_LOG_FILES:
+            path = os.path.join(pooled_datadir, "regtest", name)
+            if os.path.exists(path):
+                shutil.copy(path, os.path.join(self.datadir, "regtest"))
+        self.pool.release(self.pool_lease)
+        PORT_OVERRIDES.pop(self.index, None)
+        self.pool_lease = None
+
+    def _start_sampler(self):
+        if self.sample_interval:
+            self.sampler = ProcSampler(self.process.pid, self.sample_interval)
+            self.sampler.start()
+
+    def _stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.resource_runs.append(self.sampler.to_dict())
+            self.sampler = None
+
+    def write_resource_report(self, dirname):
+        """Write the resource usage samples of all runs of the node to <dirname>/reports."""
+        self._stop_sampler()
+        if self.resource_runs:
+            write_report(os.path.join(dirname, REPORTS_DIR, "node%d_resources.json" % self.index), self.index, self.resource_runs)
+
     def wait_for_rpc_connection(self):
-        """Sets up an RPC connection to the bitcoind process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
-            assert self.process.poll() is None, "litecoind exited with status %i during initialization" % self.process.returncode
-            try:
+        """Sets up an RPC connection to the bitcoind process."""
+        wait_for_rpc_connections([self])
+
+    def _init_done_logged(self):
+        """Read the debug.log lines written since the last call and check for the init done message."""
+        try:
+            with open(self.debug_log_path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < self.debug_log_offset:
+                    # The log was shrunk at startup
+                    self.debug_log_offset = 0
+                f.seek(self.debug_log_offset)
+                data = f.read()
+        except OSError:
+            return False
+        # Only consume complete lines
+        end = data.rfind(b"\n") + 1
+        self.debug_log_offset += end
+        return INIT_DONE_MESSAGE in data[:end]
+
+    def poll_rpc_connection(self):
+        """Check without blocking whether the RPC server is up, and connect to it if so.
+
+        The RPC server is only probed once debug.log shows that initialization
+        is done, or every RPC_PROBE_INTERVAL seconds as a fallback, so most
+        polls are a single read of the log tail."""
+        assert self.process.poll() is None, "litecoind exited with status %i during initialization" % self.process.returncode
+        now = time.time()
+        if not self._init_done_logged() and now < self.next_rpc_probe:
+            return False
+        self.next_rpc_probe = now + RPC_PROBE_INTERVAL
+        try:
+            if self.rpc is None:
                 self.rpc = get_rpc_proxy(rpc_url(self.datadir, self.index, self.rpchost), self.index, timeout=self.rpc_timeout, coveragedir=self.coverage_dir)
-                self.rpc.getblockcount()
-                # If the call to getblockcount() succeeds then the RPC connection is up
-                self.rpc_connected = True
-                self.url = self.rpc.url
-                self.log.debug("RPC successfully started")
-                return
-            except IOError as e:
-                if e.errno != errno.ECONNREFUSED:  # Port not yet open?
-                    raise  # unknown IO error
-            except JSONRPCException as e:  # Initialization phase
-                if e.error['code'] != -28:  # RPC in warmup?
-                    raise  # unknown JSON RPC exception
-            except ValueError as e:  # cookie file not found and no rpcuser or rpcassword. bitcoind still starting
-                if "No RPC credentials" not in str(e):
-                    raise
-            time.sleep(1.0 / poll_per_s)
-        raise AssertionError("Unable to connect to litecoind")
+            self.rpc.getblockcount()
+            # If the call to getblockcount() succeeds then the RPC connection is up
+            self.rpc_connected = True
+            self.url = self.rpc.url
+            self.log.debug("RPC successfully started")
+            return True
+        except IOError as e:
+            if e.errno != errno.ECONNREFUSED:  # Port not yet open?
+                raise  # unknown IO error
+        except JSONRPCException as e:  # Initialization phase
+            if e.error['code'] != -28:  # RPC in warmup?
+                raise  # unknown JSON RPC exception
+        except ValueError as e:  # cookie file not found and no rpcuser or rpcassword. bitcoind still starting
+            if "No RPC credentials" not in str(e):
+                raise
+        return False
+
+    def _log_files(self):
+        regtest = os.path.join(self.datadir, "regtest")
+        return {"debug": os.path.join(regtest, "debug.log"),
+                "tradelayer": os.path.join(regtest, "tradelayer.log")}
+
+    def _mark_log_start(self, rewind=False):
+        """Remember where the log lines of this start of the node begin (from the start of the logs if rewind)."""
+        if self.log_tailer is not None:
+            self.log_start_mark = None if rewind else self.log_tailer.mark()
+        else:
+            # The first event the tailer reads is the first one of this start
+            self.log_start_mark = 0
+            self.log_start_positions = None if rewind else {source: file_position(path) for source, path in self._log_files().items()}
+
+    def _get_log_tailer(self):
+        if self.log_tailer is None:
+            self.log_tailer = LogTailer(self._log_files(), name="LogTailer-node%d" % self.index,
+                                        positions=self.log_start_positions)
+            if self.running:
+                self.log_tailer.start()
+        return self.log_tailer
+
+    def _stop_log_tailer(self):
+        if self.log_tailer is not None:
+            self.log_tailer.stop()
+
+    def log_mark(self):
+        """Return a mark to pass as since= to wait_for_log() and log_events() to only consider later log lines."""
+        return self._get_log_tailer().mark()
+
+    def wait_for_log(self, pattern, timeout=60, since=None, source=None, category=None, kind=None):
+        """Wait until debug.log or tradelayer.log has a line matching the pattern regex and return its LogEvent.
+
+        since is a mark from log_mark(), and defaults to a mark taken at the
+        last start of the node. It can also be a time.time() timestamp, which
+        is only compared with debug.log times (see logtail.py). source ("debug"
+        or "tradelayer"), category and kind restrict the lines considered."""
+        if since is None:
+            since = self.log_start_mark
+        return self._get_log_tailer().wait_for(pattern, timeout, since=since, source=source, category=category, kind=kind)
+
+    def log_events(self, since=None, source=None, category=None, kind=None, pattern=None):
+        """Return the LogEvents of debug.log and tradelayer.log lines matching all the given filters."""
+        return self._get_log_tailer().select(since=since, source=source, category=category, kind=kind, pattern=pattern)
 
     def get_wallet_rpc(self, wallet_name):
         if self.use_cli:
@@ -165,6 +353,8 @@ class TestNode():
             return False
 
         # process has stopped. Assert that it didn't return an error code.
+        self._stop_sampler()
+        self._stop_log_tailer()
         assert_equal(return_code, 0)
         self.running = False
         self.process = None
@@ -174,7 +364,7 @@ class TestNode():
         return True
 
     def wait_until_stopped(self, timeout=BITCOIND_PROC_WAIT_TIMEOUT):
-        wait_until(self.is_node_stopped, timeout=timeout)
+        wait_until_stopped([self], timeout)
 
     def node_encrypt_wallet(self, passphrase):
         """"Encrypts the wallet.
@@ -214,6 +404,26 @@ class TestNode():
             p.peer_disconnect()
         del self.p2ps[:]
 
+def wait_for_rpc_connections(nodes):
+    """Wait for several starting nodes to come up, polling all of them in turn."""
+    pending = list(nodes)
+    deadline = time.time() + max(node.rpc_timeout for node in pending)
+    while True:
+        pending = [node for node in pending if not node.poll_rpc_connection()]
+        if not pending:
+            return
+        if time.time() > deadline:
+            raise AssertionError("Unable to connect to litecoind")
+        time.sleep(READY_POLL_INTERVAL)
+
+def wait_until_stopped(nodes, timeout=BITCOIND_PROC_WAIT_TIMEOUT):
+    """Wait for several stopping nodes to exit, polling all of them in turn."""
+    deadline = time.time() + timeout
+    while not all([node.is_node_stopped() for node in nodes]):
+        if time.time() > deadline:
+            raise AssertionError("Nodes did not stop within %d seconds" % timeout)
+        time.sleep(READY_POLL_INTERVAL)
+
 class TestNodeCLIAttr:
     def __init__(self, cli, command):
         self.cli = cli
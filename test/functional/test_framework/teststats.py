@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Statistics of a test script run, passed from the script to test_runner.py.
+
+At the end of a test, BitcoinTestFramework writes <tmpdir>/reports/test_stats.json:
+
+    {"setup_time": seconds until run_test() started,
+     "rpc_requests": number of RPC requests made by the script,
+     "rpc_seconds": time spent waiting for their responses,
+     "phases": {phase: seconds spent in it}}
+
+The phases are listed in PHASES. node_startup is the time spent in
+start_node() and start_nodes(), wherever they were called from, so it
+overlaps with setup_network and run_test.
+
+test_runner.py reads and removes the file, together with the directories
+it leaves empty, so that passing tests still leave no test directory."""
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+from .procstats import REPORTS_DIR
+
+TEST_STATS_FILE = "test_stats.json"
+
+PHASES = ["setup_chain", "setup_network", "node_startup", "run_test", "shutdown", "cleanup"]
+
+class PhaseTimer():
+    """Accumulate the time spent in each phase of a test."""
+
+    def __init__(self):
+        self.times = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.time() - start
+
+    def __str__(self):
+        return ", ".join("%s %.2f s" % (name, self.times[name]) for name in PHASES if name in self.times)
+
+def write_test_stats(testdir, stats):
+    path = os.path.join(testdir, REPORTS_DIR, TEST_STATS_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(stats, f)
+
+def load_test_stats(testdir):
+    """Return the statistics written by the test in testdir, or {} if there are none."""
+    reports = os.path.join(testdir, REPORTS_DIR)
+    path = os.path.join(reports, TEST_STATS_FILE)
+    try:
+        with open(path, encoding='utf8') as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    os.remove(path)
+    for directory in [reports, testdir]:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # Not empty: other reports, or the test failed and left its datadirs
+            break
+    return stats
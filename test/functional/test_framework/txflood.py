@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Multi-peer transaction flood load generator.
+
+TxFloodPeer: a P2PInterface that pushes transactions to a node and tracks
+    the inv, getdata and reject messages it gets back
+MempoolWatcher: a thread recording when transactions enter a node's mempool,
+    by polling getrawmempool or by listening to ZMQ hashtx notifications
+TxFlood: opens several TxFloodPeers to a node, streams pre-built
+    transactions through them at a target rate or as fast as possible and
+    reports throughput and acceptance latency"""
+
+from collections import defaultdict
+import logging
+import math
+import threading
+import time
+
+from .messages import (
+    MSG_WITNESS_FLAG,
+    CInv,
+    CTransaction,
+    FromHex,
+    msg_inv,
+    msg_tx,
+    msg_witness_tx,
+)
+from .mininode import P2PInterface, mininode_lock
+from .util import (
+    create_confirmed_utxos,
+    get_rpc_proxy,
+    satoshi_round,
+    wait_until,
+)
+
+logger = logging.getLogger("TestFramework.txflood")
+
+MSG_TX = 1
+
+def load_transactions(path):
+    """Load transactions from a file with one hex-encoded transaction per line."""
+    txs = []
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                txs.append(FromHex(CTransaction(), line))
+    return txs
+
+def create_wallet_transactions(node, count, fee):
+    """Build `count` signed, unbroadcast transactions that spend distinct wallet utxos.
+
+    The transactions are independent of each other, so they can be
+    accepted into the mempool in any order."""
+    utxos = create_confirmed_utxos(fee, node, count)
+    address = node.getnewaddress()
+    txs = []
+    for utxo in utxos[:count]:
+        inputs = [{"txid": utxo["txid"], "vout": utxo["vout"]}]
+        outputs = {address: satoshi_round(utxo["amount"] - fee)}
+        raw_tx = node.createrawtransaction(inputs, outputs)
+        signed = node.signrawtransaction(raw_tx)
+        assert signed["complete"]
+        txs.append(FromHex(CTransaction(), signed["hex"]))
+    return txs
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+class TxFloodPeer(P2PInterface):
+    """A P2P connection that pushes transactions to a node.
+
+    Transactions are either sent unsolicited, or announced with an inv and
+    sent when the node asks for them with getdata."""
+
+    subscribed_commands = {"inv", "getdata", "reject"}
+
+    def __init__(self):
+        super().__init__()
+        self.sent = 0
+        self.announced_back = set()
+        self.getdata_requests = 0
+        self.rejects = {}
+        self.pending = {}
+
+    def on_inv(self, message):
+        # The node relays accepted transactions back to every peer except
+        # the one it received them from. Don't request them.
+        for i in message.inv:
+            if i.type & ~MSG_WITNESS_FLAG == MSG_TX:
+                self.announced_back.add(i.hash)
+
+    def on_getdata(self, message):
+        for i in message.inv:
+            if i.type & ~MSG_WITNESS_FLAG == MSG_TX and i.hash in self.pending:
+                self.getdata_requests += 1
+                tx = self.pending.pop(i.hash)
+                self.send_message(msg_witness_tx(tx) if i.type & MSG_WITNESS_FLAG else msg_tx(tx))
+
+    def on_reject(self, message):
+        if message.message == b'tx':
+            self.rejects[message.data] = (message.code, message.reason)
+
+    def push_transaction(self, tx, announce=False):
+        if announce:
+            with mininode_lock:
+                self.pending[tx.sha256] = tx
+            self.send_message(msg_inv([CInv(MSG_TX, tx.sha256)]))
+        else:
+            self.send_message(msg_tx(tx) if tx.wit.is_null() else msg_witness_tx(tx))
+        self.sent += 1
+
+class MempoolWatcher(threading.Thread):
+    """Records the first time each watched txid is seen in a node's mempool.
+
+    Polls getrawmempool over a dedicated RPC connection, or subscribes to
+    the node's ZMQ hashtx notifications if zmq_address is given."""
+
+    def __init__(self, node, txids, poll_interval=0.05, zmq_address=None):
+        super().__init__(name="MempoolWatcher")
+        self.node = node
+        self.remaining = set(txids)
+        self.first_seen = {}
+        self.poll_interval = poll_interval
+        self.zmq_address = zmq_address
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        if zmq_address is not None:
+            # Subscribe before the flood starts so no notification is missed
+            import zmq
+            self.zmq_context = zmq.Context()
+            self.zmq_socket = self.zmq_context.socket(zmq.SUB)
+            self.zmq_socket.setsockopt(zmq.SUBSCRIBE, b"hashtx")
+            self.zmq_socket.setsockopt(zmq.RCVTIMEO, int(poll_interval * 1000))
+            self.zmq_socket.connect(zmq_address)
+
+    def _seen(self, txids, timestamp):
+        with self.lock:
+            for txid in txids:
+                if txid in self.remaining:
+                    self.remaining.discard(txid)
+                    self.first_seen[txid] = timestamp
+
+    def run(self):
+        if self.zmq_address is not None:
+            self._run_zmq()
+        else:
+            self._run_poll()
+
+    def _run_poll(self):
+        rpc = get_rpc_proxy(self.node.url, self.node.index, timeout=self.node.rpc_timeout)
+        while self.remaining and not self.stopped.is_set():
+            self._seen(rpc.getrawmempool(), time.time())
+            self.stopped.wait(self.poll_interval)
+
+    def _run_zmq(self):
+        import zmq
+        try:
+            while self.remaining and not self.stopped.is_set():
+                try:
+                    topic, body, seq = self.zmq_socket.recv_multipart()
+                except zmq.Again:
+                    continue
+                self._seen([body.hex()], time.time())
+        finally:
+            self.zmq_socket.close()
+            self.zmq_context.term()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class TxFlood():
+    """Streams pre-built transactions into a node over several P2P connections.
+
+    Usage:
+        flood = TxFlood(node, txs, num_peers=8)
+        flood.add_peers()
+        network_thread_start()
+        result = flood.run()
+
+    rate: target transactions per second over all peers, or None to send as
+        fast as possible.
+    announce: announce transactions with inv and answer getdata instead of
+        sending them unsolicited."""
+
+    def __init__(self, node, transactions, num_peers=4, rate=None, announce=False, poll_interval=0.05, zmq_address=None):
+        assert num_peers >= 1
+        self.node = node
+        self.transactions = transactions
+        self.num_peers = num_peers
+        self.rate = rate
+        self.announce = announce
+        self.poll_interval = poll_interval
+        self.zmq_address = zmq_address
+        self.peers = []
+        for tx in self.transactions:
+            tx.calc_sha256()
+
+    def add_peers(self):
+        """Open the P2P connections. Must be called before the network thread is started."""
+        for _ in range(self.num_peers):
+            self.peers.append(self.node.add_p2p_connection(TxFloodPeer()))
+        return self.peers
+
+    def run(self, timeout=300):
+        """Send all transactions, wait until each one is accepted or rejected and return the results."""
+        for peer in self.peers:
+            peer.wait_for_verack()
+
+        txids = [tx.hash for tx in self.transactions]
+        watcher = MempoolWatcher(self.node, txids, self.poll_interval, self.zmq_address)
+        watcher.start()
+
+        send_time = {}
+        start = time.time()
+        for i, tx in enumerate(self.transactions):
+            if self.rate:
+                delay = start + i / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            send_time[tx.hash] = time.time()
+            self.peers[i % self.num_peers].push_transaction(tx, self.announce)
+        send_end = time.time()
+
+        def all_done():
+            rejected = set()
+            for peer in self.peers:
+                rejected.update(peer.rejects)
+            with watcher.lock:
+                return all(tx.hash not in watcher.remaining or tx.sha256 in rejected for tx in self.transactions)
+        try:
+            wait_until(all_done, timeout=timeout, lock=mininode_lock)
+        finally:
+            watcher.stop()
+        end = time.time()
+        return self._results(start, send_end, end, send_time, watcher.first_seen)
+
+    def _results(self, start, send_end, end, send_time, first_seen):
+        latencies = [first_seen[txid] - send_time[txid] for txid in first_seen]
+        last_accept = max(first_seen.values()) if first_seen else end
+        with mininode_lock:
+            peers = [{
+                "sent": p.sent,
+                "getdata": p.getdata_requests,
+                "inv": len(p.announced_back),
+                "reject": len(p.rejects),
+            } for p in self.peers]
+            reject_reasons = defaultdict(int)
+            for p in self.peers:
+                for code, reason in p.rejects.values():
+                    reject_reasons["%d:%s" % (code, reason.decode('utf8', 'replace'))] += 1
+        result = {
+            "sent": len(self.transactions),
+            "accepted": len(first_seen),
+            "rejected": sum(p["reject"] for p in peers),
+            "reject_reasons": dict(reject_reasons),
+            "send_seconds": send_end - start,
+            "total_seconds": end - start,
+            "send_tx_per_s": len(self.transactions) / max(send_end - start, 1e-6),
+            "accepted_tx_per_s": len(first_seen) / max(last_accept - start, 1e-6),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p90": percentile(latencies, 90),
+            "latency_p99": percentile(latencies, 99),
+            "latency_max": max(latencies) if latencies else None,
+            "peers": peers,
+        }
+        logger.info("Sent %d txs in %.2f s (%.1f tx/s), %d accepted (%.1f tx/s), %d rejected" %
+                    (result["sent"], result["send_seconds"], result["send_tx_per_s"],
+                     result["accepted"], result["accepted_tx_per_s"], result["rejected"]))
+        return result
@@ -7,13 +7,18 @@
 from base64 import b64encode
 from binascii import hexlify, unhexlify
 from decimal import Decimal, ROUND_DOWN
+import errno
+import fcntl
 import hashlib
 import json
 import logging
 import os
 import random
 import re
+import shutil
+import socket
 from subprocess import CalledProcessError
+import tempfile
 import time
 
 #new libraries
@@ -229,13 +234,29 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=N
 # RPC/P2P connection constants and functions
 ############################################
 
-# The maximum number of nodes a single test can spawn
-MAX_NODES = 8
+# The maximum number of nodes a single test can spawn. Big Tradelayer
+# topologies can raise it with the TEST_MAX_NODES environment variable.
+MAX_NODES = int(os.getenv("TEST_MAX_NODES", "8"))
+# The number of nodes in the cache of pre-mined chains
+CACHE_NODES = min(8, MAX_NODES)
 # Don't assign rpc or p2p ports lower than this
 PORT_MIN = 11000
 # The number of ports to "reserve" for p2p and rpc, each
 PORT_RANGE = 5000
 
+# Lock files of the ports reserved by test processes, shared by all test runs
+# on the machine
+PORT_REGISTRY = os.getenv("TEST_PORT_REGISTRY", os.path.join(tempfile.gettempdir(), "litecoin_test_ports"))
+
+# Ports reserved by this process, by ("p2p" | "rpc", node index)
+_reserved_ports = {}
+# Open, locked registry files of the reserved ports. The locks are released
+# when the process exits.
+_port_locks = []
+
+# Ports of nodes that don't use the PortSeed ranges (e.g. nodes from the node pool), by node index
+PORT_OVERRIDES = {}
+
 class PortSeed:
     # Must be initialized with a unique integer for each process
     n = None
@@ -265,12 +286,61 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
 
     return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
 
+def port_is_free(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Like litecoind, don't mind connections in TIME_WAIT
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind(("127.0.0.1", port))
+    except OSError:
+        return False
+    finally:
+        s.close()
+    return True
+
+def reserve_port(range_start, hint):
+    """Reserve a free port in [range_start, range_start + PORT_RANGE), searching from hint.
+
+    A port is reserved by locking its file in PORT_REGISTRY for the lifetime of
+    the process, so concurrent test processes never get the same port, and
+    checked to be free by binding it, which skips ports still held by
+    leftover litecoinds."""
+    os.makedirs(PORT_REGISTRY, exist_ok=True)
+    for i in range(PORT_RANGE):
+        port = range_start + (hint - range_start + i) % PORT_RANGE
+        if port in _reserved_ports.values():
+            continue
+        f = open(os.path.join(PORT_REGISTRY, "%d.lock" % port), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            continue
+        if not port_is_free(port):
+            f.close()
+            continue
+        _port_locks.append(f)
+        return port
+    raise AssertionError("No free port in [%d, %d)" % (range_start, range_start + PORT_RANGE))
+
+def _node_port(kind, n):
+    if (kind, n) not in _reserved_ports:
+        range_start = PORT_MIN if kind == "p2p" else PORT_MIN + PORT_RANGE
+        # Start where the port seed puts this process, to spread concurrent tests over the range
+        hint = range_start + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+        _reserved_ports[(kind, n)] = reserve_port(range_start, hint)
+    return _reserved_ports[(kind, n)]
+
 def p2p_port(n):
     assert(n <= MAX_NODES)
-    return PORT_MIN + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+    if n in PORT_OVERRIDES:
+        return PORT_OVERRIDES[n][0]
+    return _node_port("p2p", n)
 
 def rpc_port(n):
-    return PORT_MIN + PORT_RANGE + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+    if n in PORT_OVERRIDES:
+        return PORT_OVERRIDES[n][1]
+    return _node_port("rpc", n)
 
 def rpc_url(datadir, i, rpchost=None):
     rpc_u, rpc_p = get_auth_cookie(datadir)
@@ -323,6 +393,83 @@ def get_auth_cookie(datadir):
         raise ValueError("No RPC credentials")
     return user, password
 
+# Datadir cloning
+#
+# Test datadirs are provisioned from the cache by sharing every file the node
+# never modifies with the cache, and only copying the rest:
+# - LevelDB tables (.ldb) are immutable once written, and block files other
+#   than the highest-numbered one are never appended to again. These are
+#   hardlinked.
+# - Everything else (LevelDB logs and manifests, the wallet, the last block
+#   file, the undo files...) is reflinked where the filesystem supports it (btrfs, xfs), which
+#   shares the data until either copy is modified, or copied.
+
+# ioctl to reflink a whole file on Linux
+FICLONE = 0x40049409
+
+# Filesystems (by device) where reflinks are not supported
+_no_reflink_devices = set()
+
+# Undo (rev) files are not hardlinked at all: the undo data of a block is
+# written to the rev file that matches the block's blk file, so connecting a
+# block that was stored earlier (a reorg, or a block that arrived late) writes
+# to an older rev file, which would change the cached copy through the link.
+BLOCK_FILE_RE = re.compile(r"^blk(\d+)\.dat$")
+
+def _last_block_file(names):
+    """Return the name of the highest-numbered blk file in a list of names, or None."""
+    last = None
+    for name in names:
+        m = BLOCK_FILE_RE.match(name)
+        if m and (last is None or int(m.group(1)) > last[0]):
+            last = (int(m.group(1)), name)
+    return last[1] if last else None
+
+def _reflink_or_copy(src, dst):
+    """Reflink src to dst if the filesystem supports it, else copy it. Returns True if reflinked."""
+    dev = os.stat(os.path.dirname(dst)).st_dev
+    if dev not in _no_reflink_devices:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM):
+                    raise
+                if e.errno != errno.EXDEV:
+                    _no_reflink_devices.add(dev)
+    shutil.copy2(src, dst)
+    return False
+
+def clone_datadir(from_dir, to_dir):
+    """Recursively clone a node datadir, sharing immutable files with the source.
+
+    Returns a dict with the number of files hardlinked, reflinked and copied,
+    and the number of bytes copied."""
+    stats = {"linked": 0, "reflinked": 0, "copied": 0, "bytes_copied": 0}
+    for dirpath, dirnames, filenames in os.walk(from_dir):
+        target = os.path.join(to_dir, os.path.relpath(dirpath, from_dir))
+        os.makedirs(target, exist_ok=True)
+        last_block_file = _last_block_file(filenames)
+        for name in filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(target, name)
+            if name.endswith(".ldb") or (BLOCK_FILE_RE.match(name) and name != last_block_file):
+                try:
+                    os.link(src, dst)
+                    stats["linked"] += 1
+                    continue
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+            if _reflink_or_copy(src, dst):
+                stats["reflinked"] += 1
+            else:
+                stats["copied"] += 1
+                stats["bytes_copied"] += os.path.getsize(dst)
+    return stats
+
 # If a cookie file exists in the given datadir, delete it.
 def delete_cookie_file(datadir):
     if os.path.isfile(os.path.join(datadir, "regtest", ".cookie")):
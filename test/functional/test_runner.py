@@ -15,9 +15,11 @@ For a description of arguments recognized by test scripts, see
 """
 
 import argparse
-from collections import deque
+from collections import Counter, deque
 import configparser
 import datetime
+import heapq
+import json
 import os
 import time
 import shutil
@@ -27,6 +29,14 @@ import subprocess
 import tempfile
 import re
 import logging
+import pstats
+import selectors
+
+from test_framework.coverage import REFERENCE_FILENAME, read_counts
+from test_framework.nodepool import NodePool
+from test_framework.procstats import REPORTS_DIR, load_summaries
+from test_framework.profiling import PROFILE_FILE, TRACEMALLOC_FILE, time_breakdown, write_profile_summary
+from test_framework.teststats import PHASES, load_test_stats
 
 # Formatting. Default colors to empty strings.
 BOLD, BLUE, RED, GREY = ("", ""), ("", ""), ("", ""), ("", "")
@@ -49,6 +59,16 @@ if os.name == 'posix':
     RED = ('\033[0m', '\033[0;31m')
     GREY = ('\033[0m', '\033[1;30m')
 
+# Rough memory use of a litecoind under test, and number of nodes of a typical
+# test, used to limit the default number of parallel jobs
+MEMORY_PER_NODE = 256 * 1024 * 1024
+NODES_PER_TEST = 4
+
+# How often to print the tests that are running
+PROGRESS_INTERVAL = 30
+# How long a test that timed out gets to shut down after SIGINT
+TIMEOUT_KILL_DELAY = 60
+
 TEST_EXIT_PASSED = 0
 TEST_EXIT_SKIPPED = 77
 
@@ -121,6 +141,8 @@ BASE_SCRIPTS= [
     'rpc_named_arguments.py',
     'wallet_listsinceblock.py',
     'p2p_leak.py',
+    'p2p_capture_replay.py',
+    'feature_snapshot.py',
     'wallet_encryption.py',
     'wallet_scriptaddress2.py',
     'feature_dersig.py',
@@ -149,6 +171,7 @@ EXTENDED_SCRIPTS = [
     'feature_maxuploadtarget.py',
     'mempool_packages.py',
     'feature_dbcrash.py',
+    'feature_fabricated_chain.py',
     # vv Tests less than 2m vv
     'feature_bip68_sequence.py',
     'mining_getblocktemplate_longpoll.py',
@@ -159,6 +182,8 @@ EXTENDED_SCRIPTS = [
     'rpc_bind.py',
     # vv Tests less than 30s vv
     'feature_assumevalid.py',
+    'p2p_recv_throughput.py',
+    'mempool_tx_flood.py',
     'example_test.py',
     'wallet_txn_doublespend.py',
     'wallet_txn_clone.py --mineblock',
@@ -167,11 +192,56 @@ EXTENDED_SCRIPTS = [
     'feature_rbf.py',
 ]
 
+TRADELAYER_SCRIPTS = [
+    # Tradelayer tests, run with --tradelayer
+    'tl_activation.py',
+    'tl_basics.py',
+    'tl_consensus.py',
+    'tl_contractchannels.py',
+    'tl_contractchannels_ext.py',
+    'tl_dex.py',
+    'tl_dex_override.py',
+    'tl_fees.py',
+    'tl_finder.py',
+    'tl_fixed.py',
+    'tl_inputcache.py',
+    'tl_kyc.py',
+    'tl_list.py',
+    'tl_ltcvolume.py',
+    'tl_managed.py',
+    'tl_metadex.py',
+    'tl_natives.py',
+    'tl_nodereward.py',
+    'tl_oracle_1.py',
+    'tl_oracle_self.py',
+    'tl_oracles.py',
+    'tl_oracles_entries.py',
+    'tl_oracles_liquidation.py',
+    'tl_payloads.py',
+    'tl_pegged.py',
+    'tl_persistence.py',
+    'tl_persistence_channels.py',
+    'tl_rawtransactions.py',
+    'tl_registers.py',
+    'tl_remaining.py',
+    'tl_reorg.py',
+    'tl_rpcvalues.py',
+    'tl_sendmany.py',
+    'tl_settlement_oracles.py',
+    'tl_tc_kyc.py',
+    'tl_tradechannels.py',
+    'tl_tradechannels_change.py',
+    'tl_tradechannels_close.py',
+    'tl_upnl.py',
+    'tl_vesting.py',
+]
+
 # Place EXTENDED_SCRIPTS first since it has the 3 longest running tests
-ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
+ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS + TRADELAYER_SCRIPTS
 
 NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
+    "block_timings.py",
     "combine_logs.py",
     "create_cache.py",
     "test_runner.py",
@@ -191,12 +261,31 @@ def main():
     parser.add_argument('--extended', action='store_true', help='run the extended test suite in addition to the basic tests')
     parser.add_argument('--force', '-f', action='store_true', help='run tests even on platforms where they are disabled by default (e.g. windows).')
     parser.add_argument('--help', '-h', '-?', action='store_true', help='print help text and exit')
-    parser.add_argument('--jobs', '-j', type=int, default=4, help='how many test scripts to run in parallel. Default=4.')
+    parser.add_argument('--importtime', action='store_true', help='run the test scripts with python3 -X importtime and print the modules that take longest to import.')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='how many test scripts to run in parallel. Default: the number of CPUs, limited by the available memory.')
     parser.add_argument('--keepcache', '-k', action='store_true', help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
+    parser.add_argument('--merge', nargs='+', metavar='RESULTSFILE', help='print the combined results of the --resultsfile files of several shards, update the timing file with them and exit with their combined status, instead of running tests.')
+    parser.add_argument('--nodestats', type=int, default=0, metavar='MS', help='sample CPU, memory, disk I/O and open files of every litecoind every MS milliseconds and print a summary per test.')
+    parser.add_argument('--phases', type=int, default=0, metavar='N', help='print the time spent in each phase of the tests (setup_chain, node startup, setup_network, run_test, shutdown, cleanup) and the N slowest phases. Also applies to --merge.')
+    parser.add_argument('--nodepool', type=int, default=0, metavar='N', help='keep up to N started litecoinds per node configuration and hand them to the test scripts instead of starting new ones. Default=0 (disabled).')
+    parser.add_argument('--profile', action='store_true', help='run the run_test() of every test under cProfile, and merge the profiles into <tmpdir>/profile.prof.')
     parser.add_argument('--quiet', '-q', action='store_true', help='only print results summary and failure logs')
+    parser.add_argument('--resultsfile', help='write the status, duration, setup time and RPC statistics of every test to this JSON file.')
+    parser.add_argument('--shard', metavar='I/N', help='split the selected tests into N shards of about the same total duration (according to the timing file) and only run the I-th one (1 <= I <= N). All shards must be run with the same timing file, which is not updated by the shards: use --merge to update it.')
+    parser.add_argument('--tradelayer', action='store_true', help='run the Tradelayer test suite instead of the base tests')
+    parser.add_argument('--timeout', type=int, default=None, help='interrupt tests that run longer than this many seconds. Default: 20 minutes on Travis, no timeout otherwise.')
+    parser.add_argument('--timingfile', help='JSON file with the durations of previous runs, used to start the longest tests first. Default: <builddir>/test/timings.json')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace the Python memory allocations of every test and keep a report of the top allocation sites after each phase in its directory.')
     parser.add_argument('--tmpdirprefix', '-t', default=tempfile.gettempdir(), help="Root directory for datadirs")
     args, unknown_args = parser.parse_known_args()
 
+    shard = None
+    if args.shard:
+        match = re.match(r"^(\d+)/(\d+)$", args.shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            parser.error("--shard must be I/N with 1 <= I <= N")
+        shard = (int(match.group(1)), int(match.group(2)))
+
     # args to be passed on always start with two dashes; tests are the remaining unknown args
     tests = [arg for arg in unknown_args if arg[:2] != "--"]
     passon_args = [arg for arg in unknown_args if arg[:2] == "--"]
@@ -206,6 +295,9 @@ def main():
     configfile = os.path.abspath(os.path.dirname(__file__)) + "/../config.ini"
     config.read_file(open(configfile))
 
+    if args.merge:
+        merge_results(args.merge, TestTimings(args.timingfile or "%s/test/timings.json" % config["environment"]["BUILDDIR"]), args.phases)
+
     passon_args.append("--configfile=%s" % configfile)
 
     # Set up logging
@@ -248,7 +340,9 @@ def main():
         # No individual tests have been specified.
         # Run all base tests, and optionally run extended tests.
         test_list = BASE_SCRIPTS
-        if args.extended:
+        if args.tradelayer:
+            test_list = TRADELAYER_SCRIPTS
+        elif args.extended:
             # place the EXTENDED_SCRIPTS first since the three longest ones
             # are there and the list is shorter
             test_list = EXTENDED_SCRIPTS + test_list
@@ -279,9 +373,43 @@ def main():
     if not args.keepcache:
         shutil.rmtree("%s/test/cache" % config["environment"]["BUILDDIR"], ignore_errors=True)
 
-    run_tests(test_list, config["environment"]["SRCDIR"], config["environment"]["BUILDDIR"], config["environment"]["EXEEXT"], tmpdir, args.jobs, args.coverage, passon_args, args.combinedlogslen)
+    if args.jobs is None:
+        args.jobs = default_jobs()
+        logging.debug("Running %d tests in parallel" % args.jobs)
+
+    if args.timeout is None and os.getenv('TRAVIS') == 'true':
+        # In travis, timeout individual tests (to stop tests hanging and not
+        # providing useful output)
+        args.timeout = 20 * 60
+
+    timings = TestTimings(args.timingfile or "%s/test/timings.json" % config["environment"]["BUILDDIR"])
 
-def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_coverage=False, args=[], combined_logs_len=0):
+    if shard:
+        num_tests = len(test_list)
+        test_list = timings.shard(test_list, *shard)
+        logging.debug("Shard %d/%d: running %d of %d tests" % (shard[0], shard[1], len(test_list), num_tests))
+        if not test_list:
+            if args.resultsfile:
+                write_results_file(args.resultsfile, [], 0, shard)
+            os.rmdir(tmpdir)
+            sys.exit(0)
+
+    run_tests(test_list, config["environment"]["SRCDIR"], config["environment"]["BUILDDIR"], config["environment"]["EXEEXT"], tmpdir, args.jobs, args.coverage, passon_args, args.combinedlogslen, args.nodepool, args.nodestats, timings, args.timeout, shard, args.resultsfile, args.phases, args.profile, args.tracemalloc, args.importtime)
+
+def default_jobs():
+    """Return the number of CPUs, limited to the number of tests that fit in the available memory."""
+    jobs = os.cpu_count() or 1
+    try:
+        with open("/proc/meminfo", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    jobs = min(jobs, available // (MEMORY_PER_NODE * NODES_PER_TEST))
+    except OSError:
+        pass
+    return max(1, jobs)
+
+def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_coverage=False, args=[], combined_logs_len=0, nodepool=0, nodestats=0, timings=None, timeout=None, shard=None, results_file=None, phases_top=0, profile=False, trace_memory=False, import_time=False):
     # Warn if bitcoind is already running (unix only)
     try:
         if subprocess.check_output(["pidof", "litecoind"]) is not None:
@@ -304,6 +432,9 @@ def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_cove
     flags = ["--srcdir={}/src".format(build_dir)] + args
     flags.append("--cachedir=%s" % cache_dir)
 
+    if nodestats:
+        flags.append("--nodestats=%d" % nodestats)
+
     if enable_coverage:
         coverage = RPCCoverage()
         flags.append(coverage.flag)
@@ -311,7 +442,8 @@ def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_cove
     else:
         coverage = None
 
-    if len(test_list) > 1 and jobs > 1:
+    # Tradelayer tests start from a clean chain or a ChainSnapshot, not from the cache
+    if len(test_list) > 1 and jobs > 1 and not all(t.startswith("tl_") for t in test_list):
         # Populate cache
         try:
             subprocess.check_output([tests_dir + 'create_cache.py'] + flags + ["--tmpdir=%s/cache" % tmpdir])
@@ -319,23 +451,60 @@ def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_cove
             sys.stdout.buffer.write(e.output)
             raise
 
+    # Not for create_cache.py, whose directory must be gone when it's done
+    flags.append("--teststats")
+    if profile:
+        flags.append("--profile")
+    if trace_memory:
+        flags.append("--tracemalloc")
+
+    if nodepool:
+        # Started after the cache is built, which pooled nodes are provisioned from
+        pool = NodePool(os.path.join(tmpdir, "nodepool"), nodepool)
+        pool.start()
+        logging.debug("Node pool listening at %s" % pool.socket_path)
+    else:
+        pool = None
+
+    if timings:
+        test_list = timings.longest_first(test_list)
+        predicted_makespan = timings.predicted_makespan(test_list, jobs)
+
     #Run Tests
-    job_queue = TestHandler(jobs, tests_dir, tmpdir, test_list, flags)
+    job_queue = TestHandler(jobs, tests_dir, tmpdir, test_list, flags, timeout, import_time)
     time0 = time.time()
     test_results = []
+    # test name -> {node index: resource usage summary}
+    resources = {}
+    # Merged profiles of the tests
+    merged_profile = None
+    memory_reports = []
 
     max_len_name = len(max(test_list, key=len))
 
-    for _ in range(len(test_list)):
+    num_tests = len(test_list)
+    for done in range(1, num_tests + 1):
         test_result, testdir, stdout, stderr = job_queue.get_next()
         test_results.append(test_result)
+        test_result.stats = load_test_stats(testdir)
+        if profile:
+            profile_path = os.path.join(testdir, REPORTS_DIR, PROFILE_FILE)
+            if os.path.isfile(profile_path):
+                if merged_profile is None:
+                    merged_profile = pstats.Stats(profile_path)
+                else:
+                    merged_profile.add(profile_path)
+        if trace_memory and os.path.isfile(os.path.join(testdir, REPORTS_DIR, TRACEMALLOC_FILE)):
+            memory_reports.append(os.path.join(testdir, REPORTS_DIR, TRACEMALLOC_FILE))
+        if nodestats:
+            resources[test_result.name] = load_summaries(testdir)
 
         if test_result.status == "Passed":
-            logging.debug("\n%s%s%s passed, Duration: %s s" % (BOLD[1], test_result.name, BOLD[0], test_result.time))
+            logging.debug("\n%s%s%s passed, Duration: %s s (%d/%d)" % (BOLD[1], test_result.name, BOLD[0], test_result.time, done, num_tests))
         elif test_result.status == "Skipped":
-            logging.debug("\n%s%s%s skipped" % (BOLD[1], test_result.name, BOLD[0]))
+            logging.debug("\n%s%s%s skipped (%d/%d)" % (BOLD[1], test_result.name, BOLD[0], done, num_tests))
         else:
-            print("\n%s%s%s failed, Duration: %s s\n" % (BOLD[1], test_result.name, BOLD[0], test_result.time))
+            print("\n%s%s%s failed, Duration: %s s (%d/%d)\n" % (BOLD[1], test_result.name, BOLD[0], test_result.time, done, num_tests))
             print(BOLD[1] + 'stdout:\n' + BOLD[0] + stdout + '\n')
             print(BOLD[1] + 'stderr:\n' + BOLD[0] + stderr + '\n')
             if combined_logs_len and os.path.isdir(testdir):
@@ -347,7 +516,30 @@ def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_cove
                 combined_logs, _ = subprocess.Popen([os.path.join(tests_dir, 'combine_logs.py'), '-c', testdir], universal_newlines=True, stdout=subprocess.PIPE).communicate()
                 print("\n".join(deque(combined_logs.splitlines(), combined_logs_len)))
 
-    print_results(test_results, max_len_name, (int(time.time() - time0)))
+    runtime = time.time() - time0
+    print_results(test_results, max_len_name, int(runtime))
+    if results_file:
+        write_results_file(results_file, test_results, runtime, shard)
+    if timings:
+        if predicted_makespan is not None:
+            print("Predicted runtime: %d s, actual: %d s\n" % (predicted_makespan, runtime))
+        if not shard:
+            # The other shards split the tests with the same durations
+            timings.update(test_results)
+            timings.save()
+    if nodestats:
+        print_resource_summary(resources, max_len_name)
+    if phases_top:
+        print_phase_report(test_results, max_len_name, phases_top)
+    if merged_profile is not None:
+        print_profile_summary(merged_profile, tmpdir)
+    if import_time:
+        print_import_times(job_queue.import_times)
+    if memory_reports:
+        print("Memory allocation reports:\n%s\n" % "\n".join("  " + path for path in sorted(memory_reports)))
+
+    if pool:
+        pool.stop()
 
     if coverage:
         coverage.report_rpc_coverage()
@@ -381,62 +573,232 @@ def print_results(test_results, max_len_name, runtime):
     results += "Runtime: %s s\n" % (runtime)
     print(results)
 
+def write_results_file(path, test_results, runtime, shard=None):
+    results = {
+        "shard": "%d/%d" % shard if shard else None,
+        "runtime": runtime,
+        "tests": [dict(name=result.name, status=result.status, duration=result.duration, **result.stats)
+                  for result in test_results],
+    }
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(results, f, indent=4)
+
+def merge_results(paths, timings, phases_top=0):
+    """Print the combined results of several --resultsfile files, update the timings with them and exit."""
+    test_results = []
+    runtime = 0
+    shards = set()
+    num_shards = set()
+    for path in paths:
+        with open(path, encoding="utf8") as f:
+            results = json.load(f)
+        # The shards ran in parallel
+        runtime = max(runtime, results["runtime"])
+        if results["shard"]:
+            index, count = map(int, results["shard"].split("/"))
+            shards.add(index)
+            num_shards.add(count)
+        for test in results["tests"]:
+            test_result = TestResult(test["name"], test["status"], int(test["duration"]), test["duration"])
+            test_result.stats = {key: value for key, value in test.items() if key not in ("name", "status", "duration")}
+            test_results.append(test_result)
+
+    missing = []
+    if len(num_shards) > 1:
+        print("%sWARNING!%s The results are from different numbers of shards: %s" % (BOLD[1], BOLD[0], sorted(num_shards)))
+    elif num_shards:
+        missing = sorted(set(range(1, num_shards.pop() + 1)) - shards)
+        if missing:
+            print("%sWARNING!%s Missing the results of shards %s" % (BOLD[1], BOLD[0], ", ".join(map(str, missing))))
+
+    if not test_results:
+        print("No test results in %s" % ", ".join(paths))
+        sys.exit(1)
+    max_len_name = len(max((result.name for result in test_results), key=len))
+    print_results(test_results, max_len_name, int(runtime))
+    if phases_top:
+        print_phase_report(test_results, max_len_name, phases_top)
+    timings.update(test_results)
+    timings.save()
+
+    all_passed = all(map(lambda test_result: test_result.was_successful, test_results))
+    sys.exit(not all_passed or bool(missing))
+
+def print_phase_report(test_results, max_len_name, top):
+    """Print the total time spent in each phase over all tests, and the slowest phases of single tests."""
+    totals = {}
+    rows = []
+    for test_result in test_results:
+        for phase, seconds in test_result.stats.get("phases", {}).items():
+            totals[phase] = totals.get(phase, 0) + seconds
+            rows.append((seconds, test_result.name, phase))
+    if not rows:
+        print("No phase timings reported by the tests\n")
+        return
+    time_sum = sum(test_result.duration for test_result in test_results) or 1
+    max_len_phase = max(len(phase) for phase in PHASES)
+
+    results = "\n" + BOLD[1] + "%s | %s | %s\n\n" % ("PHASE".ljust(max_len_phase), "TOTAL".rjust(10), "SHARE") + BOLD[0]
+    for phase in PHASES:
+        if phase in totals:
+            results += "%s | %s | %4.1f%%\n" % (phase.ljust(max_len_phase), ("%.1f s" % totals[phase]).rjust(10), 100 * totals[phase] / time_sum)
+    results += "(node_startup overlaps with setup_network and run_test)\n"
+
+    results += "\n" + BOLD[1] + "%s | %s | %s\n\n" % ("TEST".ljust(max_len_name), "PHASE".ljust(max_len_phase), "DURATION") + BOLD[0]
+    rows.sort(key=lambda row: (-row[0], row[1], row[2]))
+    for seconds, name, phase in rows[:top]:
+        results += "%s | %s | %.1f s\n" % (name.ljust(max_len_name), phase.ljust(max_len_phase), seconds)
+    print(results)
+
+def print_profile_summary(stats, tmpdir):
+    """Write the merged profile of the tests to tmpdir and print where their time went."""
+    stats.dump_stats(os.path.join(tmpdir, "profile.prof"))
+    write_profile_summary(stats, os.path.join(tmpdir, "profile.txt"))
+    total = stats.total_tt or 1
+    results = "\n" + BOLD[1] + "Time of the test scripts' run_test() by group:\n\n" + BOLD[0]
+    for group, seconds in time_breakdown(stats):
+        results += "  %-28s %9.1f s  %5.1f%%\n" % (group, seconds, 100 * seconds / total)
+    results += "\nMerged profile written to %s/profile.prof, summary in %s/profile.txt\n" % (tmpdir, tmpdir)
+    print(results)
+
+def print_import_times(import_times, top=25):
+    """Print the import time of the test scripts and the modules that took longest to import, over all scripts."""
+    if not import_times:
+        return
+    totals = {name: sum(modules.values()) for name, modules in import_times.items()}
+    slowest = max(totals, key=totals.get)
+    results = "\n" + BOLD[1] + "Import time per test script: %.0f ms on average, %.0f ms at most (%s)\n\n" % (
+        sum(totals.values()) / len(totals) / 1000, totals[slowest] / 1000, slowest) + BOLD[0]
+    # module -> (total self time over all scripts, number of scripts that imported it)
+    modules = {}
+    for imports in import_times.values():
+        for module, self_us in imports.items():
+            total, count = modules.get(module, (0, 0))
+            modules[module] = (total + self_us, count + 1)
+    width = max(len(module) for module in modules)
+    results += BOLD[1] + "%s | %s | %s\n\n" % ("MODULE".ljust(width), "TOTAL".rjust(10), "SCRIPTS") + BOLD[0]
+    for module, (total, count) in sorted(modules.items(), key=lambda item: -item[1][0])[:top]:
+        results += "%s | %s | %d\n" % (module.ljust(width), ("%.0f ms" % (total / 1000)).rjust(10), count)
+    print(results)
+
+def split_import_times(stderr):
+    """Remove the -X importtime lines from a test script's stderr.
+
+    Returns the rest of stderr and {module: self import time in microseconds}."""
+    imports = {}
+    lines = []
+    for line in stderr.splitlines(True):
+        if not line.startswith("import time:"):
+            lines.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            module = fields[2].strip()
+            imports[module] = imports.get(module, 0) + int(fields[0])
+    return "".join(lines), imports
+
+def print_resource_summary(resources, max_len_name):
+    """Print the litecoind resource usage of each test, heaviest CPU users first."""
+    columns = ["NODE", "CPU USER", "CPU SYS", "PEAK RSS", "READ", "WRITTEN", "PEAK FDS"]
+    results = "\n" + BOLD[1] + "%s | %s\n\n" % ("TEST".ljust(max_len_name), " | ".join(c.rjust(8) for c in columns)) + BOLD[0]
+    rows = []
+    for name, summaries in resources.items():
+        for node, summary in sorted(summaries.items()):
+            rows.append((summary["cpu_user"] + summary["cpu_sys"], name, node, summary))
+    rows.sort(key=lambda row: (-row[0], row[1], row[2]))
+    for _, name, node, summary in rows:
+        values = [str(node),
+                  "%.2f s" % summary["cpu_user"],
+                  "%.2f s" % summary["cpu_sys"],
+                  "%.1f MB" % (summary["peak_rss"] / 1e6),
+                  "%.1f MB" % (summary["read_bytes"] / 1e6),
+                  "%.1f MB" % (summary["write_bytes"] / 1e6),
+                  str(summary["peak_fds"])]
+        results += "%s | %s\n" % (name.ljust(max_len_name), " | ".join(v.rjust(8) for v in values))
+    print(results)
+
 class TestHandler:
     """
     Trigger the test scripts passed in via the list.
+
+    Finished test scripts are detected as soon as they exit, through a pidfd
+    (or, where pidfds aren't available, a pipe inherited by the script that
+    is closed when it exits) watched with a selector.
     """
 
-    def __init__(self, num_tests_parallel, tests_dir, tmpdir, test_list=None, flags=None):
+    def __init__(self, num_tests_parallel, tests_dir, tmpdir, test_list=None, flags=None, timeout=None, import_time=False):
         assert(num_tests_parallel >= 1)
         self.num_jobs = num_tests_parallel
         self.tests_dir = tests_dir
         self.tmpdir = tmpdir
         self.test_list = test_list
         self.flags = flags
+        self.timeout = timeout
+        # With import_time, the scripts run under this interpreter with -X
+        # importtime. Their import times, by test name -> {module: self time
+        # in microseconds}
+        self.import_time = import_time
+        self.import_times = {}
         self.num_running = 0
-        # In case there is a graveyard of zombie bitcoinds, we can apply a
-        # pseudorandom offset to hopefully jump over them.
-        # (625 is PORT_RANGE/MAX_NODES)
+        # The port seed is where a test starts looking for free ports (see
+        # reserve_port() in util.py). Tests reserve their ports through lock
+        # files, so seeds only spread concurrent tests over the port range and
+        # don't need to be unique; the pseudorandom offset spreads consecutive
+        # runs. (625 is PORT_RANGE/MAX_NODES)
         self.portseed_offset = int(time.time() * 1000) % 625
         self.jobs = []
+        self.selector = selectors.DefaultSelector()
+        self.use_pidfd = pidfd_supported()
+        # proc -> time it was interrupted for running longer than the timeout
+        self.interrupted = {}
+        self.next_progress = time.time() + PROGRESS_INTERVAL
+
+    def start_test(self, t):
+        self.num_running += 1
+        portseed = len(self.test_list) + self.portseed_offset
+        portseed_arg = ["--portseed={}".format(portseed)]
+        log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
+        log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
+        test_argv = t.split()
+        testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
+        tmpdir_arg = ["--tmpdir={}".format(testdir)]
+        argv = [self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg
+        if self.import_time:
+            argv = [sys.executable, "-X", "importtime"] + argv
+        if self.use_pidfd:
+            proc = subprocess.Popen(argv, universal_newlines=True, stdout=log_stdout, stderr=log_stderr)
+            watch_fd = os.pidfd_open(proc.pid)
+        else:
+            # The script holds the write end until it exits
+            watch_fd, write_fd = os.pipe()
+            proc = subprocess.Popen(argv, universal_newlines=True, stdout=log_stdout, stderr=log_stderr, pass_fds=(write_fd,))
+            os.close(write_fd)
+        self.selector.register(watch_fd, selectors.EVENT_READ)
+        self.jobs.append((t, time.time(), proc, testdir, log_stdout, log_stderr, watch_fd))
 
     def get_next(self):
         while self.num_running < self.num_jobs and self.test_list:
             # Add tests
-            self.num_running += 1
-            t = self.test_list.pop(0)
-            portseed = len(self.test_list) + self.portseed_offset
-            portseed_arg = ["--portseed={}".format(portseed)]
-            log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
-            log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
-            test_argv = t.split()
-            testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
-            tmpdir_arg = ["--tmpdir={}".format(testdir)]
-            self.jobs.append((t,
-                              time.time(),
-                              subprocess.Popen([self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
-                              testdir,
-                              log_stdout,
-                              log_stderr))
+            self.start_test(self.test_list.pop(0))
         if not self.jobs:
             raise IndexError('pop from empty list')
         while True:
             # Return first proc that finishes
-            time.sleep(.5)
             for j in self.jobs:
-                (name, time0, proc, testdir, log_out, log_err) = j
-                if os.getenv('TRAVIS') == 'true' and int(time.time() - time0) > 20 * 60:
-                    # In travis, timeout individual tests after 20 minutes (to stop tests hanging and not
-                    # providing useful output.
-                    proc.send_signal(signal.SIGINT)
+                (name, time0, proc, testdir, log_out, log_err, watch_fd) = j
                 if proc.poll() is not None:
+                    self.selector.unregister(watch_fd)
+                    os.close(watch_fd)
                     log_out.seek(0), log_err.seek(0)
                     [stdout, stderr] = [l.read().decode('utf-8') for l in (log_out, log_err)]
                     log_out.close(), log_err.close()
-                    if proc.returncode == TEST_EXIT_PASSED and stderr == "":
+                    if self.import_time:
+                        stderr, self.import_times[name] = split_import_times(stderr)
+                    if proc in self.interrupted:
+                        del self.interrupted[proc]
+                        status = "Failed"
+                        stderr += "\nTimed out after %d s\n" % self.timeout
+                    elif proc.returncode == TEST_EXIT_PASSED and stderr == "":
                         status = "Passed"
                     elif proc.returncode == TEST_EXIT_SKIPPED:
                         status = "Skipped"
@@ -445,14 +807,54 @@ class TestHandler:
                     self.num_running -= 1
                     self.jobs.remove(j)
 
-                    return TestResult(name, status, int(time.time() - time0)), testdir, stdout, stderr
-            print('.', end='', flush=True)
+                    duration = time.time() - time0
+                    return TestResult(name, status, int(duration), duration), testdir, stdout, stderr
+            self.selector.select(self.check_running())
+
+    def check_running(self):
+        """Interrupt or kill tests that ran out of time and print progress. Returns the time until this should be called again."""
+        now = time.time()
+        wakeup = self.next_progress
+        for (name, time0, proc, _, _, _, _) in self.jobs:
+            if not self.timeout:
+                break
+            if proc not in self.interrupted:
+                if now - time0 > self.timeout:
+                    # Let the framework shut down the nodes and keep the logs
+                    proc.send_signal(signal.SIGINT)
+                    self.interrupted[proc] = now
+                    wakeup = min(wakeup, now + TIMEOUT_KILL_DELAY)
+                else:
+                    wakeup = min(wakeup, time0 + self.timeout)
+            elif now - self.interrupted[proc] > TIMEOUT_KILL_DELAY:
+                proc.kill()
+            else:
+                wakeup = min(wakeup, self.interrupted[proc] + TIMEOUT_KILL_DELAY)
+        if now >= self.next_progress:
+            running = ", ".join("%s (%d s)" % (name, now - time0) for (name, time0, _, _, _, _, _) in self.jobs)
+            logging.debug("Running: %s" % running)
+            self.next_progress = now + PROGRESS_INTERVAL
+            wakeup = min(wakeup, self.next_progress)
+        return max(0, wakeup - now)
+
+def pidfd_supported():
+    if not hasattr(os, "pidfd_open"):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return False
+    return True
 
 class TestResult():
-    def __init__(self, name, status, time):
+    def __init__(self, name, status, time, duration=None):
         self.name = name
         self.status = status
         self.time = time
+        # Unrounded duration in seconds
+        self.duration = duration if duration is not None else time
+        # Setup time and RPC statistics reported by the test, see teststats.py
+        self.stats = {}
         self.padding = 0
 
     def __repr__(self):
@@ -482,7 +884,7 @@ def check_script_prefixes():
     # convention don't immediately cause the tests to fail.
     LEEWAY = 10
 
-    good_prefixes_re = re.compile("(example|feature|interface|mempool|mining|p2p|rpc|wallet)_")
+    good_prefixes_re = re.compile("(example|feature|interface|mempool|mining|p2p|rpc|tl|wallet)_")
     bad_script_names = [script for script in ALL_SCRIPTS if good_prefixes_re.match(script) is None]
 
     if len(bad_script_names) > 0:
@@ -505,6 +907,73 @@ def check_script_list(src_dir):
             # On travis this warning is an error to prevent merging incomplete commits into master
             sys.exit(1)
 
+class TestTimings():
+    """
+    Durations of the tests in previous runs, kept in a JSON file.
+
+    Tests are started longest first, so that the last tests to finish are
+    short ones and the run doesn't end with a single long test running
+    while the other jobs are idle. Tests without a recorded duration may be
+    long, so they are started before all others.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, encoding="utf8") as f:
+                self.durations = json.load(f)
+        except (OSError, ValueError):
+            self.durations = {}
+
+    def longest_first(self, test_list):
+        return sorted(test_list, key=lambda test: -self.durations.get(test, float('inf')))
+
+    def predicted_makespan(self, test_list, jobs):
+        """Return the predicted runtime of the tests in this order, or None if no test has a recorded duration."""
+        known = [self.durations[test] for test in test_list if test in self.durations]
+        if not known:
+            return None
+        default = sum(known) / len(known)
+        # Finish times of the jobs, the next test goes to the first one that is free
+        finish = [0.0] * min(jobs, len(test_list))
+        for test in test_list:
+            heapq.heapreplace(finish, finish[0] + self.durations.get(test, default))
+        return max(finish)
+
+    def shard(self, test_list, index, count):
+        """Return the tests of the index-th (1-based) of count shards, in their original order.
+
+        Tests are assigned longest first to the shard with the least total
+        duration so far. Tests without a recorded duration count as taking
+        the average duration. The split only depends on the test list and
+        the durations, so every shard computes the same one."""
+        known = [self.durations[test] for test in test_list if test in self.durations]
+        default = sum(known) / len(known) if known else 1.0
+        # (total duration, shard index) of the shards
+        loads = [(0.0, i) for i in range(count)]
+        selected = set()
+        for test in sorted(test_list, key=lambda test: (-self.durations.get(test, default), test)):
+            load, i = heapq.heappop(loads)
+            if i == index - 1:
+                selected.add(test)
+            heapq.heappush(loads, (load + self.durations.get(test, default), i))
+        return [test for test in test_list if test in selected]
+
+    def update(self, test_results):
+        for result in test_results:
+            if result.status != "Passed":
+                continue
+            previous = self.durations.get(result.name)
+            # Smooth out the noise of a single run
+            duration = result.duration if previous is None else (previous + result.duration) / 2
+            self.durations[result.name] = round(duration, 1)
+
+    def save(self):
+        try:
+            with open(self.path, "w", encoding="utf8") as f:
+                json.dump(self.durations, f, indent=4, sort_keys=True)
+        except OSError as e:
+            logging.warning("Could not save test timings to %s: %s" % (self.path, e))
+
 class RPCCoverage():
     """
     Coverage reporting utilities for test_runner.
@@ -526,10 +995,12 @@ class RPCCoverage():
 
     def report_rpc_coverage(self):
         """
-        Print out RPC commands that were unexercised by tests.
+        Print out RPC commands that were unexercised by tests, and the call
+        counts of the Tradelayer commands.
 
         """
-        uncovered = self._get_uncovered_rpc_commands()
+        all_cmds, counts = self._get_rpc_call_counts()
+        uncovered = all_cmds - set(counts)
 
         if uncovered:
             print("Uncovered RPC commands:")
@@ -537,22 +1008,31 @@ class RPCCoverage():
         else:
             print("All RPC commands covered.")
 
+        tl_cmds = sorted(cmd for cmd in all_cmds if cmd.startswith("tl_"))
+        if tl_cmds:
+            width = max(len(cmd) for cmd in tl_cmds)
+            results = BOLD[1] + "%s | %s\n\n" % ("TRADELAYER RPC".ljust(width), "CALLS") + BOLD[0]
+            for cmd in tl_cmds:
+                color = RED if not counts[cmd] else ("", "")
+                results += color[1] + "%s | %d\n" % (cmd.ljust(width), counts[cmd]) + color[0]
+            results += "\n%d of %d Tradelayer commands covered\n" % (sum(1 for cmd in tl_cmds if counts[cmd]), len(tl_cmds))
+            print(results)
+
     def cleanup(self):
         return shutil.rmtree(self.dir)
 
-    def _get_uncovered_rpc_commands(self):
+    def _get_rpc_call_counts(self):
         """
-        Return a set of currently untested RPC commands.
+        Return the set of all RPC commands and a Counter of the calls made by the tests.
 
         """
         # This is shared from `test/functional/test-framework/coverage.py`
-        reference_filename = 'rpc_interface.txt'
         coverage_file_prefix = 'coverage.'
 
-        coverage_ref_filename = os.path.join(self.dir, reference_filename)
+        coverage_ref_filename = os.path.join(self.dir, REFERENCE_FILENAME)
         coverage_filenames = set()
         all_cmds = set()
-        covered_cmds = set()
+        counts = Counter()
 
         if not os.path.isfile(coverage_ref_filename):
             raise RuntimeError("No coverage reference found")
@@ -566,10 +1046,9 @@ class RPCCoverage():
                     coverage_filenames.add(os.path.join(root, filename))
 
         for filename in coverage_filenames:
-            with open(filename, 'r') as f:
-                covered_cmds.update([i.strip() for i in f.readlines()])
+            counts.update(read_counts(filename))
 
-        return all_cmds - covered_cmds
+        return all_cmds, counts
 
 
 if __name__ == '__main__':
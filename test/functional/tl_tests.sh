@@ -1,9 +1,4 @@
-a=$(ls | grep tl_)
-forb="tl_tests.sh"
-for i in ${a}
-do
-    if [[ "$i" != "$forb" ]];
-    then
-        ./$i
-    fi
-done
+#!/usr/bin/env bash
+# Run the Tradelayer functional tests in parallel. Arguments are passed on to
+# test_runner.py, e.g. ./tl_tests.sh -j8 or ./tl_tests.sh tl_dex.py tl_fees.py
+exec "$(dirname "$0")/test_runner.py" --tradelayer "$@"